@@ -58,6 +58,7 @@ AUTHENTICATION_BACKENDS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'colony.profiling.QueryProfileMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -125,6 +126,47 @@ USE_TZ = True
 # Change 'default' database configuration with $DATABASE_URL.
 DATABASES['default'].update(dj_database_url.config(conn_max_age=500, ssl_require=True))
 
+# Cache for rendered census rows and reports
+# By default this is in local memory, which is per process. Set REDIS_URL
+# (requires django-redis) or MEMCACHED_LOCATION to share it between 
+# processes. The cache keys change whenever the data does, so any of 
+# these give correct results.
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        }
+    }
+elif os.environ.get('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_LOCATION'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'OPTIONS': {
+                # Enough for one rendered row per cage
+                'MAX_ENTRIES': 10000,
+            },
+        }
+    }
+
+# Serve the autocompletes of unsacked mice from an in-memory index in
+# each process, instead of querying the database on every keystroke
+# (see colony.name_index). Set MOUSE_NAME_INDEX to enable it.
+MOUSE_NAME_INDEX = bool(os.environ.get('MOUSE_NAME_INDEX'))
+
+# Count and time the SQL queries of each request (see colony.profiling).
+# Set QUERY_PROFILE to enable it, and QUERY_BUDGET to log the requests
+# that make more queries than that.
+QUERY_PROFILE = bool(os.environ.get('QUERY_PROFILE'))
+QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 0)) or None
+
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
@@ -159,6 +201,10 @@ LOGGING = {
             'handlers': ['console'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'ERROR'),
         },
+        'colony': {
+            'handlers': ['console'],
+            'level': os.getenv('COLONY_LOG_LEVEL', 'WARNING'),
+        },
     },
 }
 
@@ -2,10 +2,13 @@ from builtins import str
 from builtins import object
 from django.contrib import admin
 from .models import (Mouse, Genotype, Litter, 
-    Cage, Person, SpecialRequest, HistoricalMouse, Gene, MouseGene)
+    Cage, Person, SpecialRequest, HistoricalMouse, Gene, MouseGene,
+    combine_genesets, distinct_genesets, format_genesets)
 # Register your models here.
 from django.db.models import Count
+from django.http import HttpResponseRedirect
 from django.urls import reverse
+from django.utils.http import urlencode
 from simple_history.admin import SimpleHistoryAdmin
 from django.contrib.admin.views.main import ChangeList
 from django.utils.safestring import mark_safe
@@ -140,15 +143,27 @@ class LitterAdmin(admin.ModelAdmin):
     # that haven't been genotyped yet)
     ordering = ('-date_genotyped', 'dob', 'date_toeclipped', 
         'breeding_cage__name',)
+    
+    # The cage of each litter is shown in its row
+    list_select_related = ('breeding_cage',)
 
     def get_changelist(self, request, **kwargs):
         """Overrule changelist so that clicking litter name goes to page"""
         return LitterAdminChangeList
 
     def get_queryset(self, request):
-        """Only return litters that are born."""
+        """Only return litters that are born.
+        
+        The pups, special requests, and genes shown in each row are 
+        prefetched.
+        """
         qs = super(LitterAdmin, self).get_queryset(request)
-        return qs.filter(dob__isnull=False)
+        return qs.filter(dob__isnull=False).select_related(
+            'father', 'mother').prefetch_related('mouse_set',
+            'breeding_cage__specialrequest_set__requestee',
+            'breeding_cage__mouse_set__mousegene_set__gene_name',
+            'father__mousegene_set__gene_name',
+            'mother__mousegene_set__gene_name')
 
     def name(self, obj):
         return str(obj)
@@ -163,7 +178,28 @@ class LitterAdmin(admin.ModelAdmin):
         return obj.breeding_cage.notes
 
     def cross(self, obj):
-        return obj.breeding_cage.printable_relevant_genesets
+        """The relevant genesets of the breeding cage
+        
+        This is the same as obj.breeding_cage.printable_relevant_genesets,
+        but it only uses the prefetched mice and genes.
+        """
+        cage_mice = obj.breeding_cage.mouse_set.all()
+        mother_in_cage = obj.mother.cage_id == obj.breeding_cage_id
+        if mother_in_cage or len(cage_mice) == 0:
+            # A breeding cage: the genes of both parents
+            genesets = [combine_genesets([
+                [(mg.gene_name.name, mg.gene_name.gene_type) 
+                for mg in parent.mousegene_set.all()]
+                for parent in [obj.father, obj.mother]
+            ])]
+        else:
+            # The distinct genes of the mice in the cage
+            genesets = distinct_genesets([
+                [(mg.gene_name.name, mg.gene_name.gene_type) 
+                for mg in mouse.mousegene_set.all()]
+                for mouse in cage_mice
+            ])
+        return format_genesets(genesets)
     cross.short_description = 'Cross'
     
     def n_pups(self, obj):
@@ -279,7 +315,7 @@ class CageAdmin(admin.ModelAdmin):
     selection, as opposed to individually going to each mouse page.
     """
     # Columns in the list page
-    list_display = ('name', 'rack_spot', 'proprietor', 
+    list_display = ('name', 'rack_spot', 'proprietor', 'cage_type',
         'target_genotype', 'link_to_mice', 
         'auto_needs_message', 'notes',)
     
@@ -288,7 +324,7 @@ class CageAdmin(admin.ModelAdmin):
     
     # This allows filtering by proprietor name and defunctness
     # Also filter by genotype of contained mice
-    list_filter = ('proprietor__name', DefunctFilter, 
+    list_filter = ('proprietor__name', DefunctFilter, 'cage_type',
         'mouse__mousegene__gene_name', 'location',)
     
     # Allow searching cages by mouse info
@@ -314,6 +350,31 @@ class CageAdmin(admin.ModelAdmin):
 
     # Pagination to save time
     list_per_page = 20
+    
+    # The proprietor and litter of each cage are shown in its row
+    list_select_related = ('proprietor', 'litter',)
+    
+    # Sack many cages at once
+    actions = ['sack']
+
+    def sack(self, request, queryset):
+        """Go to the page to confirm sacking the selected cages"""
+        return HttpResponseRedirect('%s?%s' % (
+            reverse('colony:sack_multiple'),
+            urlencode([('cages', pk) for pk in 
+            queryset.filter(defunct=False).values_list('pk', flat=True)]),
+        ))
+    sack.short_description = 'Sack all mice and make the cages defunct'
+
+    def get_queryset(self, request):
+        """Prefetch the mice and special requests shown for each cage"""
+        qs = super(CageAdmin, self).get_queryset(request)
+        return qs.prefetch_related(
+            'mouse_set__mousegene_set__gene_name',
+            'mouse_set__litter',
+            'mouse_set__user',
+            'specialrequest_set__requestee',
+        )
 
     ## Define what shows up on the individual cage admin page
     # Clickable links to every mouse in the cage
@@ -321,7 +382,8 @@ class CageAdmin(admin.ModelAdmin):
     def link_to_mice(self, obj):
         """Generate HTML links for every mouse in the cage"""
         link_html_code = ''
-        for child in obj.mouse_set.order_by('name').all():
+        # The mice are already ordered by name, and prefetched
+        for child in obj.mouse_set.all():
             child_link = reverse("admin:colony_mouse_change", 
                 args=[child.id])
             child_info = child.info()
@@ -394,7 +456,7 @@ class MouseAdmin(admin.ModelAdmin):
     readonly_fields = ('info', 'age', 'dob', 'mother', 'father', 'sacked', 
         'link_to_mother', 'link_to_father', 'link_to_progeny',
         'link_to_cage', 'cage_history_string', 'litter_management',
-        'old_genotype', 'new_genotype',)
+        'old_genotype', 'new_genotype', 'change_log_string',)
 
     # How to filter and search
     list_filter = ['cage__proprietor', 'user', 'breeder', SackFilter, 
@@ -407,6 +469,14 @@ class MouseAdmin(admin.ModelAdmin):
     
     # Pagination to save time
     list_per_page = 20
+    
+    # The user, cage, and litter (for dob) are shown in each row
+    list_select_related = ('user', 'cage', 'litter',)
+    
+    def get_queryset(self, request):
+        """Prefetch the genes shown in the genotype of each mouse"""
+        qs = super(MouseAdmin, self).get_queryset(request)
+        return qs.prefetch_related('mousegene_set__gene_name')
 
     ## Ordering for choosing cage for mouse
     # http://stackoverflow.com/questions/8992865/django-admin-sort-foreign-key-field-list
@@ -496,6 +566,10 @@ class MouseAdmin(admin.ModelAdmin):
         (None, {
             'fields': ('cage_history_string', ),
             'description': 'Historical cage records',
+        }),
+        (None, {
+            'fields': ('change_log_string', ),
+            'description': 'Historical records of every change',
         }),                
         (None, {
             'fields': ('dob', 'age', 'manual_father', 'manual_mother', 'manual_dob',),
@@ -552,6 +626,7 @@ class SpecialRequestAdmin(admin.ModelAdmin):
     list_display = ('cage', 'requester', 'requestee', 'date_requested', 
         'date_completed', 'message',)
     list_filter = ('requester', 'requestee')
+    list_select_related = ('cage', 'requester', 'requestee',)
 
 class HistoricalMouseAdmin(admin.ModelAdmin):
     list_filter = ('cage__name', 'name',)
@@ -559,6 +634,15 @@ class HistoricalMouseAdmin(admin.ModelAdmin):
     list_display = ('history_date', 'history_user', 'name', 'cage', 'notes',
         'genotype',)
     change_list_template = 'admin/colony/historicalmouse/change_list.html'
+    list_select_related = ('history_user', 'cage', 'genotype',)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # Each litter is named after its breeding cage
+        if db_field.name == "litter":
+            kwargs["queryset"] = Litter.objects.select_related(
+                'breeding_cage')
+        return super(HistoricalMouseAdmin, self).formfield_for_foreignkey(
+            db_field, request, **kwargs)
 
 
 admin.site.register(HistoricalMouse, HistoricalMouseAdmin)
@@ -5,3 +5,7 @@ from django.apps import AppConfig
 
 class ColonyConfig(AppConfig):
     name = 'colony'
+    
+    def ready(self):
+        # Connect the signal handlers
+        from . import signals
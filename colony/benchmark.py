@@ -0,0 +1,140 @@
+"""Time the census, the reports, and the admin changelists
+
+run_benchmarks fills the database with a synthetic colony at each scale
+(see colony.synthetic), requests each of BENCHMARK_URLS as a superuser,
+and returns the number of queries and the time taken. Use the benchmark
+management command to run these on a temporary test database and save
+the results as JSON, to compare before and after a change:
+    python manage.py benchmark --mice 1000 10000 --output before.json
+
+Each URL is requested once after clearing the cache ('cold'), and then
+repeatedly with the cache filled ('warm').
+"""
+from __future__ import unicode_literals
+from __future__ import division
+
+import datetime
+import platform
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from .profiling import QueryProfile
+from .synthetic import generate_colony
+
+# Name, URL name, and query string of each page to benchmark
+BENCHMARK_URLS = (
+    ('census', 'colony:census', ''),
+    ('census_by_genotype', 'colony:census', 'sort_by=genotype'),
+    ('summary', 'colony:summary', ''),
+    ('records', 'colony:records', ''),
+    ('counts_by_person', 'colony:counts_by_person', ''),
+    ('cage_changelist', 'admin:colony_cage_changelist', ''),
+    ('mouse_changelist', 'admin:colony_mouse_changelist', ''),
+    ('litter_changelist', 'admin:colony_litter_changelist', ''),
+)
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2
+
+def benchmark_url(client, url, repeat):
+    """Request url once cold and repeat times warm
+
+    Returns: dict with keys:
+        'status' : the status code of the cold request
+        'queries', 'duplicates', 'sql_ms', 'ms' : of the cold request
+        'warm_queries', 'warm_ms' : of the warm requests, the median time
+    """
+    cache.clear()
+    with QueryProfile() as cold:
+        response = client.get(url)
+
+    warm_l = []
+    for idx in range(repeat):
+        with QueryProfile() as warm:
+            client.get(url)
+        warm_l.append(warm)
+
+    return {
+        'status': response.status_code,
+        'queries': cold.n_queries,
+        'duplicates': cold.n_duplicates,
+        'sql_ms': round(cold.sql_time * 1000, 1),
+        'ms': round(cold.total_time * 1000, 1),
+        'warm_queries': max([warm.n_queries for warm in warm_l] or [0]),
+        'warm_ms': round(median(
+            [warm.total_time * 1000 for warm in warm_l] or [0]), 1),
+    }
+
+def run_benchmarks(scales, seed=0, repeat=3, today=None, log=None):
+    """Benchmark BENCHMARK_URLS at each scale, in the current database
+
+    scales : list of numbers of mice
+    seed, today : passed to generate_colony
+    repeat : number of warm requests of each URL
+    log : if not None, a function that is called with progress messages
+
+    The database is flushed before each scale, so this must not be run
+    on a database with real data. The static files storage is replaced,
+    so that the pages can be rendered without running collectstatic.
+
+    Returns: dict with keys:
+        'database', 'django', 'python', 'date', 'seed', 'repeat'
+        'results' : list of dicts, one per scale and URL, with the keys
+            from benchmark_url, and 'mice', 'cages', 'name', 'url'
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    results = []
+    with override_settings(STATICFILES_STORAGE=
+        'django.contrib.staticfiles.storage.StaticFilesStorage'):
+        for n_mice in scales:
+            call_command('flush', interactive=False, verbosity=0)
+            counts = generate_colony(n_mice, seed=seed, today=today)
+            if log is not None:
+                log('generated %s' % ', '.join(['%d %s' % (n, name)
+                    for name, n in sorted(counts.items())]))
+
+            user = User.objects.create_superuser(
+                'benchmark', 'benchmark@example.com', 'benchmark')
+            client = Client()
+            client.force_login(user)
+
+            for name, url_name, query in BENCHMARK_URLS:
+                url = reverse(url_name)
+                if query:
+                    url += '?' + query
+                result = benchmark_url(client, url, repeat)
+                result.update({
+                    'mice': counts['Mouse'],
+                    'cages': counts['Cage'],
+                    'name': name,
+                    'url': url,
+                })
+                results.append(result)
+                if log is not None:
+                    log('%d mice, %s: %d queries, %.1f ms' % (
+                        counts['Mouse'], name, result['queries'],
+                        result['ms']))
+
+    return {
+        'database': connection.vendor,
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'date': today.isoformat(),
+        'seed': seed,
+        'repeat': repeat,
+        'results': results,
+    }
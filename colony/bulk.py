@@ -0,0 +1,367 @@
+"""Bulk operations on mice, that run a fixed number of queries
+
+Saving mice one at a time runs several queries per mouse: the save
+itself, its historical record, and the signal handlers in
+colony.signals that reclassify the affected cages. The functions here
+instead create many objects at once inside a single transaction, along
+with their historical records, and then refresh the affected cages 
+once.
+
+Bulk operations do not fire signals, so each function here refreshes
+the cages it affected itself (see colony.signals.refresh_cages), logs 
+the changes of the historical records it creates (see 
+colony.changes.log_changes), and marks the mice it changed in the mouse
+name index (see colony.name_index).
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from .changes import MODEL_NAMES, log_changes, select_display_related
+from .husbandry import sync_tasks
+from .models import Cage, Genotype, Litter, Mouse, MouseGene
+from .name_index import mouse_name_index
+from .signals import cages_affected_by_mice, refresh_cages
+
+# The suffix of the new cage for the pups of each sex, when weaning
+WEAN_CAGE_SUFFIXES = ((0, 'M'), (1, 'F'), (2, 'PUP'))
+
+
+def create_historical_records(model, objs, history_type, user=None,
+    history_date=None):
+    """Create the historical records of objs in bulk, as if saved
+
+    model : a model tracked by simple_history, like Mouse
+    objs : list of saved instances of model, with their current values
+    history_type : '+' if they were created, '~' if they were changed
+    user : the User to record as history_user, or None
+    history_date : when they were saved, by default now
+
+    This is like simple_history's bulk_history_create, which can only
+    record creations. All of the records have the same history_date.
+    Changes to Mouse and Cage are logged in ChangeLog, like the signal
+    handler does for records created by saving.
+
+    Returns: the number of records created
+    """
+    history_model = model.history.model
+    if history_date is None:
+        history_date = timezone.now()
+    records = [history_model(
+        history_date=history_date,
+        history_user=user,
+        history_change_reason=None,
+        history_type=history_type,
+        **dict([(field.attname, getattr(obj, field.attname))
+            for field in obj._meta.fields
+            if field.name not in history_model._history_excluded_fields])
+    ) for obj in objs]
+    history_model.objects.bulk_create(records, batch_size=500)
+
+    # Created records have no changes to log
+    if history_type != '+' and history_model in MODEL_NAMES:
+        # Fetch them again, with their history_ids, and with what is
+        # needed to display the changes
+        log_changes(history_model, list(select_display_related(
+            history_model.objects.filter(
+            history_date=history_date, history_type=history_type,
+            id__in=[obj.pk for obj in objs]))))
+
+    return len(records)
+
+def create_with_history(model, objs, user=None):
+    """Create objs and their historical records in bulk
+
+    model : Mouse or Cage, or another model tracked by simple_history 
+        with a unique name
+    objs : list of unsaved instances of model
+    user : the User to record as history_user, or None
+
+    This is like simple_history.utils.bulk_create_with_history, but it
+    records the user, and on databases where bulk_create does not set 
+    the pks it fetches the objects again in a single query (by their 
+    unique names), rather than one query per object.
+
+    Returns: the list of created objects, with their pks
+    """
+    if len(objs) == 0:
+        return []
+
+    with transaction.atomic():
+        created = model.objects.bulk_create(objs, batch_size=500)
+        if created[0].pk is None:
+            name2obj = model.objects.in_bulk(
+                [obj.name for obj in objs], field_name='name')
+            created = [name2obj[obj.name] for obj in objs]
+
+        create_historical_records(model, created, '+', user=user)
+
+    return created
+
+def get_pup_traits(litter):
+    """Returns the traits that pups inherit from the parents of litter
+
+    This runs a single query, for the MouseGenes of both parents.
+
+    Returns: pure_breeder, wild_type, gene_ids
+        pure_breeder : if one parent is pure and the other is wild type,
+            or if both are pure breeders of the same single gene
+        wild_type : if both parents are wild type
+        gene_ids : sorted list of the ids of the genes of either parent
+    """
+    mother, father = litter.mother, litter.father
+    parent_gene_ids = {mother.pk: [], father.pk: []}
+    for mouse_id, gene_id in MouseGene.objects.filter(
+        mouse_name__in=[mother.pk, father.pk]).values_list(
+        'mouse_name_id', 'gene_name_id'):
+        parent_gene_ids[mouse_id].append(gene_id)
+
+    # See have_same_single_gene
+    same_single_gene = (
+        len(parent_gene_ids[mother.pk]) == 1 and
+        len(parent_gene_ids[father.pk]) == 1 and
+        parent_gene_ids[mother.pk] == parent_gene_ids[father.pk])
+
+    pure_breeder = (
+        (mother.pure_breeder and father.wild_type) or
+        (father.pure_breeder and mother.wild_type) or
+        (father.pure_breeder and mother.pure_breeder and same_single_gene)
+    )
+
+    # wild_type implies pure_breeder
+    wild_type = mother.wild_type and father.wild_type
+    if wild_type:
+        pure_breeder = True
+
+    gene_ids = sorted(set(
+        parent_gene_ids[mother.pk] + parent_gene_ids[father.pk]))
+
+    return pure_breeder, wild_type, gene_ids
+
+def create_pups(litter, number_of_pups, user=None):
+    """Add pups to litter, until it has number_of_pups
+
+    The pups are named after the breeding cage and numbered from the
+    number of existing pups, like '1234-5'. Names that are already taken
+    are skipped. Each pup starts in the breeding cage with unknown sex,
+    the 'TBD' genotype, and a '?/?' MouseGene for each gene of either
+    parent.
+
+    The pups, their historical records, and their MouseGenes are each
+    created with a single query, in one transaction, and the breeding
+    cage is refreshed once.
+
+    user : the User to record as history_user, or None
+
+    Returns: the list of created Mouse
+    """
+    cage_name = litter.breeding_cage.name
+    n_existing = litter.mouse_set.count()
+    names = ['%s-%d' % (cage_name, pupnum + 1)
+        for pupnum in range(n_existing, number_of_pups)]
+    if len(names) == 0:
+        return []
+
+    # Pups that already exist, due to naming the pups weirdly
+    taken = set(Mouse.objects.filter(name__in=names).values_list(
+        'name', flat=True))
+
+    pure_breeder, wild_type, gene_ids = get_pup_traits(litter)
+    genotype = Genotype.objects.filter(name='TBD').first()
+
+    with transaction.atomic():
+        pups = create_with_history(Mouse, [
+            Mouse(
+                name=name,
+                sex=2,
+                genotype=genotype,
+                litter=litter,
+                cage_id=litter.breeding_cage_id,
+                pure_breeder=pure_breeder,
+                wild_type=wild_type,
+            ) for name in names if name not in taken], user=user)
+
+        MouseGene.objects.bulk_create([
+            MouseGene(mouse_name_id=pup.pk, gene_name_id=gene_id,
+                zygosity='?/?')
+            for pup in pups for gene_id in gene_ids], batch_size=500)
+
+        refresh_cages(Cage.objects.filter(pk=litter.breeding_cage_id))
+        mouse_name_index.mark_changed([pup.pk for pup in pups])
+
+    return pups
+
+def set_zygosities(gene, mice, zygosities):
+    """Set the zygosity of gene for each of mice
+
+    gene : Gene that was tested
+    mice : list of Mouse
+    zygosities : list of zygosity, one for each of mice
+
+    The existing MouseGenes of these mice for this gene are fetched in a
+    single query. Those with a different zygosity are updated, and the
+    missing ones are created, in bulk in one transaction. If a mouse has
+    several MouseGenes for this gene, only the first is updated. The
+    affected cages are then refreshed once.
+
+    Returns: the number of MouseGenes created or updated
+    """
+    existing = {}
+    for mg in MouseGene.objects.filter(gene_name=gene, 
+        mouse_name__in=[mouse.pk for mouse in mice]):
+        existing.setdefault(mg.mouse_name_id, mg)
+
+    new_mgs = []
+    changed_mgs = []
+    for mouse, zygosity in zip(mice, zygosities):
+        mg = existing.get(mouse.pk)
+        if mg is None:
+            new_mgs.append(MouseGene(gene_name=gene, mouse_name_id=mouse.pk,
+                zygosity=zygosity))
+        elif mg.zygosity != zygosity:
+            mg.zygosity = zygosity
+            changed_mgs.append(mg)
+
+    if len(new_mgs) == 0 and len(changed_mgs) == 0:
+        return 0
+
+    with transaction.atomic():
+        MouseGene.objects.bulk_create(new_mgs, batch_size=500)
+        MouseGene.objects.bulk_update(changed_mgs, ['zygosity'],
+            batch_size=500)
+
+        changed_mouse_ids = [mg.mouse_name_id for mg in new_mgs + changed_mgs]
+        refresh_cages(cages_affected_by_mice(changed_mouse_ids,
+            [mouse.cage_id for mouse in mice 
+            if mouse.pk in changed_mouse_ids]))
+        mouse_name_index.mark_changed(changed_mouse_ids)
+
+    return len(new_mgs) + len(changed_mgs)
+
+def wean_litters(litters, user=None):
+    """Wean the pups of each of litters into new cages, in one transaction
+
+    litters : list of Litter, with their breeding_cage
+    user : the User to record as history_user, or None
+
+    The pups of each sex are moved to a new cage named after the 
+    breeding cage, with the suffix in WEAN_CAGE_SUFFIXES, in the same 
+    location and with the same proprietor. Then date_weaned is set to 
+    today.
+
+    The cages are created in bulk, the pups are moved with one update 
+    per new cage, the litters are updated at once, and all of their 
+    historical records are created in bulk. The affected cages are
+    refreshed once. Only the target_genotype slug of each litter is
+    still computed one litter at a time, as when saving.
+
+    Raises ValueError, before changing anything, if any of the new cage
+    names is already taken.
+
+    Returns: the list of new Cage
+    """
+    if len(litters) == 0:
+        return []
+
+    litter_ids = [litter.pk for litter in litters]
+    pups = list(Mouse.objects.filter(litter__in=litter_ids))
+    previous_cage_ids = [pup.cage_id for pup in pups]
+
+    # The new cages, and the pups for each
+    new_cages = []
+    cage_name2pups = {}
+    for litter in litters:
+        breeding_cage = litter.breeding_cage
+        for sex, suffix in WEAN_CAGE_SUFFIXES:
+            sex_pups = [pup for pup in pups 
+                if pup.litter_id == litter.pk and pup.sex == sex]
+            if len(sex_pups) == 0:
+                continue
+
+            cage_name = breeding_cage.name + suffix
+            new_cages.append(Cage(
+                name=cage_name,
+                location=breeding_cage.location,
+                proprietor_id=breeding_cage.proprietor_id,
+                notes='',
+            ))
+            cage_name2pups[cage_name] = sex_pups
+
+    taken = sorted(Cage.objects.filter(
+        name__in=list(cage_name2pups.keys())).values_list('name', flat=True))
+    if len(taken) > 0:
+        raise ValueError('cage names already taken: %s' % ', '.join(taken))
+
+    today = datetime.date.today()
+    with transaction.atomic():
+        new_cages = create_with_history(Cage, new_cages, user=user)
+
+        # Move the pups
+        moved_pups = []
+        for cage in new_cages:
+            sex_pups = cage_name2pups[cage.name]
+            Mouse.objects.filter(pk__in=[pup.pk for pup in sex_pups]
+                ).update(cage=cage)
+            for pup in sex_pups:
+                pup.cage = cage
+            moved_pups += sex_pups
+        create_historical_records(Mouse, moved_pups, '~', user=user)
+
+        # Mark the litters weaned
+        # Like saving, this also updates their target_genotype slug
+        slug_field = Litter._meta.get_field('target_genotype')
+        for litter in litters:
+            litter.date_weaned = today
+            slug_field.pre_save(litter, add=False)
+        Litter.objects.bulk_update(litters, 
+            ['date_weaned', 'target_genotype'], batch_size=500)
+        create_historical_records(Litter, litters, '~', user=user)
+        sync_tasks(litters)
+
+        refresh_cages(cages_affected_by_mice([pup.pk for pup in pups],
+            litter_ids + previous_cage_ids + [cage.pk for cage in new_cages]))
+        mouse_name_index.mark_changed([pup.pk for pup in pups])
+
+    return new_cages
+
+def sack_cages(cage_qs, user=None):
+    """Make the cages defunct and sack their mice, in one transaction
+
+    cage_qs : queryset of Cage
+    user : the User to record as history_user, or None
+
+    The cages that are not defunct yet are made defunct, and the mice 
+    in these cages that are not sacked yet are sacked today. Each is 
+    done with a single update, and their historical records are created
+    in bulk. The affected cages are refreshed once.
+
+    Returns: n_cages, n_mice
+        The number of cages made defunct and of mice sacked
+    """
+    today = datetime.date.today()
+    with transaction.atomic():
+        cage_ids = list(cage_qs.values_list('pk', flat=True))
+        cages = list(Cage.objects.filter(pk__in=cage_ids, defunct=False))
+        mice = list(Mouse.objects.filter(cage__in=cage_ids, 
+            sack_date__isnull=True))
+
+        Cage.objects.filter(pk__in=[cage.pk for cage in cages]).update(
+            defunct=True)
+        for cage in cages:
+            cage.defunct = True
+        create_historical_records(Cage, cages, '~', user=user)
+
+        Mouse.objects.filter(pk__in=[mouse.pk for mouse in mice]).update(
+            sack_date=today)
+        for mouse in mice:
+            mouse.sack_date = today
+        create_historical_records(Mouse, mice, '~', user=user)
+
+        refresh_cages(cages_affected_by_mice([mouse.pk for mouse in mice],
+            cage_ids))
+        mouse_name_index.mark_changed([mouse.pk for mouse in mice])
+
+    return len(cages), len(mice)
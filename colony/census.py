@@ -0,0 +1,507 @@
+"""Census engine: builds precomputed rows for the census views
+
+The census templates used to evaluate properties like Cage.type_of_cage
+and Mouse.can_be_breeding_mother on every row, which issued extra
+queries per cage even with heavy prefetching. Instead, build_census
+fetches everything it needs in a fixed number of flat values() queries
+(independent of the number of cages), and assembles CensusCage and
+CensusMouse objects that the templates can render without touching
+the database.
+
+The classification and formatting logic is shared with the model
+properties, via the helper functions in colony.models.
+
+Most cages do not change between views of the census, so the rendered
+rows are also cached, per cage, by get_census_rows. The cache key 
+includes Cage.census_modified, which the signals in colony.signals set 
+whenever anything shown in the row changes (see touch_cages).
+
+Rows also depend on today's date. Ages are not rendered into the cached
+rows: the rows contain a marker with the date to count from, which is
+replaced when the row is displayed (see fill_day_counts). Everything
+else that depends on the date, like the litter needs and the colors of
+breedable mice, only changes on certain dates. Each row records the 
+next of these dates (CensusCage.expires), and its cache entry expires
+then.
+"""
+from __future__ import unicode_literals
+
+from builtins import object
+import datetime
+import re
+
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from .models import (Cage, Mouse, Litter, MouseGene, SpecialRequest,
+    BREEDING_CAGE_TYPES, classify_cross, classify_stock, combine_genesets,
+    distinct_genesets, format_genesets, format_genotype, format_litter_info,
+    format_special_requests)
+
+# Human-readable choices, looked up once rather than per row
+SEX_DISPLAY = dict(Mouse._meta.get_field('sex').choices)
+LOCATION_DISPLAY = dict(Cage._meta.get_field('location').choices)
+
+# Mice older than this many days are breedable
+# See Mouse.is_breedable_female and is_breedable_male
+BREEDABLE_AGE = 40
+
+
+## Day counts
+# Marker for the number of days since a date, in the rendered rows
+DAY_COUNT_MARKER = '<!--days-since:%s%s-->'
+DAY_COUNT_RE = re.compile(
+    r'<!--days-since:(\d{4})-(\d{2})-(\d{2})(:hide-zero)?-->')
+
+def day_count_marker(date, hide_zero=False):
+    """Returns a marker for the number of days since date, or None
+
+    The marker is replaced with the number of days by fill_day_counts,
+    or with nothing if hide_zero and it is zero. Returns None if date is
+    None, like Mouse.age and Litter.age.
+    """
+    if date is None:
+        return None
+    return mark_safe(DAY_COUNT_MARKER % (date.isoformat(), 
+        ':hide-zero' if hide_zero else ''))
+
+def fill_day_counts(html, today):
+    """Replace the day count markers in html with the number of days"""
+    def days_since(match):
+        year, month, day, hide_zero = match.groups()
+        days = (today - datetime.date(int(year), int(month), int(day))).days
+        if days == 0 and hide_zero:
+            return ''
+        return str(days)
+    return DAY_COUNT_RE.sub(days_since, html)
+
+def next_change(dates, today):
+    """Returns the earliest of dates that is after today, or None"""
+    future_dates = [date for date in dates if date > today]
+    if len(future_dates) == 0:
+        return None
+    return min(future_dates)
+
+
+class CensusMouse(object):
+    """Precomputed census information about a single mouse
+
+    Attributes mirror the Mouse fields and properties used by the census
+    templates. gene_list is a list of (gene_name, gene_type, zygosity),
+    in the same order as Mouse.mousegene_set. age_display is the age
+    as a day count marker, for the rendered rows.
+    """
+    def __init__(self, values, today):
+        self.pk = values['id']
+        self.name = values['name']
+        self.sex = values['sex']
+        self.sex_display = SEX_DISPLAY.get(self.sex)
+        self.cage_id = values['cage_id']
+        self.user = values['user__name']
+        self.litter_pk = values['litter_id']
+        self.pure_breeder = values['pure_breeder']
+        self.wild_type = values['wild_type']
+        self.notes = values['notes']
+        self.gene_list = []
+
+        # Same precedence as Mouse.dob
+        if values['manual_dob'] is not None:
+            self.dob = values['manual_dob']
+        else:
+            self.dob = values['litter__dob']
+
+        if self.dob is None:
+            self.age = None
+        else:
+            self.age = (today - self.dob).days
+        self.age_display = day_count_marker(self.dob, hide_zero=True)
+
+        # Set by CensusCage, once all mice in the cage are known
+        self.color = 'black'
+
+    @property
+    def new_genotype(self):
+        return format_genotype(self.wild_type, [
+            (gene_name, zygosity)
+            for gene_name, gene_type, zygosity in self.gene_list])
+
+    @property
+    def genes(self):
+        """List of (gene_name, gene_type), as used for genesets"""
+        return [(gene_name, gene_type)
+            for gene_name, gene_type, zygosity in self.gene_list]
+
+    @property
+    def is_breedable_female(self):
+        """See Mouse.is_breedable_female"""
+        return self.sex_display == 'F' and (
+            self.age is None or self.age > BREEDABLE_AGE)
+
+    @property
+    def is_breedable_male(self):
+        """See Mouse.is_breedable_male"""
+        return self.sex_display == 'M' and (
+            self.age is None or self.age > BREEDABLE_AGE)
+
+    def __str__(self):
+        return str(self.name)
+
+
+class CensusCage(object):
+    """Precomputed census information about a single cage
+
+    Attributes mirror the Cage fields and properties used by the census
+    templates, including type_of_cage, relevant_genesets, and
+    auto_needs_message. mice is the list of CensusMouse in this cage,
+    sorted by name.
+
+    litter_values is the values() dict of this cage's litter, or None.
+    mother and father are CensusMouse, wherever the parents live.
+
+    expires is the first date after today on which this cage would be
+    displayed differently, apart from the day counts, or None if it
+    does not depend on the date.
+    """
+    def __init__(self, values, mice, litter_values, mother, father,
+        special_requests, today):
+        self.pk = values['id']
+        self.name = values['name']
+        self.rack_spot = values['rack_spot']
+        self.notes = values['notes']
+        self.proprietor = values['proprietor__name']
+        self.location_display = LOCATION_DISPLAY.get(values['location'])
+        self.change_link = reverse("admin:colony_cage_change", args=[self.pk])
+        self.mice = mice
+        self.n_mice = len(mice)
+
+        # Dates on which the display may change
+        change_dates = []
+
+        ## Litter information
+        if litter_values is None:
+            self.litter_pk = None
+            self.mother_present = False
+            litter_needs_message = ''
+        else:
+            self.litter_pk = litter_values['breeding_cage_id']
+
+            # See Cage.contains_mother_of_this_litter
+            self.mother_present = mother.cage_id == self.pk
+
+            # An unsaved Litter, just to run the needs_* methods
+            # These only depend on the dates
+            litter = Litter(
+                date_mated=litter_values['date_mated'],
+                dob=litter_values['dob'],
+                date_toeclipped=litter_values['date_toeclipped'],
+                date_weaned=litter_values['date_weaned'],
+            )
+            litter_needs_message = litter.auto_needs_message(today)
+            change_dates += litter.auto_needs_dates(today)
+
+            # See Litter.current_change_link
+            # The ages are day count markers
+            info = format_litter_info(litter_values['n_pups'],
+                day_count_marker(litter.dob), 
+                day_count_marker(litter.date_mated))
+            if litter.date_weaned is not None:
+                self.litter_status = 'weaned'
+            elif litter.dob is None:
+                self.litter_status = mark_safe(info)
+            elif litter_values['n_pups'] == 0:
+                self.litter_status = mark_safe('%s; add pups' % info)
+            else:
+                self.litter_status = mark_safe('%s; edit' % info)
+
+        ## Type of cage and relevant genesets
+        # See Cage.type_of_cage and Cage.relevant_genesets
+        if litter_values is not None and (
+            self.mother_present or self.n_mice == 0):
+            # It is a breeding cage
+            same_single_gene = (
+                not (mother.wild_type or father.wild_type) and
+                len(mother.gene_list) == 1 and
+                len(father.gene_list) == 1 and
+                mother.gene_list[0][0] == father.gene_list[0][0])
+            self.type_of_cage = classify_cross(mother, father,
+                same_single_gene)
+        else:
+            self.type_of_cage = classify_stock(
+                [mouse.pure_breeder for mouse in mice])
+
+        if self.type_of_cage == 'empty':
+            self.relevant_genesets = []
+        elif self.type_of_cage in BREEDING_CAGE_TYPES:
+            self.relevant_genesets = [
+                combine_genesets([father.genes, mother.genes])]
+        else:
+            self.relevant_genesets = distinct_genesets(
+                [mouse.genes for mouse in mice])
+        self.printable_relevant_genesets = format_genesets(
+            self.relevant_genesets)
+
+        ## Needs
+        # See Cage.auto_needs_message
+        srm = format_special_requests(special_requests)
+        if srm != '' and litter_needs_message != '':
+            self.auto_needs_message = srm + '<br />' + litter_needs_message
+        else:
+            self.auto_needs_message = srm + litter_needs_message
+
+        ## Colorize breeding mothers and fathers
+        # See Mouse.can_be_breeding_mother and can_be_breeding_father
+        has_breedable_male = any(mouse.is_breedable_male for mouse in mice)
+        has_breedable_female = any(
+            mouse.is_breedable_female for mouse in mice)
+        for mouse in mice:
+            if ((mouse.is_breedable_female and has_breedable_male) or
+                (mother is not None and mother.pk == mouse.pk)):
+                mouse.color = 'red'
+            elif mouse.is_breedable_male and has_breedable_female:
+                mouse.color = 'blue'
+
+        # The colors change when mice become breedable
+        change_dates += [
+            mouse.dob + datetime.timedelta(days=BREEDABLE_AGE + 1)
+            for mouse in mice if mouse.dob is not None]
+
+        self.expires = next_change(change_dates, today)
+
+    def __str__(self):
+        return self.name
+
+
+def build_census(cage_qs, today=None):
+    """Returns a list of CensusCage, one for each cage in cage_qs
+
+    cage_qs : queryset of Cage, in the order to display
+    today : date to use for ages and needs. Defaults to today.
+
+    This runs five queries regardless of the number of cages: one each
+    for the cages, litters, mice (including parents living elsewhere),
+    mousegenes, and special requests.
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    # Subqueries used to restrict all the other tables to these cages
+    cage_ids = cage_qs.values('id')
+    litter_qs = Litter.objects.filter(breeding_cage__in=cage_ids)
+    mouse_qs = Mouse.objects.filter(
+        Q(cage__in=cage_ids) |
+        Q(pk__in=litter_qs.values('mother')) |
+        Q(pk__in=litter_qs.values('father'))
+    )
+
+    ## Cages
+    cage_values_l = list(cage_qs.values('id', 'name', 'rack_spot', 'notes',
+        'location', 'proprietor__name'))
+
+    ## Litters, keyed by cage id
+    litter_values_d = {}
+    for litter_values in litter_qs.annotate(n_pups=Count('mouse')).values(
+        'breeding_cage_id', 'mother_id', 'father_id', 'date_mated', 'dob',
+        'date_toeclipped', 'date_weaned', 'n_pups'):
+        litter_values_d[litter_values['breeding_cage_id']] = litter_values
+
+    ## Mice, including parents that are no longer in these cages
+    # These are sorted by name because of Mouse.Meta.ordering
+    mouse_d = {}
+    cage2mice = {}
+    for mouse_values in mouse_qs.values('id', 'name', 'sex', 'cage_id',
+        'user__name', 'litter_id', 'pure_breeder', 'wild_type', 'notes',
+        'manual_dob', 'litter__dob'):
+        mouse = CensusMouse(mouse_values, today)
+        mouse_d[mouse.pk] = mouse
+        cage2mice.setdefault(mouse.cage_id, []).append(mouse)
+
+    ## MouseGenes
+    # These are sorted by gene type and name because of MouseGene.Meta
+    for mg_values in MouseGene.objects.filter(
+        mouse_name__in=mouse_qs.values('id')).values_list(
+        'mouse_name_id', 'gene_name__name', 'gene_name__gene_type',
+        'zygosity'):
+        mouse_d[mg_values[0]].gene_list.append(mg_values[1:])
+
+    ## Special requests, keyed by cage id
+    cage2requests = {}
+    for sr_values in SpecialRequest.objects.filter(
+        cage__in=cage_ids).order_by('id').values_list(
+        'cage_id', 'requestee__name', 'message', 'date_completed'):
+        cage2requests.setdefault(sr_values[0], []).append(sr_values[1:])
+
+    ## Assemble rows
+    res = []
+    for cage_values in cage_values_l:
+        cage_id = cage_values['id']
+        litter_values = litter_values_d.get(cage_id)
+        if litter_values is None:
+            mother, father = None, None
+        else:
+            mother = mouse_d[litter_values['mother_id']]
+            father = mouse_d[litter_values['father_id']]
+
+        res.append(CensusCage(cage_values,
+            mice=cage2mice.get(cage_id, []),
+            litter_values=litter_values,
+            mother=mother,
+            father=father,
+            special_requests=cage2requests.get(cage_id, []),
+            today=today,
+        ))
+
+    return res
+
+
+# The denormalized Cage fields maintained by update_classification
+CLASSIFICATION_FIELDS = (
+    'cage_type', 'geneset_key', 'mouse_count', 'mother_present')
+
+def update_classification(cage_qs):
+    """Recompute the stored classification fields of the cages in cage_qs
+
+    The values come from build_census, so they always agree with the
+    census. Only cages whose stored values changed are written. This
+    uses bulk_update, so it does not fire signals or create historical
+    records.
+
+    Returns: the number of cages that were updated
+    """
+    stored = dict([(row[0], row[1:]) for row in
+        cage_qs.values_list('id', *CLASSIFICATION_FIELDS)])
+
+    changed_cages = []
+    for census_cage in build_census(cage_qs):
+        # Sort the genesets so that cages with the same genesets in a
+        # different order have the same key
+        values = (
+            census_cage.type_of_cage,
+            format_genesets(sorted(census_cage.relevant_genesets))[:255],
+            census_cage.n_mice,
+            census_cage.mother_present,
+        )
+
+        if stored.get(census_cage.pk) != values:
+            changed_cages.append(Cage(pk=census_cage.pk,
+                **dict(zip(CLASSIFICATION_FIELDS, values))))
+
+    Cage.objects.bulk_update(changed_cages, CLASSIFICATION_FIELDS,
+        batch_size=500)
+
+    return len(changed_cages)
+
+
+## Cached rendering
+# Rows are keyed by census_modified, and expire when they depend on the
+# date. Otherwise, this only bounds how long the rows of unused cages 
+# are kept.
+CENSUS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+def touch_cages(cage_qs):
+    """Mark the census rows of the cages in cage_qs as changed
+
+    This sets census_modified with update(), so it does not fire signals
+    or create historical records. A timestamp is used, rather than a 
+    counter, so that saving a stale Cage instance cannot bring back the
+    key of an old row.
+    """
+    Cage.objects.filter(pk__in=cage_qs.values('pk')).update(
+        census_modified=timezone.now())
+
+def census_cache_key(cage_id, census_modified):
+    """Returns the cache key of the rendered census row of a cage"""
+    if census_modified is None:
+        token = 'never'
+    else:
+        token = census_modified.isoformat()
+    return 'census_row:%d:%s' % (cage_id, token)
+
+def census_cache_timeout(expires):
+    """Returns the number of seconds to cache a row until expires
+
+    The row expires at the local midnight starting expires, or after
+    CENSUS_CACHE_TIMEOUT if that is sooner or expires is None.
+    """
+    if expires is None:
+        return CENSUS_CACHE_TIMEOUT
+    delta = (datetime.datetime.combine(expires, datetime.time()) - 
+        datetime.datetime.now())
+    return max(1, min(CENSUS_CACHE_TIMEOUT, int(delta.total_seconds())))
+
+
+class CensusRow(object):
+    """The rendered census row of a single cage
+
+    pk : id of the cage
+    genesets : the relevant genesets of the cage, as computed by 
+        build_census when the row was rendered
+    html : the rendered colony/census_cage.html
+    """
+    def __init__(self, pk, genesets, html):
+        self.pk = pk
+        self.genesets = genesets
+        self.html = html
+
+
+def get_census_rows(cage_qs, today=None):
+    """Returns a list of CensusRow, one for each cage in cage_qs
+
+    cage_qs : queryset of Cage, in the order to display
+    today : date to use for ages and needs. Defaults to today.
+
+    The rendered rows are read from the cache. Only the cages that are
+    not cached, because they changed since they were last rendered or 
+    their row expired, are built with build_census and rendered. So when
+    nothing changed this runs a single query.
+
+    Each cache entry is (html, genesets, rendered_on, expires). It is 
+    only used for dates from rendered_on up to the day before expires,
+    even if the cache keeps it longer. The genesets are cached with the
+    html, so they are never parsed from the stored geneset_key, which 
+    may be out of date.
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    cage_values_l = list(cage_qs.values_list('id', 'census_modified'))
+    keys = dict([(cage_id, census_cache_key(cage_id, census_modified))
+        for cage_id, census_modified in cage_values_l])
+
+    # The cached html and genesets that are valid today
+    cached = {}
+    for key, (html, genesets, rendered_on, expires) in cache.get_many(
+        list(keys.values())).items():
+        if rendered_on <= today and (expires is None or today < expires):
+            cached[key] = (html, genesets)
+
+    ## Render the cages that are not cached
+    missing = [cage_id for cage_id, key in keys.items() if key not in cached]
+    if len(missing) > 0:
+        # Avoid a long IN clause if nothing is cached
+        if len(missing) < len(keys):
+            missing_qs = Cage.objects.filter(pk__in=missing)
+        else:
+            missing_qs = cage_qs
+
+        # Group the entries by when they expire, to store them together
+        entries_by_expires = {}
+        for census_cage in build_census(missing_qs, today):
+            key = keys[census_cage.pk]
+            cached[key] = (render_to_string(
+                'colony/census_cage.html', {'cage': census_cage}),
+                census_cage.relevant_genesets)
+            entries_by_expires.setdefault(census_cage.expires, {})[key] = (
+                cached[key] + (today, census_cage.expires))
+        for expires, entries in entries_by_expires.items():
+            cache.set_many(entries, census_cache_timeout(expires))
+
+    res = []
+    for cage_id, census_modified in cage_values_l:
+        html, genesets = cached[keys[cage_id]]
+        res.append(CensusRow(cage_id, genesets, 
+            mark_safe(fill_day_counts(html, today))))
+    return res
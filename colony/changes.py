@@ -0,0 +1,301 @@
+"""Diff engine for the simple_history records of Mouse and Cage
+
+Each historical record is compared with the previous version of the same
+object to find which fields changed. Looking up the previous version
+one record at a time, and then following every foreign key to display
+it, took several queries per record. Instead, get_predecessors finds the
+previous version of many records in a single query per model, using the
+LAG window function, and the foreign keys needed for display are 
+fetched with select_related (see DISPLAY_RELATED).
+
+The diffs are computed once, when each historical record is created,
+and stored in ChangeLog (see log_changes). Readers like the records
+feed get them from there with get_logged_changes. The history that
+predates ChangeLog is logged by the backfill_changelog command, and 
+until then it is diffed when it is read.
+"""
+from __future__ import unicode_literals
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import F, Min, Q, Window
+from django.db.models.functions import Lag
+
+from .models import ChangeLog, HistoricalCage, HistoricalMouse
+
+# These fields are never reported as changes
+EXCLUDE_FIELDS = ('history_date', 'history_id', 'history_user',
+    'history_type')
+
+# Related objects needed to display each historical model, including
+# the ones needed by their __str__ (Litter displays its breeding cage)
+DISPLAY_RELATED = {
+    HistoricalMouse: ['cage', 'user', 'manual_father', 'manual_mother',
+        'litter__breeding_cage', 'genotype', 'history_user'],
+    HistoricalCage: ['proprietor', 'history_user'],
+}
+
+# The name stored in ChangeLog.model for each historical model
+MODEL_NAMES = {
+    HistoricalMouse: 'Mouse',
+    HistoricalCage: 'Cage',
+}
+
+# (name, attname) of the fields to compare, for each historical model
+# For foreign keys, the attname is the id, which can be compared
+# without fetching the related object
+DIFF_FIELDS = dict([
+    (history_model, [(field.name, field.attname) 
+        for field in history_model._meta.get_fields()
+        if field.name not in EXCLUDE_FIELDS])
+    for history_model in DISPLAY_RELATED])
+
+
+def select_display_related(history_qs):
+    """Returns history_qs with the related objects needed for display"""
+    return history_qs.select_related(*DISPLAY_RELATED[history_qs.model])
+
+def get_predecessors(history_model, records):
+    """Find the previous version of each record
+
+    history_model : HistoricalMouse or HistoricalCage
+    records : list of records of history_model
+
+    The previous version of a record is the latest record of the same
+    object that comes before it, ordered by history_date and then
+    history_id. These are all found in a single query: LAG finds the
+    previous history_id of every version of these objects, and the
+    records with those history_ids are fetched (with the related objects
+    needed for display).
+
+    Returns: dict from history_id to the previous record, or None if
+        it was the first record of its object
+    """
+    if len(records) == 0:
+        return {}
+
+    # The previous history_id of every version of these objects, up to
+    # the latest of these records
+    # Window functions cannot be filtered in SQL, so this includes the
+    # predecessors of versions that are not in records
+    versions = history_model.objects.filter(
+        id__in=set([record.id for record in records]),
+        history_date__lte=max([record.history_date for record in records]),
+    )
+    prev_history_ids = versions.annotate(prev_history_id=Window(
+        Lag('history_id'),
+        partition_by=[F('id')],
+        order_by=[F('history_date').asc(), F('history_id').asc()],
+    )).values('prev_history_id')
+
+    # Group the candidates by object
+    candidates_by_id = {}
+    for candidate in select_display_related(
+        history_model.objects.filter(history_id__in=prev_history_ids)):
+        candidates_by_id.setdefault(candidate.id, []).append(candidate)
+
+    # The predecessor of each record is the latest candidate before it
+    res = {}
+    for record in records:
+        key = (record.history_date, record.history_id)
+        earlier = [candidate for candidate in
+            candidates_by_id.get(record.id, [])
+            if (candidate.history_date, candidate.history_id) < key]
+        if len(earlier) == 0:
+            res[record.history_id] = None
+        else:
+            res[record.history_id] = max(earlier, key=lambda candidate:
+                (candidate.history_date, candidate.history_id))
+    return res
+
+def get_value(record, fieldname):
+    """Returns the value of a field of record, for display
+
+    Foreign keys of historical records are not constrained, so the 
+    related object may no longer exist. In that case, this returns None.
+    """
+    try:
+        return getattr(record, fieldname)
+    except ObjectDoesNotExist:
+        return None
+
+def diff_records(old_record, new_record):
+    """Returns the fields that differ between two versions of an object
+
+    Returns: list of dicts, each with fields:
+        field : name of field that was changed
+        old: previous value
+        new: new value
+        type: 'addition', 'removal', or 'change'
+    """
+    changes = []
+    for fieldname, attname in DIFF_FIELDS[type(new_record)]:
+        # Compare the stored values
+        old_field_value = getattr(old_record, attname)
+        new_field_value = getattr(new_record, attname)
+
+        # Determine if this was added, deleted, changed, or nothing
+        if old_field_value is None and new_field_value is not None:
+            change_type = 'addition'
+        elif new_field_value is None and old_field_value is not None:
+            change_type = 'removal'
+        elif old_field_value != new_field_value:
+            change_type = 'change'
+        else:
+            # no change made to this field
+            continue
+
+        # Append change, with the values to display
+        changes.append({
+            'field': fieldname,
+            'old': get_value(old_record, fieldname),
+            'new': get_value(new_record, fieldname),
+            'type': change_type,
+        })
+
+    return changes
+
+def make_change_logs(old_record, new_record):
+    """Returns unsaved ChangeLog, one for each field that changed"""
+    res = []
+    for change in diff_records(old_record, new_record):
+        res.append(ChangeLog(
+            model=MODEL_NAMES[type(new_record)],
+            object_id=new_record.id,
+            history_id=new_record.history_id,
+            history_date=new_record.history_date,
+            field=change['field'],
+            old=None if change['old'] is None else str(change['old']),
+            new=None if change['new'] is None else str(change['new']),
+            change_type=change['type'],
+        ))
+    return res
+
+def log_changes(history_model, records):
+    """Store the changes made by each of records in ChangeLog
+
+    history_model : HistoricalMouse or HistoricalCage
+    records : list of records of history_model, that have not been 
+        logged yet
+
+    This runs one query to get the previous versions, and one to store
+    the changes.
+
+    Returns: the number of ChangeLog stored
+    """
+    predecessors = get_predecessors(history_model, records)
+
+    change_logs = []
+    for record in records:
+        old_record = predecessors[record.history_id]
+        if old_record is not None:
+            change_logs += make_change_logs(old_record, record)
+
+    ChangeLog.objects.bulk_create(change_logs, batch_size=500)
+    return len(change_logs)
+
+def backfill_changes(history_model, batch_size=500):
+    """Recompute the ChangeLog of every record of history_model
+
+    Existing ChangeLog for this model are replaced. The history is
+    processed in batches of batch_size records.
+
+    Returns: the number of ChangeLog stored
+    """
+    n_stored = 0
+    with transaction.atomic():
+        ChangeLog.objects.filter(model=MODEL_NAMES[history_model]).delete()
+
+        last_history_id = 0
+        while True:
+            records = list(select_display_related(
+                history_model.objects.filter(
+                history_id__gt=last_history_id).order_by(
+                'history_id'))[:batch_size])
+            if len(records) == 0:
+                break
+
+            n_stored += log_changes(history_model, records)
+            last_history_id = records[-1].history_id
+
+    return n_stored
+
+def get_unlogged_changes(history_model, records):
+    """Returns the changes of records that predate ChangeLog
+
+    This diffs the records like log_changes, but does not store them. 
+    The records are fetched again with the related objects needed for 
+    display, so this runs two queries.
+
+    Returns: dict like get_logged_changes
+    """
+    records = list(select_display_related(history_model.objects.filter(
+        history_id__in=[record.history_id for record in records])))
+    predecessors = get_predecessors(history_model, records)
+
+    res = {}
+    for record in records:
+        old_record = predecessors[record.history_id]
+        if old_record is None:
+            continue
+        changes = diff_records(old_record, record)
+        for change in changes:
+            for key in ('old', 'new'):
+                if change[key] is not None:
+                    change[key] = str(change[key])
+        if len(changes) > 0:
+            res[(history_model, record.history_id)] = changes
+    return res
+
+def get_logged_changes(records):
+    """Returns the stored changes of each of records
+
+    records : list of records of HistoricalMouse or HistoricalCage
+
+    This runs two queries. Records older than the first stored change of
+    their model, which may predate ChangeLog if backfill_changelog was 
+    not run, are diffed with get_unlogged_changes instead, which runs
+    two more queries per model.
+
+    Returns: dict from (history model, history_id) to a list of dicts,
+        in the format of diff_records, except that the values are 
+        strings. Records without changes are not included.
+    """
+    history_ids_by_model = {}
+    for record in records:
+        history_ids_by_model.setdefault(MODEL_NAMES[type(record)], 
+            []).append(record.history_id)
+    if len(history_ids_by_model) == 0:
+        return {}
+
+    # One query for all models
+    q = Q()
+    for model_name, history_ids in history_ids_by_model.items():
+        q |= Q(model=model_name, history_id__in=history_ids)
+
+    model_name2history_model = dict([(model_name, history_model) 
+        for history_model, model_name in MODEL_NAMES.items()])
+    res = {}
+    for change_log in ChangeLog.objects.filter(q).order_by('id'):
+        key = (model_name2history_model[change_log.model], 
+            change_log.history_id)
+        res.setdefault(key, []).append({
+            'field': change_log.field,
+            'old': change_log.old,
+            'new': change_log.new,
+            'type': change_log.change_type,
+        })
+
+    # Every record since the first stored change was logged as it was
+    # created, so only the older ones can be missing from the log
+    first_logged = dict(ChangeLog.objects.filter(
+        model__in=list(history_ids_by_model)).order_by().values_list(
+        'model').annotate(Min('history_id')))
+    for model_name in history_ids_by_model:
+        history_model = model_name2history_model[model_name]
+        unlogged = [record for record in records
+            if type(record) == history_model and 
+            record.history_id < first_logged.get(model_name, float('inf'))]
+        if len(unlogged) > 0:
+            res.update(get_unlogged_changes(history_model, unlogged))
+    return res
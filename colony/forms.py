@@ -1,4 +1,5 @@
 from builtins import zip
+import datetime
 from django import forms
 
 from .models import Mouse, Cage, Person, Gene, MouseGene
@@ -75,9 +76,27 @@ class SackForm(forms.Form):
    "Form for making cage defunct and sacking its mice" 
    pass 
 
+class SackCagesForm(forms.Form):
+    """Chooses several cages to make defunct, see sack_multiple"""
+    cages = forms.ModelMultipleChoiceField(
+        queryset=Cage.objects.filter(defunct=False),
+        widget=forms.MultipleHiddenInput,
+    )
+
 class WeanForm(forms.Form):
     pass
 
+class WeanLittersForm(forms.Form):
+    """Chooses which of several litters to wean, see wean_due"""
+    def __init__(self, *args, **kwargs):
+        litters = kwargs.pop('litters')
+        super(WeanLittersForm, self).__init__(*args, **kwargs)
+        
+        self.fields['litters'] = forms.ModelMultipleChoiceField(
+            queryset=litters,
+            widget=forms.CheckboxSelectMultiple,
+        )
+
 class AddGenotypingInfoForm(forms.Form):
     """Form for adding genotyping info
     
@@ -193,3 +212,131 @@ class CensusFilterForm(forms.Form):
         ],
         required=False,
     )
+
+class CountsByPersonForm(forms.Form):
+    """Chooses the date range, resolution, and locations of counts_by_person
+    
+    This is bound to the GET parameters start, end, freq, and locations.
+    Use get_params to get the values, with defaults filled in.
+    
+    The cages are counted on every day of the range, so the range is
+    limited to max_days days.
+    """
+    start = forms.DateField(label='From', required=False,
+        help_text='Defaults to 20 weeks before the end. '
+        'At most 400 days before the end.')
+    
+    end = forms.DateField(label='To', required=False,
+        help_text='Defaults to today.')
+    
+    freq = forms.ChoiceField(
+        label='Table resolution',
+        choices=[
+            ('W-WED', 'weekly'),
+            ('D', 'daily'),
+            ('MS', 'monthly'),
+        ],
+        required=False,
+    )
+    
+    locations = forms.MultipleChoiceField(
+        label='Locations',
+        choices=Cage._meta.get_field('location').choices,
+        required=False,
+        widget=forms.CheckboxSelectMultiple,
+    )
+    
+    # Used when a parameter is missing
+    default_weeks = 20
+    default_freq = 'W-WED'
+    default_locations = [0, 4] # 1710 and SC2-011
+    
+    # The longest range, in days
+    max_days = 400
+    
+    def clean(self):
+        cleaned_data = super(CountsByPersonForm, self).clean()
+        start = cleaned_data.get('start')
+        end = cleaned_data.get('end') or datetime.date.today()
+        if start is not None and start > end:
+            raise forms.ValidationError('The start must be before the end.')
+        if start is not None and (end - start).days + 1 > self.max_days:
+            raise forms.ValidationError(
+                'The range can be at most %d days.' % self.max_days)
+        return cleaned_data
+    
+    def get_params(self):
+        """Returns start, end, freq, locations
+        
+        Parameters that are missing, or all of them if the form is not
+        valid, are replaced with the defaults. locations is a sorted
+        list of int.
+        """
+        if self.is_bound and self.is_valid():
+            cleaned_data = self.cleaned_data
+        else:
+            cleaned_data = {}
+        
+        end = cleaned_data.get('end') or datetime.date.today()
+        start = cleaned_data.get('start') or (
+            end - datetime.timedelta(weeks=self.default_weeks))
+        freq = cleaned_data.get('freq') or self.default_freq
+        locations = sorted([int(location) for location in 
+            cleaned_data.get('locations') or self.default_locations])
+        
+        return start, end, freq, locations
+
+class TasksDueForm(forms.Form):
+    """Chooses the date and proprietor of tasks_due
+    
+    This is bound to the GET parameters date and proprietor. Use
+    get_params to get the values, with defaults filled in.
+    """
+    date = forms.DateField(label='Due on', required=False,
+        help_text='Defaults to today.')
+    
+    proprietor = forms.ModelChoiceField(
+        label='Cage proprietor',
+        queryset=Person.objects.filter(active=True).all(),
+        required=False,
+    )
+    
+    def get_params(self):
+        """Returns date, proprietor
+        
+        Parameters that are missing, or all of them if the form is not
+        valid, are replaced with the defaults: today, and None (all
+        proprietors).
+        """
+        if self.is_bound and self.is_valid():
+            cleaned_data = self.cleaned_data
+        else:
+            cleaned_data = {}
+        
+        date = cleaned_data.get('date') or datetime.date.today()
+        proprietor = cleaned_data.get('proprietor')
+        
+        return date, proprietor
+
+class GenotypingImportForm(forms.Form):
+    """Uploads or pastes genotyping results, see colony.genotyping"""
+    results_file = forms.FileField(label='CSV or TSV file', required=False,
+        help_text='One row per result: mouse name, gene name, zygosity.')
+    
+    results_text = forms.CharField(label='Or paste the results', 
+        required=False, widget=forms.Textarea(attrs={'rows': 12}))
+    
+    def clean(self):
+        cleaned_data = super(GenotypingImportForm, self).clean()
+        results_file = cleaned_data.get('results_file')
+        if results_file is not None:
+            try:
+                cleaned_data['text'] = results_file.read().decode(
+                    'utf-8-sig')
+            except UnicodeDecodeError:
+                raise forms.ValidationError('The file must be text.')
+        elif cleaned_data.get('results_text'):
+            cleaned_data['text'] = cleaned_data['results_text']
+        else:
+            raise forms.ValidationError('Upload or paste some results.')
+        return cleaned_data
@@ -0,0 +1,119 @@
+"""Import genotyping results for many mice at once, e.g. a PCR plate
+
+Results are read from CSV or TSV text, with one row per result: the
+mouse name, the gene name, and the zygosity, like
+    1234-5,Emx-Cre,+/-
+A header row whose third column is 'zygosity' is skipped. Every row is
+validated before anything is changed (see parse_results), and then they
+are all applied in a single transaction (see import_results).
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import csv
+
+from django.db import transaction
+
+from .bulk import set_zygosities
+from .models import Gene, Mouse, MouseGene
+
+
+def read_rows(text):
+    """Returns (line_number, cells) for each non-blank row of text
+
+    The delimiter is a tab if the first line contains one, and otherwise
+    a comma. Cells are stripped of surrounding whitespace.
+    """
+    lines = text.splitlines()
+    if len(lines) > 0 and '\t' in lines[0]:
+        delimiter = '\t'
+    else:
+        delimiter = ','
+
+    res = []
+    for line_number, cells in enumerate(
+        csv.reader(lines, delimiter=delimiter), 1):
+        cells = [cell.strip() for cell in cells]
+        if any(cells):
+            res.append((line_number, cells))
+    return res
+
+def parse_results(text):
+    """Parse and validate genotyping results
+
+    text : CSV or TSV text, see the module docstring
+
+    Each row must have three columns, an existing mouse and gene, and a
+    zygosity in MouseGene.zygosity_choices. A result can be repeated,
+    but not with a different zygosity. The mice and genes are fetched
+    with one query each, whatever the number of rows.
+
+    Returns: results, errors
+        results : list of (Mouse, Gene, zygosity), without repeats
+        errors : list of messages like 'line 3: unknown gene "Cre"'.
+            If there are any, the results should not be imported.
+    """
+    rows = read_rows(text)
+    if len(rows) > 0 and len(rows[0][1]) >= 3 and (
+        rows[0][1][2].lower() == 'zygosity'):
+        rows = rows[1:]
+
+    # Fetch all the mice and genes at once
+    mouse_d = Mouse.objects.in_bulk(
+        [cells[0] for line_number, cells in rows], field_name='name')
+    gene_d = Gene.objects.in_bulk(
+        [cells[1] for line_number, cells in rows if len(cells) > 1],
+        field_name='name')
+
+    results = OrderedDict()
+    errors = []
+    for line_number, cells in rows:
+        if len(cells) != 3:
+            errors.append('line %d: expected 3 columns, got %d' % (
+                line_number, len(cells)))
+            continue
+
+        mouse_name, gene_name, zygosity = cells
+        line_errors = []
+        if mouse_name not in mouse_d:
+            line_errors.append('unknown mouse "%s"' % mouse_name)
+        if gene_name not in gene_d:
+            line_errors.append('unknown gene "%s"' % gene_name)
+        if zygosity not in MouseGene.zygosity_choices:
+            line_errors.append('invalid zygosity "%s"' % zygosity)
+        if len(line_errors) == 0:
+            previous = results.get((mouse_name, gene_name))
+            if previous is not None and previous[2] != zygosity:
+                line_errors.append('conflicting result for %s %s' % (
+                    mouse_name, gene_name))
+
+        if len(line_errors) > 0:
+            errors += ['line %d: %s' % (line_number, error)
+                for error in line_errors]
+        else:
+            results[(mouse_name, gene_name)] = (
+                mouse_d[mouse_name], gene_d[gene_name], zygosity)
+
+    return list(results.values()), errors
+
+def import_results(results):
+    """Apply genotyping results from parse_results, in one transaction
+
+    The results for each gene are applied with set_zygosities, so they
+    are created or updated in bulk.
+
+    Returns: the number of MouseGenes created or updated
+    """
+    # Group the results by gene
+    gene2results = OrderedDict()
+    for mouse, gene, zygosity in results:
+        gene2results.setdefault(gene, []).append((mouse, zygosity))
+
+    n_changed = 0
+    with transaction.atomic():
+        for gene, gene_results in gene2results.items():
+            n_changed += set_zygosities(gene,
+                [mouse for mouse, zygosity in gene_results],
+                [zygosity for mouse, zygosity in gene_results])
+
+    return n_changed
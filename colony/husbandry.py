@@ -0,0 +1,129 @@
+"""Husbandry tasks: stores the needs of each litter in HusbandryTask
+
+The Litter.needs_* methods compute the trigger, target, and warn dates
+of each task from the dates of the litter. sync_tasks stores their 
+results, and is called whenever a litter is saved (see colony.signals),
+so that get_tasks_due can build a worklist across all litters with a 
+single indexed query.
+"""
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.db import transaction
+
+from .models import HusbandryTask, Litter
+
+# The Litter method that computes each kind of HusbandryTask
+TASK_METHODS = OrderedDict([
+    ('date_mated', 'needs_date_mated'),
+    ('pup_check', 'needs_pup_check'),
+    ('toe_clip', 'needs_toe_clip'),
+    ('genotype', 'needs_genotype'),
+    ('wean', 'needs_wean'),
+])
+
+# Fields set by sync_tasks
+TASK_FIELDS = ('trigger', 'target', 'warn', 'completed')
+
+
+def sync_tasks(litters):
+    """Store the HusbandryTask of each of litters
+
+    litters : list of Litter
+    
+    For each kind of task that a litter needs, the task is created or
+    its dates are updated. Tasks that are no longer needed are marked
+    completed. The dates of needs_date_mated are relative to today, so
+    a pending 'date_mated' task keeps the dates it was created with.
+    
+    This runs one query to get the existing tasks, and then creates 
+    and updates tasks in bulk, so it does not fire signals.
+    
+    Returns: the number of tasks created or updated
+    """
+    if len(litters) == 0:
+        return 0
+    
+    existing = {}
+    for task in HusbandryTask.objects.filter(
+        litter__in=[litter.pk for litter in litters]):
+        existing[(task.litter_id, task.kind)] = task
+    
+    new_tasks = []
+    changed_tasks = []
+    for litter in litters:
+        for kind, method_name in TASK_METHODS.items():
+            needs = getattr(litter, method_name)()
+            task = existing.get((litter.pk, kind))
+            
+            if needs is None:
+                # Not needed (anymore)
+                if task is not None and not task.completed:
+                    task.completed = True
+                    changed_tasks.append(task)
+                continue
+            
+            if kind == 'date_mated' and task is not None and (
+                not task.completed):
+                continue
+            
+            values = (needs['trigger'], needs['target'], needs['warn'], 
+                False)
+            if task is None:
+                new_tasks.append(HusbandryTask(litter_id=litter.pk, 
+                    kind=kind, **dict(zip(TASK_FIELDS, values))))
+            elif tuple([getattr(task, field) for field in TASK_FIELDS]
+                ) != values:
+                for field, value in zip(TASK_FIELDS, values):
+                    setattr(task, field, value)
+                changed_tasks.append(task)
+    
+    HusbandryTask.objects.bulk_create(new_tasks, batch_size=500)
+    HusbandryTask.objects.bulk_update(changed_tasks, TASK_FIELDS,
+        batch_size=500)
+    
+    return len(new_tasks) + len(changed_tasks)
+
+def sync_all_tasks(batch_size=500):
+    """Store the HusbandryTask of every litter, batch_size at a time
+
+    Returns: the number of tasks created or updated
+    """
+    n_synced = 0
+    with transaction.atomic():
+        last_pk = 0
+        while True:
+            litters = list(Litter.objects.filter(
+                pk__gt=last_pk).order_by('pk')[:batch_size])
+            if len(litters) == 0:
+                break
+            
+            n_synced += sync_tasks(litters)
+            last_pk = litters[-1].pk
+    
+    return n_synced
+
+def get_tasks_due(date, proprietor=None):
+    """Returns the pending tasks that are due on date
+    
+    date : datetime.date
+    proprietor : Person, or None for all. Only tasks for the litters in
+        this person's cages are returned.
+    
+    These are the tasks that are not completed and were triggered on or
+    before date, for litters in cages that are not defunct. They are 
+    ordered by target date.
+    
+    Returns: queryset of HusbandryTask, with the cage and its proprietor
+    """
+    qs = HusbandryTask.objects.filter(
+        completed=False,
+        trigger__lte=date,
+        litter__breeding_cage__defunct=False,
+    ).select_related('litter__breeding_cage__proprietor')
+    
+    if proprietor is not None:
+        qs = qs.filter(litter__breeding_cage__proprietor=proprietor)
+    
+    return qs
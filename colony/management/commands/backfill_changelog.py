@@ -0,0 +1,35 @@
+"""Rebuild the ChangeLog from the simple_history tables
+
+New historical records are logged as they are created (see 
+colony.signals). Run this once after migrating, to log the history that
+predates ChangeLog, or whenever the log is suspected to be incomplete:
+    python manage.py backfill_changelog
+
+Until then, the history that predates ChangeLog is diffed whenever it
+is displayed (see colony.changes.get_logged_changes), which is slower.
+"""
+from django.core.management.base import BaseCommand
+
+from colony.changes import MODEL_NAMES, backfill_changes
+
+
+class Command(BaseCommand):
+    help = 'Recompute the ChangeLog of every Mouse and Cage record'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=sorted(MODEL_NAMES.values()),
+            help='only rebuild the log of this model')
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='number of historical records to process at once')
+
+    def handle(self, *args, **options):
+        for history_model, model_name in sorted(MODEL_NAMES.items(),
+            key=lambda item: item[1]):
+            if options['model'] not in (None, model_name):
+                continue
+            
+            n_stored = backfill_changes(history_model, 
+                batch_size=options['batch_size'])
+            
+            self.stdout.write('%s: stored %d changes' % (
+                model_name, n_stored))
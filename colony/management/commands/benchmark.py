@@ -0,0 +1,46 @@
+"""Benchmark the census and other pages on a synthetic colony
+
+This creates a temporary test database (like the test runner does),
+fills it with a synthetic colony at each scale, and times the pages in
+colony.benchmark.BENCHMARK_URLS. The real database is not touched.
+    python manage.py benchmark --mice 1000 10000 --output before.json
+
+Run it on SQLite, or on a local Postgres by setting DATABASE_URL. The
+results are written as JSON, so that runs can be compared.
+"""
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from colony.benchmark import run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Time the census and other pages on a synthetic colony'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mice', type=int, nargs='+', default=[1000],
+            help='numbers of mice to benchmark (default: 1000)')
+        parser.add_argument('--seed', type=int, default=0,
+            help='seed for generating the colony')
+        parser.add_argument('--repeat', type=int, default=3,
+            help='number of warm requests of each page')
+        parser.add_argument('--output',
+            help='file to write the JSON results to (default: stdout)')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0,
+            autoclobber=True, serialize=False)
+        try:
+            res = run_benchmarks(options['mice'], seed=options['seed'],
+                repeat=options['repeat'], log=self.stderr.write)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        text = json.dumps(res, indent=1, sort_keys=True)
+        if options['output'] is None:
+            self.stdout.write(text)
+        else:
+            with open(options['output'], 'w') as fi:
+                fi.write(text + '\n')
@@ -0,0 +1,41 @@
+"""Import genotyping results from a CSV or TSV file
+
+The file has one row per result: mouse name, gene name, and zygosity
+(see colony.genotyping). Nothing is imported if any row is invalid:
+    python manage.py import_genotyping plate.csv
+
+Use --dry-run to only validate the file.
+"""
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from colony.genotyping import import_results, parse_results
+
+
+class Command(BaseCommand):
+    help = 'Import genotyping results (mouse, gene, zygosity) from a file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV or TSV file')
+        parser.add_argument('--dry-run', action='store_true',
+            help='only validate the file')
+
+    def handle(self, *args, **options):
+        try:
+            with io.open(options['path'], encoding='utf-8-sig') as fi:
+                text = fi.read()
+        except (IOError, UnicodeDecodeError) as e:
+            raise CommandError('cannot read %s: %s' % (options['path'], e))
+        
+        results, errors = parse_results(text)
+        if len(errors) > 0:
+            raise CommandError('\n'.join(['not imported:'] + errors))
+        
+        if options['dry_run']:
+            self.stdout.write('%d valid results' % len(results))
+            return
+        
+        n_changed = import_results(results)
+        self.stdout.write('imported %d results, %d created or updated' % (
+            len(results), n_changed))
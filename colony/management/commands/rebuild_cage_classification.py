@@ -0,0 +1,30 @@
+"""Rebuild the stored classification of every cage
+
+The fields Cage.cage_type, geneset_key, mouse_count, and mother_present
+are normally kept up to date by the signals in colony.signals. Run this
+after migrating, after bulk edits that bypass signals, or whenever the
+stored values are suspected to be stale:
+    python manage.py rebuild_cage_classification
+"""
+from django.core.management.base import BaseCommand
+
+from colony.census import update_classification
+from colony.models import Cage
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored classification fields of every cage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--active-only', action='store_true',
+            help='only rebuild cages that are not defunct')
+
+    def handle(self, *args, **options):
+        cage_qs = Cage.objects.all()
+        if options['active_only']:
+            cage_qs = cage_qs.filter(defunct=False)
+
+        n_updated = update_classification(cage_qs)
+        
+        self.stdout.write('updated %d of %d cages' % (
+            n_updated, cage_qs.count()))
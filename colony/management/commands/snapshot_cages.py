@@ -0,0 +1,74 @@
+"""Store the daily snapshots of cage occupancy
+
+By default, this snapshots every day after the most recent snapshot, up
+to and including today, so it can be run daily (e.g., from the Heroku
+scheduler) and only does new work:
+    python manage.py snapshot_cages
+
+The first time, or to recompute a range of dates, pass --start (and
+optionally --end). Existing snapshots in that range are replaced:
+    python manage.py snapshot_cages --start 2019-01-01
+
+A snapshot is the state at the start of its day, so dates after today
+are rejected: their snapshots would be stored before they happened, and
+then used in place of the actual counts.
+"""
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from colony.models import CageSnapshot
+from colony.occupancy import store_snapshots
+
+
+def parse_date(s):
+    try:
+        return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('invalid date: %s (expected YYYY-MM-DD)' % s)
+
+
+class Command(BaseCommand):
+    help = 'Snapshot the state of every cage at the start of each day'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', 
+            help='first date to snapshot (default: the day after the '
+            'latest snapshot, or today if there are none)')
+        parser.add_argument('--end', 
+            help='last date to snapshot, at most today (default: today)')
+        parser.add_argument('--include-defunct', action='store_true',
+            help='also snapshot defunct cages')
+
+    def handle(self, *args, **options):
+        today = datetime.date.today()
+        if options['end'] is None:
+            end = today
+        else:
+            end = parse_date(options['end'])
+            if end > today:
+                raise CommandError('cannot snapshot after today: %s' % 
+                    options['end'])
+        
+        if options['start'] is not None:
+            start = parse_date(options['start'])
+        else:
+            latest = CageSnapshot.objects.aggregate(
+                latest=Max('date'))['latest']
+            if latest is None:
+                start = end
+            else:
+                start = latest + datetime.timedelta(days=1)
+
+        dates = []
+        date = start
+        while date <= end:
+            dates.append(date)
+            date += datetime.timedelta(days=1)
+
+        n_stored = store_snapshots(dates, 
+            include_defunct=options['include_defunct'])
+
+        self.stdout.write('stored %d snapshots for %d days' % (
+            n_stored, len(dates)))
@@ -0,0 +1,22 @@
+"""Store the husbandry tasks of every litter
+
+Tasks are stored whenever a litter is saved (see colony.signals). Run 
+this once after migrating, to store the tasks of existing litters:
+    python manage.py sync_husbandry_tasks
+"""
+from django.core.management.base import BaseCommand
+
+from colony.husbandry import sync_all_tasks
+
+
+class Command(BaseCommand):
+    help = 'Store the HusbandryTask of every Litter'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='number of litters to process at once')
+
+    def handle(self, *args, **options):
+        n_synced = sync_all_tasks(batch_size=options['batch_size'])
+        
+        self.stdout.write('created or updated %d tasks' % n_synced)
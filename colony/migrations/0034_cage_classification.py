@@ -0,0 +1,110 @@
+# Generated by Django 3.0.7 on 2026-10-18 07:42
+
+import collections
+
+from django.db import migrations, models
+
+# Only the plain functions are used from colony.models, not the models
+from colony.models import (BREEDING_CAGE_TYPES, classify_cross, 
+    classify_stock, combine_genesets, distinct_genesets, format_genesets)
+
+MouseValues = collections.namedtuple('MouseValues', 
+    ['pk', 'cage_id', 'pure_breeder', 'wild_type'])
+
+def fill_classification(apps, schema_editor):
+    """Classify the existing cages, like census.update_classification
+    
+    This reads every mouse, litter and MouseGene once, with the 
+    historical models, and follows CensusCage.
+    """
+    Cage = apps.get_model('colony', 'Cage')
+    Litter = apps.get_model('colony', 'Litter')
+    Mouse = apps.get_model('colony', 'Mouse')
+    MouseGene = apps.get_model('colony', 'MouseGene')
+    
+    mouse_d = {}
+    cage2mice = {}
+    for values in Mouse.objects.order_by('name').values_list(
+        'id', 'cage_id', 'pure_breeder', 'wild_type'):
+        mouse = MouseValues(*values)
+        mouse_d[mouse.pk] = mouse
+        cage2mice.setdefault(mouse.cage_id, []).append(mouse)
+    
+    mouse2genes = {}
+    for mouse_id, gene_name, gene_type in MouseGene.objects.order_by(
+        'gene_name__gene_type', 'gene_name__name').values_list(
+        'mouse_name_id', 'gene_name__name', 'gene_name__gene_type'):
+        mouse2genes.setdefault(mouse_id, []).append((gene_name, gene_type))
+    
+    cage2parents = dict([(cage_id, (mouse_d[mother_id], mouse_d[father_id])) 
+        for cage_id, mother_id, father_id in Litter.objects.values_list(
+        'breeding_cage_id', 'mother_id', 'father_id')])
+    
+    cages = []
+    for cage in Cage.objects.all():
+        mice = cage2mice.get(cage.pk, [])
+        parents = cage2parents.get(cage.pk)
+        mother_present = (
+            parents is not None and parents[0].cage_id == cage.pk)
+        
+        if parents is not None and (mother_present or len(mice) == 0):
+            # A breeding cage
+            mother, father = parents
+            mother_genes = mouse2genes.get(mother.pk, [])
+            father_genes = mouse2genes.get(father.pk, [])
+            same_single_gene = (
+                not (mother.wild_type or father.wild_type) and
+                len(mother_genes) == 1 and len(father_genes) == 1 and
+                mother_genes[0][0] == father_genes[0][0])
+            cage_type = classify_cross(mother, father, same_single_gene)
+        else:
+            cage_type = classify_stock([mouse.pure_breeder for mouse in mice])
+        
+        if cage_type == 'empty':
+            genesets = []
+        elif cage_type in BREEDING_CAGE_TYPES:
+            genesets = [combine_genesets([father_genes, mother_genes])]
+        else:
+            genesets = distinct_genesets(
+                [mouse2genes.get(mouse.pk, []) for mouse in mice])
+        
+        cage.cage_type = cage_type
+        cage.geneset_key = format_genesets(sorted(genesets))[:255]
+        cage.mouse_count = len(mice)
+        cage.mother_present = mother_present
+        cages.append(cage)
+    
+    Cage.objects.bulk_update(cages, ['cage_type', 'geneset_key', 
+        'mouse_count', 'mother_present'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0033_auto_20191227_1349'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cage',
+            name='cage_type',
+            field=models.CharField(db_index=True, default='empty', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='cage',
+            name='geneset_key',
+            field=models.CharField(db_index=True, default='empty', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='cage',
+            name='mother_present',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cage',
+            name='mouse_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_classification, 
+            migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.0.7 on 2026-10-18 07:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0034_cage_classification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CageSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('location', models.IntegerField(choices=[(0, '1710'), (1, '1702'), (2, 'Behavior'), (3, '1736'), (4, 'SC2-011'), (5, 'L7-057'), (6, 'SC2-056'), (7, 'SC2-044'), (8, 'L5-036')])),
+                ('defunct', models.BooleanField(default=False)),
+                ('n_mice', models.IntegerField(default=0)),
+                ('cage', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='snapshots', to='colony.Cage')),
+                ('proprietor', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='colony.Person')),
+            ],
+            options={
+                'ordering': ['date', 'cage_id'],
+                'unique_together': {('date', 'cage')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+# The records feed orders the history tables by (history_date, history_id)
+# and takes only the most recent records. simple_history does not index
+# history_date, so add the indexes directly. This SQL is the same on 
+# SQLite and PostgreSQL.
+HISTORY_TABLES = ['colony_historicalmouse', 'colony_historicalcage']
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0035_cagesnapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql='CREATE INDEX %s_date_id_idx ON %s (history_date, history_id)' % (
+                table, table),
+            reverse_sql='DROP INDEX %s_date_id_idx' % table,
+        )
+        for table in HISTORY_TABLES
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.0.7 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0036_history_date_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.IntegerField()),
+                ('history_id', models.IntegerField()),
+                ('history_date', models.DateTimeField()),
+                ('field', models.CharField(max_length=50)),
+                ('old', models.TextField(blank=True, null=True)),
+                ('new', models.TextField(blank=True, null=True)),
+                ('change_type', models.CharField(choices=[('addition', 'addition'), ('removal', 'removal'), ('change', 'change')], max_length=10)),
+            ],
+            options={
+                'ordering': ['model', 'history_date', 'history_id', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['model', 'history_date'], name='colony_chan_model_caed69_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['model', 'history_id'], name='colony_chan_model_1bc5b6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['model', 'object_id'], name='colony_chan_model_aa501b_idx'),
+        ),
+    ]
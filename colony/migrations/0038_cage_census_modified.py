@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0037_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cage',
+            name='census_modified',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
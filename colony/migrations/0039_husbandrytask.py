@@ -0,0 +1,41 @@
+# Generated by Django 3.0.7 on 2026-10-18 08:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0038_cage_census_modified'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HusbandryTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('date_mated', 'specify date mated'), ('pup_check', 'pup check'), ('toe_clip', 'toe clip'), ('genotype', 'genotype'), ('wean', 'wean')], max_length=20)),
+                ('trigger', models.DateField()),
+                ('target', models.DateField()),
+                ('warn', models.DateField()),
+                ('completed', models.BooleanField(default=False)),
+                ('litter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='colony.Litter')),
+            ],
+            options={
+                'ordering': ['target', 'litter_id', 'kind'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='husbandrytask',
+            index=models.Index(fields=['completed', 'trigger'], name='colony_husb_complet_e2b0f6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='husbandrytask',
+            index=models.Index(fields=['completed', 'warn'], name='colony_husb_complet_731473_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='husbandrytask',
+            unique_together={('litter', 'kind')},
+        ),
+    ]
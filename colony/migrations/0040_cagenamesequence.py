@@ -0,0 +1,50 @@
+# Generated by Django 3.0.7 on 2026-10-18 08:24
+
+from django.db import migrations, models
+
+
+def seed_sequences(apps, schema_editor):
+    """Start a sequence for each Person's series after its last cage"""
+    Cage = apps.get_model('colony', 'Cage')
+    Person = apps.get_model('colony', 'Person')
+    CageNameSequence = apps.get_model('colony', 'CageNameSequence')
+    
+    # Highest cage number in each series, reading all the names once
+    series2last = {}
+    for cage_name in Cage.objects.values_list('name', flat=True):
+        try:
+            cage_num = int(cage_name)
+        except (TypeError, ValueError):
+            continue
+        series_number = cage_num // 1000
+        series2last[series_number] = max(
+            cage_num, series2last.get(series_number, cage_num))
+    
+    series_numbers = sorted(set(
+        Person.objects.values_list('series_number', flat=True)))
+    CageNameSequence.objects.bulk_create([
+        CageNameSequence(series_number=series_number,
+            last_number=series2last.get(series_number, series_number * 1000))
+        for series_number in series_numbers
+    ])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0039_husbandrytask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CageNameSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series_number', models.IntegerField(unique=True)),
+                ('last_number', models.IntegerField()),
+            ],
+            options={
+                'ordering': ['series_number'],
+            },
+        ),
+        migrations.RunPython(seed_sequences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.0.7 on 2026-10-18 08:41
+
+from django.db import migrations
+
+
+# Indexes for the case-insensitive mouse name searches in the mouse
+# autocompletes. The plain unique index on name can't serve these, and
+# the indexes they need can't be declared on the model in this version of
+# Django, so they are created here for each database vendor.
+#
+# On PostgreSQL, istartswith and icontains compare UPPER(name) using
+# LIKE, which is served by a text_pattern_ops index for prefixes and a
+# trigram index for infixes. On SQLite, LIKE is case-insensitive and is
+# served by an index with NOCASE collation.
+INDEXES = {
+    'postgresql': [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX colony_mouse_name_upper_idx ON colony_mouse '
+        '(UPPER(name::text) text_pattern_ops)',
+        'CREATE INDEX colony_mouse_unsacked_name_idx ON colony_mouse '
+        '(sex, UPPER(name::text) text_pattern_ops) '
+        'WHERE sack_date IS NULL',
+        'CREATE INDEX colony_mouse_name_trgm_idx ON colony_mouse '
+        'USING gin (UPPER(name::text) gin_trgm_ops)',
+    ],
+    'sqlite': [
+        'CREATE INDEX colony_mouse_name_nocase_idx ON colony_mouse '
+        '(name COLLATE NOCASE)',
+        'CREATE INDEX colony_mouse_unsacked_name_idx ON colony_mouse '
+        '(sex, name COLLATE NOCASE) WHERE sack_date IS NULL',
+    ],
+}
+
+def create_indexes(apps, schema_editor):
+    for sql in INDEXES.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+def drop_indexes(apps, schema_editor):
+    for sql in INDEXES.get(schema_editor.connection.vendor, []):
+        if sql.startswith('CREATE INDEX'):
+            schema_editor.execute(
+                'DROP INDEX IF EXISTS %s' % sql.split()[2])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0040_cagenamesequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-18 09:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0041_mouse_name_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cage',
+            name='geneset_key',
+            field=models.CharField(db_index=True, default='empty', editable=False, help_text='The printable relevant genesets, possibly truncated. Only used to order the census by genotype.', max_length=255),
+        ),
+    ]
@@ -15,7 +15,7 @@ from builtins import str
 from builtins import zip
 from past.utils import old_div
 from builtins import object
-from django.db import models
+from django.db import models, transaction
 import datetime
 from django.urls import reverse
 from django.urls.exceptions import NoReverseMatch
@@ -53,18 +53,24 @@ def strip_alpha(cage_name):
     else:
         return int(res)
 
-def generate_cage_name(series_number):
-    """Returns the next cage name for this user.
+def find_last_cage_number(series_number):
+    """Returns the highest existing cage number in this series.
     
-    series_number : series number to generate the cage number
+    series_number : series number, e.g. 9 for cages 9001 to 9999
     
-    Finds all existing cage names and chooses one number higher.
-    Returns: the new cage name as a string
+    Only cage names that are integers count. This reads all the cage names
+    in the series, so generate_cage_name only calls it once per series, to
+    start its CageNameSequence.
+    
+    Returns: the highest cage number as an int, or series_number * 1000 if
+        there are none yet
     """
     # Find all cage numbers in this series
-    all_cage_names = Cage.objects.all().values_list('name', flat=True)
+    # Every cage number in the series starts with the series number
+    cage_names = Cage.objects.filter(
+        name__startswith=str(series_number)).values_list('name', flat=True)
     my_cage_numbers = []
-    for cage_name in all_cage_names:
+    for cage_name in cage_names:
         try:
             cage_num = int(cage_name)
         except (TypeError, ValueError):
@@ -78,19 +84,50 @@ def generate_cage_name(series_number):
     #~ cage_numbers = map(strip_alpha, cage_names)
     #~ cage_numbers = filter(lambda num: num is not None, cage_numbers)
     
-    # Generate a new cage number that is 1 higher
     if len(my_cage_numbers) == 0:
-        target_cage = series_number * 1000 + 1
+        return series_number * 1000
     else:
-        target_cage = max(my_cage_numbers) + 1
-    #~ target_cage_name = '%04d' % target_cage
-    target_cage_name = str(target_cage)
+        return max(my_cage_numbers)
+
+def generate_cage_name(series_number):
+    """Returns the next cage name for this user.
+    
+    series_number : series number to generate the cage number
     
-    # Error check
-    if not target_cage_name.startswith(str(series_number)):
-        raise ValueError("cannot generate new cage name, series full?")
-    if Cage.objects.filter(name=target_cage_name).count() > 0:
-        raise ValueError("cannot generate new unique cage name")
+    The last number used in each series is stored in CageNameSequence.
+    It is locked with select_for_update while it is incremented, so this
+    takes constant time and two concurrent requests never get the same
+    name. Numbers that were already taken by a cage named by hand are
+    skipped.
+    
+    Returns: the new cage name as a string
+    """
+    with transaction.atomic():
+        sequence_qs = CageNameSequence.objects.select_for_update().filter(
+            series_number=series_number)
+        sequence = sequence_qs.first()
+        if sequence is None:
+            # Start the sequence after the highest existing cage number
+            CageNameSequence.objects.get_or_create(
+                series_number=series_number,
+                defaults={
+                    'last_number': find_last_cage_number(series_number)},
+            )
+            sequence = sequence_qs.get()
+        
+        # Generate a new cage number that is 1 higher
+        target_cage = sequence.last_number + 1
+        while Cage.objects.filter(name=str(target_cage)).exists():
+            target_cage += 1
+        #~ target_cage_name = '%04d' % target_cage
+        target_cage_name = str(target_cage)
+        
+        # Error check
+        if target_cage // 1000 != series_number:
+            raise ValueError("cannot generate new cage name, series full?")
+        
+        sequence.last_number = target_cage
+        sequence.save(update_fields=['last_number'])
     
     return target_cage_name
 
@@ -205,6 +242,172 @@ def have_same_single_gene(mouse1, mouse2):
     else:
         return False
 
+def sort_gene_names(gene_name_res, gene_type_res):
+    """Returns a tuple of gene names, sorted by their gene types.
+    
+    gene_name_res, gene_type_res : parallel lists of gene names and types
+    """
+    return tuple([gene_name for gene_type, gene_name in 
+        sorted(zip(gene_type_res, gene_name_res))])
+
+def combine_genesets(gene_lists):
+    """Combine the genes of several mice into a single sorted geneset
+    
+    gene_lists : list, one per mouse, of lists of (gene_name, gene_type)
+    
+    This is used for breeding cages, where the relevant geneset is the
+    union of the genes of both parents.
+    Returns: tuple of distinct gene names, sorted by gene type
+    """
+    gene_name_res = []
+    gene_type_res = []
+    for gene_list in gene_lists:
+        for gene_name, gene_type in gene_list:
+            if gene_name not in gene_name_res:
+                gene_name_res.append(gene_name)
+                gene_type_res.append(gene_type)
+    
+    return sort_gene_names(gene_name_res, gene_type_res)
+
+def distinct_genesets(gene_lists):
+    """Returns the distinct genesets of several mice
+    
+    gene_lists : list, one per mouse, of lists of (gene_name, gene_type)
+    
+    This is used for non-breeding cages, where each mouse contributes
+    its own geneset.
+    Returns: list of distinct tuples of gene names, each sorted by gene
+        type, in order of first appearance
+    """
+    res = []
+    for gene_list in gene_lists:
+        sorted_gene_names = sort_gene_names(
+            [gene_name for gene_name, gene_type in gene_list],
+            [gene_type for gene_name, gene_type in gene_list])
+        
+        # Append if distinct
+        if sorted_gene_names not in res:
+            res.append(sorted_gene_names)
+    return res
+
+def format_genesets(genesets):
+    """Convert a list of genesets to a printable string
+    
+    Each geneset is joined with ' x ', or 'WT' if it has no genes. The
+    genesets are then joined with '; '. An empty list returns 'empty'.
+    """
+    if len(genesets) == 0:
+        # This shouldn't really happen, unless it's empty?
+        return 'empty'
+    
+    res_l = []
+    for geneset in genesets:
+        if len(geneset) == 0:
+            joined_geneset = 'WT'
+        else:
+            joined_geneset = ' x '.join(geneset)
+        res_l.append(joined_geneset)
+    return '; '.join(res_l)
+
+# The types of cage that count as breeding cages
+BREEDING_CAGE_TYPES = ('outcross', 'incross', 'cross', 
+    'impure outcross', 'impure incross', 'impure cross',)
+
+def classify_cross(mother, father, same_single_gene):
+    """Returns the type of a breeding cage as a string
+    
+    mother, father : the parents. Only the attributes wild_type and
+        pure_breeder are used.
+    same_single_gene : whether have_same_single_gene(mother, father)
+    
+    See Cage.type_of_cage for the meaning of the results.
+    """
+    # wild_type implies pure_breeder
+    mother_pure = mother.wild_type or mother.pure_breeder
+    father_pure = father.wild_type or father.pure_breeder
+    
+    # determine the type of cross
+    if mother.wild_type or father.wild_type:
+        res = 'outcross'
+    elif same_single_gene:
+        res = 'incross'
+    else:
+        res = 'cross'
+    
+    if not (mother_pure and father_pure):
+        res = 'impure ' + res
+    
+    return res
+
+def classify_stock(mice_pure_breeder):
+    """Returns the type of a non-breeding cage as a string
+    
+    mice_pure_breeder : list of the pure_breeder flag of each mouse in
+        the cage
+    
+    See Cage.type_of_cage for the meaning of the results.
+    """
+    if len(mice_pure_breeder) == 0:
+        return 'empty'
+    elif False not in mice_pure_breeder:
+        return 'pure stock'
+    else:
+        return 'progeny'
+
+def format_special_requests(special_requests):
+    """Returns an HTML string describing special requests
+    
+    special_requests : list of (requestee, message, date_completed)
+    
+    Completed requests are struck through, the others are in bold.
+    """
+    res_l = []
+    for requestee, message, date_completed in special_requests:
+        if date_completed is None:
+            res_l.append("<b>@%s: %s</b>" % (
+                requestee, escape(message)))
+        else:
+            res_l.append("<strike>@%s: %s</strike>" % (
+                requestee, escape(message)))
+    return '<br>'.join(res_l)
+
+def format_genotype(wild_type, mousegenes):
+    """Returns a genotype string. See Mouse.new_genotype.
+    
+    wild_type : whether the mouse is wild type
+    mousegenes : list of (gene_name, zygosity), in display order
+    """
+    # If it's wild type, it shouldn't have any genes
+    if len(mousegenes) == 0 and wild_type:
+        return 'pure WT'
+    
+    # Get all MouseGenes other than -/-
+    res_l = []
+    for gene_name, zygosity in mousegenes:
+        if zygosity == MouseGene.zygosity_nn:
+            continue
+        res_l.append('%s(%s)' % (gene_name, zygosity))
+    
+    if len(res_l) == 0:
+        # It has no mousegenes, or only -/- mouse genes
+        # Render as 'negative'. Avoid confusion with 'WT'
+        # Also don't include the 'pure' because 'pure negative'
+        # is confusing.            
+        return 'negative'
+    else:
+        # Join remaining mousegenes
+        return '; '.join(res_l)
+
+def format_litter_info(n_pups, pup_age, pup_embryonic_age):
+    """Returns a string like 10@P19. See Litter.info."""
+    if pup_age is None:
+        if pup_embryonic_age is None:
+            return '%d pups' % (n_pups)
+        else:
+            return 'E%s' % (pup_embryonic_age)
+    else:
+        return '%d@P%s' % (n_pups, pup_age)
+
 
 class Cage(models.Model):
     """Model for a cage.
@@ -236,8 +439,36 @@ class Cage(models.Model):
         on_delete=models.PROTECT,
     )
     
+    ## Denormalized classification, so it can be filtered and sorted in SQL
+    # These are recomputed by signals (see colony.signals) whenever a
+    # Mouse, MouseGene, Litter, or Cage changes, and can be rebuilt with
+    # the rebuild_cage_classification management command.
+    # type_of_cage
+    cage_type = models.CharField(max_length=20, default='empty', 
+        editable=False, db_index=True)
+    
+    # printable relevant genesets, sorted so that identical cages match
+    geneset_key = models.CharField(max_length=255, default='empty',
+        editable=False, db_index=True,
+        help_text='The printable relevant genesets, possibly truncated. '
+        'Only used to order the census by genotype.')
+    
+    # number of mice in the cage
+    mouse_count = models.IntegerField(default=0, editable=False)
+    
+    # contains_mother_of_this_litter
+    mother_present = models.BooleanField(default=False, editable=False)
+    
+    # When anything shown in this cage's census row last changed
+    # This is part of the cache key of the rendered row, and is also set
+    # by the signals in colony.signals
+    census_modified = models.DateTimeField(null=True, editable=False)
+    
     # track history with simple_history
-    history = HistoricalRecords()
+    # The denormalized fields are not worth tracking
+    history = HistoricalRecords(excluded_fields=[
+        'cage_type', 'geneset_key', 'mouse_count', 'mother_present',
+        'census_modified'])
     
     # whether to move to new building (temporary field)
     transfer_JLG = models.NullBooleanField(default=None)
@@ -276,53 +507,27 @@ class Cage(models.Model):
         
         if cage_type == 'empty':
             res = []
-        elif cage_type in ['outcross', 'incross', 'cross', 
-            'impure outcross', 'impure incross', 'impure cross', ]:
+        elif cage_type in BREEDING_CAGE_TYPES:
             ## Combine mousegenes from all parents
             # The result will be a list with one element
             # That element will be a tuple of all the distinct gene names
             # in the parents.
-            father = self.litter.father
-            mother = self.litter.mother
-            
-            # Extract the gene names and types from each parent
             # This syntax was chosen to be SQL efficient with prefetching
-            gene_name_res = []
-            gene_type_res = []
-            for parent in [father, mother]:
-                for mg in parent.mousegene_set.all():
-                    if mg.gene_name.name not in gene_name_res:
-                        gene_name_res.append(mg.gene_name.name)
-                        gene_type_res.append(mg.gene_name.gene_type)
-            
-            # Sort the gene names by the gene types
-            sorted_gene_names = [gene_name for gene_type, gene_name in 
-                sorted(zip(gene_type_res, gene_name_res))]
-            
-            res = [tuple(sorted_gene_names)]
+            res = [combine_genesets([
+                [(mg.gene_name.name, mg.gene_name.gene_type) 
+                for mg in parent.mousegene_set.all()]
+                for parent in [self.litter.father, self.litter.mother]
+            ])]
         elif cage_type in ['pure stock', 'progeny',]:
             ## List of mousegene sets from each mouse
             # The result will be a list of distinct tuples of gene names
             # in each mouse in the cage.
-            res = []
-            for mouse in self.mouse_set.all():
-                # Extract the gene names and types from this pup                
-                gene_name_res = []
-                gene_type_res = []  
-        
-                # This syntax was chosen to be SQL efficient with prefetching
-                for mg in mouse.mousegene_set.all():
-                    gene_name_res.append(mg.gene_name.name)
-                    gene_type_res.append(mg.gene_name.gene_type)
-                
-                # Sort the gene names by the gene types
-                sorted_gene_names = tuple([
-                    gene_name for gene_type, gene_name in 
-                    sorted(zip(gene_type_res, gene_name_res))])
-                
-                # Append if distinct
-                if sorted_gene_names not in res:
-                    res.append(sorted_gene_names)
+            # This syntax was chosen to be SQL efficient with prefetching
+            res = distinct_genesets([
+                [(mg.gene_name.name, mg.gene_name.gene_type) 
+                for mg in mouse.mousegene_set.all()]
+                for mouse in self.mouse_set.all()
+            ])
         else:
             # This is an error
             res = []
@@ -332,18 +537,7 @@ class Cage(models.Model):
     @property
     def printable_relevant_genesets(self):
         """Convert relevant genesets to a string"""
-        if len(self.relevant_genesets) == 0:
-            # This shouldn't really happen, unless it's empty?
-            return 'empty'
-        else:
-            res_l = []
-            for geneset in self.relevant_genesets:
-                if len(geneset) == 0:
-                    joined_geneset = 'WT'
-                else:
-                    joined_geneset = ' x '.join(geneset)
-                res_l.append(joined_geneset)
-            return '; '.join(res_l)
+        return format_genesets(self.relevant_genesets)
     
     @property
     def type_of_cage(self):
@@ -384,35 +578,16 @@ class Cage(models.Model):
             mother = self.litter.mother
             father = self.litter.father
             
-            # wild_type implies pure_breeder
-            mother_pure = mother.wild_type or mother.pure_breeder
-            father_pure = father.wild_type or father.pure_breeder
+            # Only check for an incross if neither parent is wild type
+            same_single_gene = (
+                not (mother.wild_type or father.wild_type) and
+                have_same_single_gene(mother, father))
             
-            # determine the type of cross
-            if mother.wild_type or father.wild_type:
-                if mother_pure and father_pure:
-                    res = 'outcross'
-                else:
-                    res = 'impure outcross'
-            elif have_same_single_gene(mother, father):
-                if mother_pure and father_pure:
-                    res = 'incross'
-                else:
-                    res = 'impure incross'
-            else:
-                if mother_pure and father_pure:
-                    res = 'cross'
-                else:
-                    res = 'impure cross'        
+            res = classify_cross(mother, father, same_single_gene)
         else:
             # no breeding
-            if qs.count() == 0:
-                res = 'empty'
-            elif False not in [mouse.pure_breeder for mouse in qs.all()]:
-                # The syntax of this conditional was chosen to be efficient
-                res = 'pure stock'                   
-            else:
-                res = 'progeny'
+            # The syntax of this list was chosen to be efficient
+            res = classify_stock([mouse.pure_breeder for mouse in qs.all()])
         
         return res
     
@@ -453,15 +628,9 @@ class Cage(models.Model):
         return s[split_idx:]
 
     def get_special_request_message(self):
-        res_l = []
-        for sr in self.specialrequest_set.all():
-            if sr.date_completed is None:
-                res_l.append("<b>@%s: %s</b>" % (
-                    sr.requestee, escape(sr.message)))
-            else:
-                res_l.append("<strike>@%s: %s</strike>" % (
-                    sr.requestee, escape(sr.message)))
-        return '<br>'.join(res_l)
+        return format_special_requests([
+            (sr.requestee, sr.message, sr.date_completed)
+            for sr in self.specialrequest_set.all()])
 
     def n_mice(self):
         return len(self.mouse_set.all())
@@ -695,26 +864,8 @@ class Mouse(models.Model):
                 "GENE1(ZYGOSITY1); GENE2(ZYGOSITY2)..."
             Genes with zygosity -/- are not included in this string.
         """
-        # If it's wild type, it shouldn't have any genes
-        if not self.mousegene_set.exists() and self.wild_type:
-            return 'pure WT'
-        
-        # Get all MouseGenes other than -/-
-        res_l = []
-        for mg in self.mousegene_set.all():
-            if mg.zygosity == MouseGene.zygosity_nn:
-                continue
-            res_l.append('%s(%s)' % (mg.gene_name, mg.zygosity))
-        
-        if len(res_l) == 0:
-            # It has no mousegenes, or only -/- mouse genes
-            # Render as 'negative'. Avoid confusion with 'WT'
-            # Also don't include the 'pure' because 'pure negative'
-            # is confusing.            
-            return 'negative'
-        else:
-            # Join remaining mousegenes
-            return '; '.join(res_l)
+        return format_genotype(self.wild_type, [
+            (mg.gene_name, mg.zygosity) for mg in self.mousegene_set.all()])
     
     def get_cage_history_list(self, only_cage_changes=True):
         """Return list of cage info at every historical timepoint.
@@ -766,6 +917,21 @@ class Mouse(models.Model):
     cage_history_string.allow_tags = True
     cage_history_string.short_description = 'From oldest to newest'
 
+    def change_log_string(self):
+        """Returns a formatted string of every change to this mouse"""
+        res_l = []
+        for change_log in ChangeLog.objects.filter(
+            model='Mouse', object_id=self.pk):
+            res_l.append('%s %s: %s' % (
+                timezone.localtime(change_log.history_date).strftime(
+                    '%Y-%m-%d %H:%M:%S'),
+                change_log.field,
+                escape('%s -> %s' % (change_log.old, change_log.new)),
+            ))
+        
+        return mark_safe("<br />\n".join(res_l))
+    change_log_string.short_description = 'Changes, from oldest to newest'
+
     @property
     def user_or_proprietor(self):
         """Returns the person in charge of this mouse.
@@ -1114,17 +1280,9 @@ class Litter(models.Model):
             n_pups = len(self.mouse_set.all())
         except AttributeError:
             n_pups = 0
-        pup_age = self.age()
-        pup_embryonic_age = self.days_since_mating()
-        if pup_age is None:
-            if pup_embryonic_age is None:
-                return '%d pups' % (n_pups)
-            else:
-                return 'E%s' % (pup_embryonic_age)
-        else:
-            return '%d@P%s' % (n_pups, pup_age)
+        return format_litter_info(n_pups, self.age(), self.days_since_mating())
     
-    def needs_date_mated(self):
+    def needs_date_mated(self, today=None):
         """Returns message if litter has no date_mated.
         
         If the litter does not have a date mated: returns None
@@ -1134,13 +1292,15 @@ class Litter(models.Model):
         if self.date_mated or self.dob:
             return None
         
-        reference_date = datetime.date.today()
+        if today is None:
+            today = datetime.date.today()
+        reference_date = today
 
         return {'message': 'specify date mated',
             'trigger': reference_date, 'target': reference_date, 
             'warn': reference_date + datetime.timedelta(days=1)}
     
-    def needs_pup_check(self):
+    def needs_pup_check(self, today=None):
         """Returns information about when pup check is needed.
         
         If the litter does not have a date mated: returns None
@@ -1158,7 +1318,7 @@ class Litter(models.Model):
         return {'message': 'pup check',
             'trigger': trigger, 'target': target, 'warn': warn}
 
-    def needs_toe_clip(self):
+    def needs_toe_clip(self, today=None):
         """Returns information about when toe clip is needed.
         
         If the litter does not have a date of birth: returns None
@@ -1176,7 +1336,7 @@ class Litter(models.Model):
         return {'message': 'toe clip',
             'trigger': trigger, 'target': target, 'warn': warn}
 
-    def needs_genotype(self):
+    def needs_genotype(self, today=None):
         """Returns information about when genotyping is needed.
         
         If the litter does not have a date of birth: returns None
@@ -1194,7 +1354,7 @@ class Litter(models.Model):
         return {'message': 'genotype',
             'trigger': trigger, 'target': target, 'warn': warn}
 
-    def needs_wean(self):
+    def needs_wean(self, today=None):
         """Returns information about when weaning is needed.
         
         If the litter does not have a date of birth: returns None
@@ -1212,26 +1372,51 @@ class Litter(models.Model):
         return {'message': 'wean',
             'trigger': trigger, 'target': target, 'warn': warn}
 
-    @mark_safe
-    def auto_needs_message(self):
-        """Generates an HTML string with all of the litter auto-needs.
+    def auto_needs_methods(self):
+        """Returns the needs_* methods used by auto_needs_message
         
-        Iterates through all of the needs_* methods and generates
-        an HTML string with all of them. Displayed in census view.        
+        Each takes the optional argument today, the date to use instead
+        of today. Only needs_date_mated depends on it.
         """
-        results_s_l = []
-        meth_l = [
+        return [
             self.needs_date_mated,
             self.needs_pup_check,
             self.needs_toe_clip,
             #~ self.needs_genotype,
             self.needs_wean,
         ]
-        today = datetime.date.today()
+
+    def auto_needs_dates(self, today=None):
+        """Returns the dates at which auto_needs_message may change
+        
+        These are the trigger, target, and warn dates of all of the
+        auto needs. auto_needs_message only depends on today's date
+        through these, so it stays the same between them.
+        """
+        res = []
+        for meth in self.auto_needs_methods():
+            meth_res = meth(today=today)
+            if meth_res is not None:
+                res += [meth_res['trigger'], meth_res['target'], 
+                    meth_res['warn']]
+        return res
+
+    @mark_safe
+    def auto_needs_message(self, today=None):
+        """Generates an HTML string with all of the litter auto-needs.
+        
+        Iterates through all of the needs_* methods and generates
+        an HTML string with all of them. Displayed in census view.        
+        
+        today : the date to use instead of today
+        """
+        results_s_l = []
+        if today is None:
+            today = datetime.date.today()
         
         # Iterate over needs methods
-        for meth in meth_l:
-            meth_res = meth()
+        for meth in self.auto_needs_methods():
+            meth_res = meth(today=today)
             
             # Continue if no result or not triggered
             if meth_res is None:
@@ -1269,4 +1454,142 @@ class SpecialRequest(models.Model):
     date_completed = models.DateField('date completed', null=True, blank=True)
     
     # track history with simple_history
-    history = HistoricalRecords()
\ No newline at end of file
+    history = HistoricalRecords()
+
+class CageSnapshot(models.Model):
+    """State of a cage at the start of a day, for historical reporting
+    
+    One row per cage per date, describing the cage as of midnight
+    (local time) at the beginning of that date. These are reconstructed
+    from the simple_history tables by the snapshot_cages management 
+    command, so that reports over long periods are range scans on this
+    table rather than reconstructions from the audit log.
+    
+    The foreign keys are not constrained, like those of the historical
+    models, because a snapshot can refer to a cage or person that has
+    since been deleted.
+    """
+    date = models.DateField(db_index=True)
+    cage = models.ForeignKey(Cage, related_name='snapshots',
+        db_constraint=False, on_delete=models.DO_NOTHING)
+    proprietor = models.ForeignKey(Person, null=True, related_name='+',
+        db_constraint=False, on_delete=models.DO_NOTHING)
+    location = models.IntegerField(
+        choices=Cage._meta.get_field('location').choices)
+    defunct = models.BooleanField(default=False)
+    
+    # Number of unsacked mice in the cage
+    n_mice = models.IntegerField(default=0)
+    
+    class Meta(object):
+        ordering = ['date', 'cage_id']
+        unique_together = [['date', 'cage']]
+    
+    def __str__(self):
+        return '%s on %s' % (self.cage_id, self.date)
+
+
+class ChangeLog(models.Model):
+    """A single field that changed in a simple_history record
+    
+    Diffing each historical record against the previous version of the
+    same object is expensive, so this is done once, when the record is
+    created (see colony.signals), and stored here. Only fields that 
+    changed are stored, so a record that changed nothing has no rows.
+    Use the backfill_changelog management command to fill this in for
+    history that predates it.
+    
+    The old and new values are stored as displayed, using str(). None
+    is stored as null.
+    """
+    # Name of the model, like 'Mouse'
+    model = models.CharField(max_length=20)
+    
+    # Identify the historical record
+    object_id = models.IntegerField()
+    history_id = models.IntegerField()
+    history_date = models.DateTimeField()
+    
+    # The change
+    field = models.CharField(max_length=50)
+    old = models.TextField(null=True, blank=True)
+    new = models.TextField(null=True, blank=True)
+    change_type = models.CharField(max_length=10, choices=(
+        ('addition', 'addition'),
+        ('removal', 'removal'),
+        ('change', 'change'),
+    ))
+    
+    class Meta(object):
+        ordering = ['model', 'history_date', 'history_id', 'id']
+        indexes = [
+            models.Index(fields=['model', 'history_date']),
+            models.Index(fields=['model', 'history_id']),
+            models.Index(fields=['model', 'object_id']),
+        ]
+    
+    def __str__(self):
+        return '%s %s %s' % (self.model, self.object_id, self.field)
+
+
+class HusbandryTask(models.Model):
+    """A husbandry task for a litter, like weaning, and when it is due
+    
+    The Litter.needs_* methods compute when each task is due from the
+    dates of the litter. Evaluating them for every litter to build a 
+    worklist is slow, so their results are stored here whenever a litter
+    is saved (see colony.husbandry.sync_tasks), and the worklist is a 
+    range query on trigger. Use the sync_husbandry_tasks management 
+    command to fill this in for litters saved before it existed.
+    
+    A task is due from its trigger date, should be done by its target
+    date, and is overdue from its warn date. Once the litter no longer
+    needs it (e.g., the pups were weaned), it is marked completed.
+    """
+    litter = models.ForeignKey(Litter, related_name='tasks',
+        on_delete=models.CASCADE)
+    
+    # The kind of task, named as in auto_needs_message
+    kind = models.CharField(max_length=20, choices=(
+        ('date_mated', 'specify date mated'),
+        ('pup_check', 'pup check'),
+        ('toe_clip', 'toe clip'),
+        ('genotype', 'genotype'),
+        ('wean', 'wean'),
+    ))
+    
+    # Dates, from the needs_* method
+    trigger = models.DateField()
+    target = models.DateField()
+    warn = models.DateField()
+    
+    completed = models.BooleanField(default=False)
+    
+    class Meta(object):
+        ordering = ['target', 'litter_id', 'kind']
+        unique_together = [['litter', 'kind']]
+        indexes = [
+            models.Index(fields=['completed', 'trigger']),
+            models.Index(fields=['completed', 'warn']),
+        ]
+    
+    def __str__(self):
+        return '%s: %s' % (self.litter_id, self.get_kind_display())
+
+
+class CageNameSequence(models.Model):
+    """The last cage number used in a series, see generate_cage_name
+    
+    Finding the next cage name by reading every existing cage name is slow
+    and races with other requests, so the last number used in each series
+    is stored here instead, and incremented under select_for_update. Rows
+    are created as needed, starting from the highest existing cage number.
+    """
+    series_number = models.IntegerField(unique=True)
+    last_number = models.IntegerField()
+    
+    class Meta(object):
+        ordering = ['series_number']
+    
+    def __str__(self):
+        return '%d: %d' % (self.series_number, self.last_number)
@@ -0,0 +1,216 @@
+"""In-memory index of unsacked mouse names, for the mouse autocompletes
+
+The autocompletes are queried on every keystroke. When the setting
+MOUSE_NAME_INDEX is True, the autocompletes of unsacked mice search
+this index instead of the database (see MouseAutocomplete).
+
+Each worker process keeps its own index: a list of MouseEntry, sorted
+by upper-cased name, so that the mice whose names start with the search
+text are a contiguous range found with bisect. Infix and gene name
+matches are found by scanning the entries, so every search with search
+text takes time proportional to the number of unsacked mice. That is a
+few thousand mice, which still takes only a few milliseconds; a gene 
+name index would be needed if there were many more.
+
+The index is kept up to date incrementally, by refetching only the mice
+that changed:
+    * The Mouse and MouseGene signals (see colony.signals), and the bulk
+      operations that bypass them (see colony.bulk), mark the mice they
+      change in this process with mark_changed.
+    * Changes made by other processes are found by comparing the highest
+      HistoricalMouse history_id and MouseGene id to the ones seen at the
+      last refresh. This is checked at most every CHECK_INTERVAL seconds.
+    * Changes that neither of those catch, such as a renamed cage, are
+      picked up by rebuilding the index every REBUILD_INTERVAL seconds.
+"""
+from __future__ import unicode_literals
+
+from builtins import object
+from builtins import str
+import bisect
+import collections
+import threading
+import time
+
+from django.db.models import Max
+
+from .models import HistoricalMouse, Mouse, MouseGene
+
+# Seconds between checks for changes made by other processes
+CHECK_INTERVAL = 2
+
+# Seconds between full rebuilds
+REBUILD_INTERVAL = 600
+
+# If more mice than this changed, rebuild instead of refetching them
+MAX_INCREMENTAL = 500
+
+
+class MouseEntry(collections.namedtuple('MouseEntry',
+    ['pk', 'name', 'sex', 'cage_name', 'gene_names'])):
+    """An unsacked mouse in the index
+
+    gene_names is a tuple of the names of its genes, like a short
+    genotype summary. Autocomplete uses pk and str() like for a Mouse.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+def fetch_entries(mouse_qs):
+    """Returns a list of MouseEntry for the unsacked mice in mouse_qs"""
+    rows = mouse_qs.filter(sack_date__isnull=True).values_list(
+        'pk', 'name', 'sex', 'cage__name')
+
+    mouse_id2gene_names = {}
+    for mouse_id, gene_name in MouseGene.objects.filter(
+        mouse_name__in=mouse_qs.filter(sack_date__isnull=True)
+        ).order_by('gene_name__name').values_list(
+        'mouse_name_id', 'gene_name__name'):
+        mouse_id2gene_names.setdefault(mouse_id, []).append(gene_name)
+
+    return [
+        MouseEntry(pk, name, sex, cage_name,
+            tuple(mouse_id2gene_names.get(pk, ())))
+        for pk, name, sex, cage_name in rows
+    ]
+
+def get_versions():
+    """Returns the highest HistoricalMouse history_id and MouseGene id"""
+    return (
+        HistoricalMouse.objects.aggregate(Max('history_id'))[
+            'history_id__max'],
+        MouseGene.objects.aggregate(Max('id'))['id__max'],
+    )
+
+class MouseNameIndex(object):
+    """Index of unsacked mouse names, see the module docstring"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.keys = []
+        self.entries = []
+        self.pk2key = {}
+        self.versions = None
+        self.changed_ids = set()
+        self.built_at = None
+        self.checked_at = None
+
+    def rebuild(self):
+        """Fetch all the unsacked mice"""
+        with self.lock:
+            self.versions = get_versions()
+            entries = sorted(fetch_entries(Mouse.objects.all()),
+                key=lambda entry: (entry.name.upper(), entry.name))
+            self.entries = entries
+            self.keys = [(entry.name.upper(), entry.name)
+                for entry in entries]
+            self.pk2key = dict(
+                [(entry.pk, key) for entry, key in zip(entries, self.keys)])
+            self.changed_ids = set()
+            self.built_at = self.checked_at = time.time()
+
+    def mark_changed(self, mouse_ids):
+        """Refetch these mice before the next search
+        
+        This does nothing until the index is first built.
+        """
+        with self.lock:
+            if self.built_at is not None:
+                self.changed_ids.update(mouse_ids)
+
+    def update_mice(self, mouse_ids):
+        """Refetch these mice from the database"""
+        mouse_ids = set(mouse_ids)
+        with self.lock:
+            # Remove their old entries
+            for mouse_id in mouse_ids:
+                key = self.pk2key.pop(mouse_id, None)
+                if key is not None:
+                    idx = bisect.bisect_left(self.keys, key)
+                    del self.keys[idx]
+                    del self.entries[idx]
+
+            # Insert the ones that are still unsacked
+            for entry in fetch_entries(
+                Mouse.objects.filter(pk__in=mouse_ids)):
+                key = (entry.name.upper(), entry.name)
+                idx = bisect.bisect_left(self.keys, key)
+                self.keys.insert(idx, key)
+                self.entries.insert(idx, entry)
+                self.pk2key[entry.pk] = key
+
+    def refresh(self):
+        """Rebuild or update the index, if it might be stale"""
+        with self.lock:
+            now = time.time()
+            if (self.built_at is None or
+                now - self.built_at > REBUILD_INTERVAL):
+                self.rebuild()
+                return
+
+            changed_ids = self.changed_ids
+            self.changed_ids = set()
+            if now - self.checked_at > CHECK_INTERVAL:
+                last_history_id, last_mousegene_id = self.versions
+                self.versions = get_versions()
+                self.checked_at = now
+                if self.versions[0] != last_history_id:
+                    changed_ids.update(HistoricalMouse.objects.filter(
+                        history_id__gt=last_history_id or 0,
+                        ).values_list('id', flat=True).distinct())
+                if self.versions[1] != last_mousegene_id:
+                    changed_ids.update(MouseGene.objects.filter(
+                        id__gt=last_mousegene_id or 0,
+                        ).values_list('mouse_name_id', flat=True).distinct())
+
+            if len(changed_ids) > MAX_INCREMENTAL:
+                self.rebuild()
+            elif len(changed_ids) > 0:
+                self.update_mice(changed_ids)
+
+    def search(self, q, sex=None):
+        """Returns the unsacked mice matching q, as a list of MouseEntry
+
+        These are ordered like MouseAutocomplete: first those whose name
+        starts with q, then those whose name contains q, and then those
+        with a gene whose name starts with q. Names are compared
+        case-insensitively.
+
+        sex : if not None, only mice of this sex are returned
+        """
+        self.refresh()
+
+        with self.lock:
+            if sex not in (None, ''):
+                sex = int(sex)
+                keep = lambda entry: entry.sex == sex
+            else:
+                keep = lambda entry: True
+
+            if not q:
+                return [entry for entry in self.entries if keep(entry)]
+
+            # The names starting with q are all in one range
+            q = str(q).upper()
+            start = bisect.bisect_left(self.keys, (q,))
+            stop = start
+            while stop < len(self.keys) and self.keys[stop][0].startswith(q):
+                stop += 1
+            res = [entry for entry in self.entries[start:stop] if keep(entry)]
+
+            # Scan for the other matches
+            contains, by_gene = [], []
+            for idx, entry in enumerate(self.entries):
+                if start <= idx < stop or not keep(entry):
+                    continue
+                if q in self.keys[idx][0]:
+                    contains.append(entry)
+                elif any(gene_name.upper().startswith(q)
+                    for gene_name in entry.gene_names):
+                    by_gene.append(entry)
+
+            return res + contains + by_gene
+
+# The index for this process
+mouse_name_index = MouseNameIndex()
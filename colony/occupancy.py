@@ -0,0 +1,373 @@
+"""Reconstruct cage occupancy over time from the simple_history tables
+
+The state of every cage at any moment is given by its most recent
+HistoricalCage record before that moment. Rather than querying the
+history table once per date of interest, get_cage_versions pulls the
+relevant records in a single query and converts them into validity
+intervals: each version is valid from its history_date until the
+history_date of the next version of the same cage. Counts for any
+number of dates are then computed with vectorized interval arithmetic
+in count_cages_by_proprietor.
+
+Reconstructing months of history this way still means reading the whole
+audit log on every report. So the state of every cage at the start of 
+each day is also materialized in CageSnapshot, by store_snapshots (see
+the snapshot_cages management command). cage_counts_by_proprietor reads
+the snapshots where they exist, and reconstructs only the other dates.
+Finally, get_counts_by_person caches the report until the history changes.
+"""
+from __future__ import unicode_literals
+
+import numpy as np
+import pandas
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
+
+from .models import CageSnapshot, HistoricalCage, HistoricalMouse
+
+# Used as the end of the validity interval of the latest version
+END_OF_TIME = np.iinfo(np.int64).max
+
+
+def datetimes_to_int(datetimes):
+    """Convert timezone-aware datetimes to int64 nanoseconds since epoch
+
+    datetimes : anything that pandas.to_datetime accepts
+    Missing values are returned as END_OF_TIME.
+    """
+    dti = pandas.DatetimeIndex(pandas.to_datetime(datetimes, utc=True))
+    res = dti.values.astype('datetime64[ns]').astype(np.int64)
+    res[np.asarray(dti.isna())] = END_OF_TIME
+    return res
+
+def get_versions(history_qs, lookups, columns, end=None):
+    """Returns the records in history_qs, with their validity intervals
+
+    history_qs : queryset of a simple_history model
+    lookups : values_list lookups to fetch, in addition to id, 
+        history_id, history_date, and history_type
+    columns : name of the column for each lookup
+    end : datetime or None
+        If not None, only records with history_date <= end are fetched,
+        which is all that is needed to know the state at or before end.
+
+    This runs a single query.
+
+    Returns: DataFrame with one row per record and columns
+        id, history_type, *columns
+        valid_from, valid_until : int64 nanoseconds since epoch
+            valid_until is END_OF_TIME for the latest version of each object
+    """
+    if end is not None:
+        history_qs = history_qs.filter(history_date__lte=end)
+
+    records = list(history_qs.values_list('id', 'history_id', 
+        'history_date', 'history_type', *lookups))
+    versions = pandas.DataFrame.from_records(records, 
+        columns=['id', 'history_id', 'history_date', 'history_type'] + 
+        list(columns))
+
+    # Order the versions of each object, breaking ties by history_id
+    versions['valid_from'] = datetimes_to_int(versions['history_date'])
+    versions = versions.sort_values(
+        ['id', 'valid_from', 'history_id']).reset_index(drop=True)
+
+    # Each version is valid until the next version of the same object
+    # This is done with integer arrays, because shifting with pandas
+    # would convert to float and lose precision
+    ids = versions['id'].values
+    valid_from = versions['valid_from'].values
+    valid_until = np.full(len(versions), END_OF_TIME, dtype=np.int64)
+    same_object = ids[1:] == ids[:-1]
+    valid_until[:-1][same_object] = valid_from[1:][same_object]
+    versions['valid_until'] = valid_until
+
+    return versions.drop(['history_id', 'history_date'], axis=1)
+
+def get_cage_versions(end=None):
+    """Returns every version of every cage, with its validity interval
+
+    See get_versions. The columns are id, history_type, defunct, 
+    location, proprietor_id, proprietor (the name), valid_from, 
+    and valid_until.
+    """
+    return get_versions(HistoricalCage.objects.all(),
+        ['defunct', 'location', 'proprietor_id', 'proprietor__name'],
+        ['defunct', 'location', 'proprietor_id', 'proprietor'],
+        end=end)
+
+def get_mouse_versions(end=None):
+    """Returns every version of every mouse, with its validity interval
+
+    See get_versions. The columns are id, history_type, cage_id,
+    sack_date, valid_from, and valid_until.
+    """
+    return get_versions(HistoricalMouse.objects.all(),
+        ['cage_id', 'sack_date'], ['cage_id', 'sack_date'], end=end)
+
+def versions_at(versions, when):
+    """Returns the version of each object that was current at when
+
+    versions : DataFrame from get_versions
+    when : int64 nanoseconds since epoch
+    
+    Objects that did not exist yet, or had been deleted, at that moment
+    are not included.
+    """
+    mask = (
+        (versions['valid_from'].values <= when) &
+        (versions['valid_until'].values > when) &
+        (versions['history_type'].values != '-')
+    )
+    return versions[mask]
+
+def midnights(dates):
+    """Returns the local midnight at the start of each date
+
+    dates : list of datetime.date
+    Returns: timezone-aware DatetimeIndex, in settings.TIME_ZONE
+    """
+    return pandas.DatetimeIndex(dates).tz_localize(settings.TIME_ZONE)
+
+def count_cages_by_proprietor(versions, target_dates, locations):
+    """Count the cages belonging to each proprietor at each target date
+
+    versions : DataFrame from get_cage_versions
+    target_dates : DatetimeIndex of dates to count at
+    locations : list of locations to include
+
+    A cage is counted at a date if its most recent version at that date
+    was not defunct, was in one of the locations, and was not a deletion.
+    Cages that contained no mice are also counted.
+
+    Returns: DataFrame of int, indexed by proprietor name, with one column
+        per target date. Proprietors with no cages at any date are
+        excluded.
+    """
+    target_ints = datetimes_to_int(target_dates)
+
+    # Select the versions that count
+    mask = (
+        ~versions['defunct'].astype(bool) &
+        versions['location'].isin(locations) &
+        (versions['history_type'] != '-')
+    )
+    counted = versions[mask]
+
+    # The number of intervals [valid_from, valid_until) containing t is
+    # the number that started at or before t, minus the number that
+    # ended at or before t
+    counts_l = []
+    proprietors = []
+    for proprietor, proprietor_versions in counted.groupby('proprietor'):
+        n_started = np.searchsorted(
+            np.sort(proprietor_versions['valid_from'].values),
+            target_ints, side='right')
+        n_ended = np.searchsorted(
+            np.sort(proprietor_versions['valid_until'].values),
+            target_ints, side='right')
+        counts = n_started - n_ended
+
+        if counts.any():
+            counts_l.append(counts)
+            proprietors.append(proprietor)
+
+    if len(counts_l) == 0:
+        return pandas.DataFrame(
+            np.zeros((0, len(target_dates)), dtype=int),
+            columns=target_dates)
+
+    return pandas.DataFrame(np.array(counts_l, dtype=int),
+        index=proprietors, columns=target_dates)
+
+
+## Daily snapshots
+def build_snapshots(date, cage_versions, mouse_versions, 
+    include_defunct=False):
+    """Returns the CageSnapshot of every cage at the start of date
+
+    date : datetime.date
+    cage_versions, mouse_versions : from get_cage_versions and 
+        get_mouse_versions, including at least every record up to the
+        local midnight at the start of date
+    include_defunct : if False, defunct cages are skipped. They never 
+        change, and would otherwise make up most of the table.
+
+    Returns: list of unsaved CageSnapshot
+    """
+    when = datetimes_to_int(midnights([date]))[0]
+
+    cages = versions_at(cage_versions, when)
+    if not include_defunct:
+        cages = cages[~cages['defunct'].astype(bool)]
+
+    # Count the unsacked mice in each cage
+    mice = versions_at(mouse_versions, when)
+    mice = mice[mice['cage_id'].notnull() & mice['sack_date'].isnull()]
+    n_mice = mice['cage_id'].astype(np.int64).value_counts()
+
+    res = []
+    for cage in cages.itertuples():
+        if pandas.isnull(cage.proprietor_id):
+            proprietor_id = None
+        else:
+            proprietor_id = int(cage.proprietor_id)
+
+        res.append(CageSnapshot(
+            date=date,
+            cage_id=int(cage.id),
+            proprietor_id=proprietor_id,
+            location=int(cage.location),
+            defunct=bool(cage.defunct),
+            n_mice=int(n_mice.get(cage.id, 0)),
+        ))
+    return res
+
+def store_snapshots(dates, include_defunct=False):
+    """Compute and store the snapshots for dates
+
+    Any existing snapshots for those dates are replaced. The history 
+    tables are queried only once, however many dates there are.
+
+    Returns: the number of snapshots stored
+    """
+    if len(dates) == 0:
+        return 0
+
+    end = midnights([max(dates)])[0]
+    cage_versions = get_cage_versions(end=end)
+    mouse_versions = get_mouse_versions(end=end)
+
+    n_stored = 0
+    with transaction.atomic():
+        CageSnapshot.objects.filter(date__in=dates).delete()
+        for date in sorted(dates):
+            snapshots = build_snapshots(date, cage_versions, mouse_versions,
+                include_defunct=include_defunct)
+            CageSnapshot.objects.bulk_create(snapshots, batch_size=500)
+            n_stored += len(snapshots)
+    return n_stored
+
+def cage_counts_by_proprietor(target_dates, locations):
+    """Count the cages belonging to each proprietor at each target date
+
+    target_dates : DatetimeIndex of local midnights, as from midnights
+    locations : list of locations to include
+
+    Counts for dates that have been snapshotted are read from 
+    CageSnapshot. Only the remaining dates, if any, are reconstructed
+    from the history tables with count_cages_by_proprietor. Both give
+    the same result.
+
+    Returns: DataFrame of int, indexed by proprietor name, with one column
+        per target date. Proprietors with no cages at any date are
+        excluded.
+    """
+    date2target = dict(zip(target_dates.date, target_dates))
+    snapshot_qs = CageSnapshot.objects.filter(date__in=list(date2target))
+
+    # Dates that have been snapshotted
+    covered_dates = set(snapshot_qs.values_list(
+        'date', flat=True).order_by().distinct())
+
+    ## Read the snapshotted dates
+    counts = {}
+    for row in snapshot_qs.filter(defunct=False, 
+        location__in=locations).values('date', 'proprietor__name').annotate(
+        n_cages=Count('id')).order_by():
+        if row['proprietor__name'] is None:
+            continue
+        counts.setdefault(row['proprietor__name'], {})[
+            date2target[row['date']]] = row['n_cages']
+    res = pandas.DataFrame.from_dict(counts, orient='index')
+
+    ## Reconstruct the rest
+    uncovered = pandas.DatetimeIndex([target for date, target in 
+        date2target.items() if date not in covered_dates])
+    if len(uncovered) > 0:
+        versions = get_cage_versions(end=uncovered.max())
+        res = pandas.concat([res, count_cages_by_proprietor(versions, 
+            uncovered, locations)], axis=1)
+    
+    res = res.reindex(columns=target_dates).fillna(0).astype(int)
+    return res.loc[res.sum(1) > 0]
+
+
+## Cached reports
+# Entries never go stale, because the key changes with the history, so
+# this only bounds how long unused entries are kept
+COUNTS_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+def counts_params_key(start, end, freq, locations):
+    """Returns a string identifying the parameters of counts_by_person"""
+    return '%s:%s:%s:%s' % (start.isoformat(), end.isoformat(), freq,
+        ','.join(map(str, sorted(locations))))
+
+def get_history_state():
+    """Returns the latest HistoricalCage history_id and history_date
+
+    Every change to a cage creates a record with a larger history_id, so 
+    the history_id identifies the state of the history that the counts
+    depend on, and the history_date is when that state began. If there
+    is no history, returns 0 and None.
+    """
+    res = HistoricalCage.objects.aggregate(
+        latest=Max('history_id'), modified=Max('history_date'))
+    return res['latest'] or 0, res['modified']
+
+def get_counts_by_person(start, end, freq, locations, version=None):
+    """Returns the cage counts by proprietor shown by counts_by_person
+
+    start, end : datetime.date, inclusive
+    freq : pandas frequency string for the tabular counts
+    locations : list of locations to include
+    version : history_id from get_history_state, if already known
+
+    The results are cached, keyed by the parameters and the latest
+    HistoricalCage history_id, so they are only recomputed when a cage 
+    actually changes. On a cache hit this runs a single query, or none
+    if version is provided.
+
+    Returns: version, df, tabular_df
+        version : the latest history_id (see get_history_state)
+        df : daily counts, with the most recent date first
+        tabular_df : counts at freq, with the most recent date first
+        Both are sorted by total usage and end with a 'total' row,
+        unless they have no dates.
+    """
+    if version is None:
+        version, modified = get_history_state()
+    key = 'counts_by_person:%s:%d' % (
+        counts_params_key(start, end, freq, locations), version)
+    
+    res = cache.get(key)
+    if res is not None:
+        return (version,) + res
+    
+    target_dates = pandas.date_range(start, end, tz=settings.TIME_ZONE,
+        freq='D')[::-1]
+    tabular_target_dates = pandas.date_range(start, end, 
+        tz=settings.TIME_ZONE, freq=freq)[::-1]
+
+    # Both resolutions are counted at once, mostly from the snapshots
+    counts = cage_counts_by_proprietor(
+        target_dates.union(tabular_target_dates), locations=locations)
+
+    res = []
+    for dates in [target_dates, tabular_target_dates]:
+        df = counts[dates]
+        df = df.loc[df.sum(1) > 0]
+
+        # Sort by usage and add a total
+        # There may be no tabular dates if the range is short
+        df = df.loc[df.sum(1).sort_values().index[::-1]]
+        if len(df.columns) > 0:
+            df.loc['total'] = df.sum(0)
+        res.append(df)
+    res = tuple(res)
+
+    cache.set(key, res, COUNTS_CACHE_TIMEOUT)
+    return (version,) + res
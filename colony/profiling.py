@@ -0,0 +1,203 @@
+"""Count and time the SQL queries made by each request
+
+QueryProfile records the queries run on the database connection while it
+is active, whether or not DEBUG is set:
+    with QueryProfile() as profile:
+        ...
+    print(profile.summary())
+
+When the setting QUERY_PROFILE is True, QueryProfileMiddleware profiles
+every request. It adds a header like
+    X-Query-Profile: queries=12; duplicates=3; sql_ms=4.1; total_ms=40.2
+to the response, and adds the profile to the statistics for its view,
+which are shown to staff by the query_profiles view. These statistics
+are kept in memory, so they are per process, and are lost on restart.
+
+If the setting QUERY_BUDGET is set, requests that make more queries than
+that are logged as warnings to the 'colony.profiling' logger, with their
+most duplicated queries. A query that is repeated with different
+parameters, like one per cage, is usually an N+1 problem.
+"""
+from __future__ import unicode_literals
+from __future__ import division
+
+from builtins import object
+import collections
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+# Number of duplicated queries to log or display for each view
+N_TOP_DUPLICATES = 5
+
+
+def fingerprint(sql):
+    """Returns sql with lists of parameters collapsed
+
+    The parameters are not part of sql, so queries that differ only in
+    their parameters already have the same sql. This also gives the same
+    fingerprint to queries like IN (%s, %s) with different numbers of
+    parameters.
+    """
+    return re.sub(r'\((%s, )+%s\)', '(...)', sql)
+
+class QueryProfile(object):
+    """Records the queries run on the default database connection
+
+    Use as a context manager. Afterwards:
+        queries : list of (sql, seconds), in the order they were run
+        n_queries : number of queries
+        sql_time : total seconds spent in the database
+        total_time : total seconds inside the context manager
+    """
+    def __init__(self):
+        self.queries = []
+        self.total_time = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # Called by the connection for each query, see execute_wrapper
+        start = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.time() - start))
+
+    def __enter__(self):
+        self.start = time.time()
+        self.wrapper = connection.execute_wrapper(self)
+        self.wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.wrapper.__exit__(exc_type, exc_value, traceback)
+        self.total_time = time.time() - self.start
+
+    @property
+    def n_queries(self):
+        return len(self.queries)
+
+    @property
+    def sql_time(self):
+        return sum([seconds for sql, seconds in self.queries])
+
+    def get_duplicates(self):
+        """Returns a Counter of fingerprints that were run more than once"""
+        counts = collections.Counter(
+            [fingerprint(sql) for sql, seconds in self.queries])
+        return collections.Counter(dict(
+            [(fp, count) for fp, count in counts.items() if count > 1]))
+
+    @property
+    def n_duplicates(self):
+        """Number of queries that repeated an earlier fingerprint"""
+        return sum([count - 1 for count in self.get_duplicates().values()])
+
+    def summary(self):
+        """Returns a summary like the X-Query-Profile header"""
+        return 'queries=%d; duplicates=%d; sql_ms=%.1f; total_ms=%.1f' % (
+            self.n_queries, self.n_duplicates, self.sql_time * 1000,
+            (self.total_time or 0) * 1000)
+
+
+## Statistics by view
+_view_stats = {}
+_view_stats_lock = threading.Lock()
+
+def record_profile(view_name, profile):
+    """Add profile to the statistics for view_name"""
+    duplicates = profile.get_duplicates()
+    with _view_stats_lock:
+        stats = _view_stats.setdefault(view_name, {
+            'view': view_name,
+            'requests': 0,
+            'queries': 0,
+            'max_queries': 0,
+            'duplicates': 0,
+            'sql_time': 0.,
+            'total_time': 0.,
+            'top_duplicates': collections.Counter(),
+        })
+        stats['requests'] += 1
+        stats['queries'] += profile.n_queries
+        stats['max_queries'] = max(stats['max_queries'], profile.n_queries)
+        stats['duplicates'] += profile.n_duplicates
+        stats['sql_time'] += profile.sql_time
+        stats['total_time'] += profile.total_time
+
+        # Keep the highest count of each fingerprint in any one request
+        for fp, count in duplicates.items():
+            stats['top_duplicates'][fp] = max(
+                stats['top_duplicates'][fp], count)
+
+def get_view_stats():
+    """Returns the statistics for each view, most queries first
+
+    Returns: list of dicts, each with keys:
+        'view', 'requests', 'max_queries'
+        'mean_queries', 'mean_duplicates', 'mean_sql_ms', 'mean_total_ms'
+        'top_duplicates' : list of (fingerprint, count), the queries
+            repeated most often within one request
+    """
+    res = []
+    with _view_stats_lock:
+        for stats in _view_stats.values():
+            n = stats['requests']
+            res.append({
+                'view': stats['view'],
+                'requests': n,
+                'max_queries': stats['max_queries'],
+                'mean_queries': stats['queries'] / n,
+                'mean_duplicates': stats['duplicates'] / n,
+                'mean_sql_ms': stats['sql_time'] * 1000 / n,
+                'mean_total_ms': stats['total_time'] * 1000 / n,
+                'top_duplicates': stats['top_duplicates'].most_common(
+                    N_TOP_DUPLICATES),
+            })
+    return sorted(res, key=lambda row: (-row['mean_queries'], row['view']))
+
+def reset_view_stats():
+    with _view_stats_lock:
+        _view_stats.clear()
+
+
+## Middleware
+class QueryProfileMiddleware(object):
+    """Profile the queries of each request, see the module docstring
+
+    This is only used if the setting QUERY_PROFILE is True.
+    """
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_PROFILE', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with QueryProfile() as profile:
+            response = self.get_response(request)
+        response['X-Query-Profile'] = profile.summary()
+
+        # Requests that did not resolve to a view, like 404s, are not
+        # recorded
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None:
+            return response
+        view_name = resolver_match.view_name
+        record_profile(view_name, profile)
+
+        budget = getattr(settings, 'QUERY_BUDGET', None)
+        if budget and profile.n_queries > budget:
+            logger.warning(
+                '%s made %d queries, over the budget of %d (%s): %s',
+                view_name, profile.n_queries, budget, request.path,
+                '; '.join(['%dx %s' % (count, fp[:200]) for fp, count in
+                    profile.get_duplicates().most_common(N_TOP_DUPLICATES)]),
+            )
+
+        return response
@@ -0,0 +1,187 @@
+"""Signal handlers that keep denormalized data up to date
+
+Connected in ColonyConfig.ready.
+
+The stored classification on each Cage (cage_type, geneset_key, etc.)
+depends on the mice in the cage, their MouseGenes, and the cage's
+Litter, including the parents wherever they live. Whenever any of those
+change, the classification of the affected cages is recomputed, and
+their cached census rows are invalidated (see refresh_cages). This is
+done once per transaction, when it commits (see refresh_on_commit), so
+that a form that saves many rows refreshes each cage once. Changes to 
+special requests, people, and genes also invalidate the census rows 
+that show them.
+
+The changes made by each new Mouse and Cage historical record are also
+stored in ChangeLog, so they do not have to be recomputed on display.
+
+The husbandry tasks of each litter are stored in HusbandryTask whenever
+the litter is saved.
+
+Mice and MouseGenes that change are refetched into this process's mouse
+name index (see colony.name_index).
+"""
+from __future__ import unicode_literals
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from simple_history.signals import post_create_historical_record
+
+from .census import touch_cages, update_classification
+from .changes import MODEL_NAMES, log_changes
+from .husbandry import sync_tasks
+from .models import Cage, Gene, Litter, Mouse, MouseGene, Person, SpecialRequest
+from .name_index import mouse_name_index
+
+
+def refresh_cages(cage_qs):
+    """Recompute the classification and census rows of these cages"""
+    update_classification(cage_qs)
+    touch_cages(cage_qs)
+
+def cages_affected_by_mice(mouse_ids, cage_ids=()):
+    """Returns a queryset of the cages whose census depends on these mice
+
+    That is the cages in cage_ids (typically the current and previous
+    cages of the mice, and the breeding cages of their litters), plus 
+    the breeding cage of any litter that one of these mice parented.
+    """
+    return Cage.objects.filter(
+        Q(pk__in=[cage_id for cage_id in cage_ids if cage_id is not None]) |
+        Q(litter__mother_id__in=mouse_ids) |
+        Q(litter__father_id__in=mouse_ids)
+    ).distinct()
+
+class PendingRefresh(object):
+    """The changes of a transaction, to refresh their cages on commit
+
+    cage_ids : cages that changed
+    mouse_ids : mice that changed, whose current cages and the breeding
+        cages of the litters they parented are affected
+    litter_ids : litters that changed, whose breeding cages and the
+        current cages of their pups are affected
+    """
+    def __init__(self):
+        self.cage_ids = set()
+        self.mouse_ids = set()
+        self.litter_ids = set()
+
+    def __call__(self):
+        # Called by the connection when the transaction commits
+        refresh_cages(Cage.objects.filter(
+            Q(pk__in=self.cage_ids | self.litter_ids) |
+            Q(mouse__in=self.mouse_ids) |
+            Q(mouse__litter_id__in=self.litter_ids) |
+            Q(litter__mother_id__in=self.mouse_ids) |
+            Q(litter__father_id__in=self.mouse_ids)
+        ).distinct())
+
+def refresh_on_commit(cage_ids=(), mouse_ids=(), litter_ids=()):
+    """Refresh the cages affected by these changes when the transaction
+    commits, along with those of every other change in it
+
+    The ids are collected in a single PendingRefresh per transaction. 
+    Outside of a transaction, the cages are refreshed immediately.
+    """
+    connection = transaction.get_connection()
+    pending = None
+    if connection.in_atomic_block:
+        # A PendingRefresh registered by an earlier change. If it was 
+        # registered in a savepoint that was rolled back, it is gone.
+        for entry in connection.run_on_commit:
+            if isinstance(entry[1], PendingRefresh):
+                pending = entry[1]
+                break
+    
+    is_new = pending is None
+    if is_new:
+        pending = PendingRefresh()
+    pending.cage_ids.update(
+        [cage_id for cage_id in cage_ids if cage_id is not None])
+    pending.mouse_ids.update(mouse_ids)
+    pending.litter_ids.update(litter_ids)
+    if is_new:
+        transaction.on_commit(pending)
+
+@receiver(pre_save, sender=Mouse)
+def remember_previous_cage(sender, instance, raw=False, **kwargs):
+    """Store the cage the mouse is leaving, so that it can be updated"""
+    if raw or instance.pk is None:
+        instance._previous_cage_id = None
+    else:
+        instance._previous_cage_id = Mouse.objects.filter(
+            pk=instance.pk).values_list('cage_id', flat=True).first()
+
+@receiver(post_save, sender=Mouse)
+@receiver(post_delete, sender=Mouse)
+def update_classification_for_mouse(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # The breeding cage shows the number of pups in its litter
+    refresh_on_commit(cage_ids=[instance.cage_id, 
+        getattr(instance, '_previous_cage_id', None), instance.litter_id],
+        mouse_ids=[instance.pk])
+
+@receiver(post_save, sender=Mouse)
+@receiver(post_delete, sender=Mouse)
+def update_name_index_for_mouse(sender, instance, **kwargs):
+    mouse_name_index.mark_changed([instance.pk])
+
+@receiver(post_save, sender=MouseGene)
+@receiver(post_delete, sender=MouseGene)
+def update_name_index_for_mousegene(sender, instance, **kwargs):
+    mouse_name_index.mark_changed([instance.mouse_name_id])
+
+@receiver(post_save, sender=MouseGene)
+@receiver(post_delete, sender=MouseGene)
+def update_classification_for_mousegene(sender, instance, raw=False, 
+    **kwargs):
+    if raw:
+        return
+    refresh_on_commit(mouse_ids=[instance.mouse_name_id])
+
+@receiver(post_save, sender=Litter)
+@receiver(post_delete, sender=Litter)
+def update_classification_for_litter(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    # The pups show the date of birth of their litter, wherever they are
+    refresh_on_commit(litter_ids=[instance.breeding_cage_id])
+
+@receiver(post_save, sender=Litter)
+def sync_tasks_for_litter(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    sync_tasks([instance])
+
+@receiver(post_save, sender=Cage)
+def update_classification_for_cage(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    refresh_on_commit(cage_ids=[instance.pk])
+
+@receiver(post_save, sender=SpecialRequest)
+@receiver(post_delete, sender=SpecialRequest)
+def touch_cage_for_special_request(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    touch_cages(Cage.objects.filter(pk=instance.cage_id))
+
+@receiver(post_save, sender=Person)
+@receiver(post_save, sender=Gene)
+def touch_all_cages(sender, instance, raw=False, **kwargs):
+    """People and gene names are shown throughout the census
+    
+    These rarely change, so just invalidate every census row.
+    """
+    if raw:
+        return
+    touch_cages(Cage.objects.all())
+
+@receiver(post_create_historical_record)
+def log_historical_record(sender, instance, history_instance, **kwargs):
+    """Store the changes made by this record in ChangeLog"""
+    if type(history_instance) in MODEL_NAMES:
+        log_changes(type(history_instance), [history_instance])
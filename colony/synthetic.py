@@ -0,0 +1,323 @@
+"""Generate a synthetic colony, for benchmarks and tests
+
+generate_colony creates persons, genes, cages, mice, litters, MouseGenes,
+special requests, and the historical records of all of them, at any
+scale. The colony depends only on the number of mice, the seed, and
+today, so runs with the same arguments can be compared.
+
+The cages and mice are created over the preceding days. Some of the
+cages have since been made defunct and their mice sacked, which is
+recorded as a change in their history, as if they had been saved then.
+About a third of the cages are breeding cages, with a litter at any
+stage from mated to weaned.
+
+Everything is created with bulk operations (see colony.bulk), so this
+runs a number of queries that grows with the number of days of history
+and the number of litters, not with the number of mice.
+"""
+from __future__ import unicode_literals
+from __future__ import division
+
+import copy
+import datetime
+import random
+
+from django.db import transaction
+from django.utils import timezone
+
+from .bulk import create_historical_records
+from .husbandry import sync_all_tasks
+from .models import (Cage, Gene, Litter, Mouse, MouseGene, Person,
+    SpecialRequest)
+from .signals import refresh_cages
+
+# The genes, and their types
+GENES = (
+    ('Emx-Cre', 'driver'),
+    ('Cux2-CreERT2', 'driver'),
+    ('PV-Cre', 'driver'),
+    ('SST-Cre', 'driver'),
+    ('Ai14', 'reporter'),
+    ('Ai32', 'reporter'),
+    ('flex-halo', 'reporter'),
+    ('GCaMP6s', 'reporter'),
+)
+
+# One person per this many mice, and at least MIN_PERSONS
+MICE_PER_PERSON = 2000
+MIN_PERSONS = 3
+
+# Cage locations, weighted towards the default census location
+LOCATIONS = (4, 4, 4, 4, 0, 3, 5, 6)
+
+# Fractions of cages
+DEFUNCT_FRACTION = 0.4
+BREEDING_FRACTION = 0.35
+SPECIAL_REQUEST_FRACTION = 0.05
+
+
+def noon(date):
+    """Returns noon on date, in the current time zone"""
+    return timezone.make_aware(
+        datetime.datetime.combine(date, datetime.time(12)))
+
+def create_named(model, objs):
+    """Bulk create objs and return them with their pks, by unique name"""
+    model.objects.bulk_create(objs, batch_size=500)
+    name2obj = model.objects.in_bulk(
+        [obj.name for obj in objs], field_name='name')
+    return [name2obj[obj.name] for obj in objs]
+
+def create_history_by_date(model, date_obj_l, history_type):
+    """Create historical records of objs, dated as given
+
+    date_obj_l : list of (date, obj), where obj is an instance of model
+        with the values to record at noon on date
+    """
+    date2objs = {}
+    for date, obj in date_obj_l:
+        date2objs.setdefault(date, []).append(obj)
+
+    for date in sorted(date2objs.keys()):
+        create_historical_records(model, date2objs[date], history_type,
+            history_date=noon(date))
+
+def generate_colony(n_mice, seed=0, days=365, today=None):
+    """Create a synthetic colony in the database, see the module docstring
+
+    n_mice : approximate number of mice to create. The cages are filled
+        until there are at least this many.
+    seed : seed for the random choices
+    days : the cages are created over this many days before today
+    today : the last day of the history, by default today. Litters are
+        at the stage they would be on this day.
+
+    Returns: dict from model name to the number of objects created
+    """
+    rng = random.Random(seed)
+    if today is None:
+        today = datetime.date.today()
+    start = today - datetime.timedelta(days=days)
+
+    def random_date(after, before=today):
+        # A date from after to before, inclusive
+        return after + datetime.timedelta(
+            days=rng.randint(0, max((before - after).days, 0)))
+
+    with transaction.atomic():
+        ## Persons and genes
+        n_persons = max(MIN_PERSONS, n_mice // MICE_PER_PERSON + 1)
+        persons = create_named(Person, [
+            Person(name='person%d' % (idx + 1),
+                login_name='person%d' % (idx + 1),
+                series_number=idx + 1)
+            for idx in range(n_persons)])
+        genes = create_named(Gene, [
+            Gene(name=name, gene_type=gene_type)
+            for name, gene_type in GENES])
+
+        ## Cages and mice
+        # Each is a dict of values until they are created
+        cage_d_l = []
+        mouse_d_l = []
+        person2n_cages = {}
+        while len(mouse_d_l) < n_mice:
+            person = rng.choice(persons)
+            person2n_cages[person] = person2n_cages.get(person, 0) + 1
+            created = random_date(start)
+            defunct_date = None
+            if rng.random() < DEFUNCT_FRACTION and created < today:
+                defunct_date = random_date(
+                    created + datetime.timedelta(days=1))
+            cage_d = {
+                'name': str(person.series_number * 1000 +
+                    person2n_cages[person]),
+                'proprietor': person,
+                'location': rng.choice(LOCATIONS),
+                'rack_spot': '%s%d' % (
+                    rng.choice('ABCDEF'), rng.randint(1, 12)),
+                'created': created,
+                'defunct_date': defunct_date,
+                'breeding': rng.random() < BREEDING_FRACTION,
+            }
+            cage_d_l.append(cage_d)
+
+            # Adults, with the parents first in breeding cages
+            if cage_d['breeding']:
+                sexes = [1, 0]
+            else:
+                sex = rng.randint(0, 1)
+                sexes = [sex] * rng.randint(1, 5)
+            cage_d['mice'] = []
+            for idx, sex in enumerate(sexes):
+                wild_type = rng.random() < 0.1
+                cage_d['mice'].append({
+                    'name': '%s-%d' % (cage_d['name'], idx + 1),
+                    'cage': cage_d,
+                    'sex': sex,
+                    'manual_dob': created - datetime.timedelta(
+                        days=rng.randint(21, 200)),
+                    'pure_breeder': rng.random() < 0.2,
+                    'wild_type': wild_type,
+                    'user': rng.choice(persons)
+                        if rng.random() < 0.05 else None,
+                    'created': created,
+                    'genes': [] if wild_type else rng.sample(
+                        genes, rng.randint(0, 2)),
+                })
+            mouse_d_l += cage_d['mice']
+
+        name2cage = dict([(cage.name, cage) for cage in create_named(Cage, [
+            Cage(name=cage_d['name'], proprietor=cage_d['proprietor'],
+                location=cage_d['location'], rack_spot=cage_d['rack_spot'],
+                defunct=cage_d['defunct_date'] is not None, notes='')
+            for cage_d in cage_d_l])])
+        for cage_d in cage_d_l:
+            cage_d['obj'] = name2cage[cage_d['name']]
+
+        ## Litters, and the unweaned pups in the breeding cages
+        litter_d_l = []
+        for cage_d in cage_d_l:
+            if not cage_d['breeding']:
+                continue
+            end = cage_d['defunct_date'] or today
+            date_mated = cage_d['created']
+            dob = date_mated + datetime.timedelta(days=rng.randint(19, 24))
+            if dob > end or rng.random() < 0.2:
+                dob = None
+            litter_d = {
+                'cage': cage_d,
+                'date_mated': date_mated,
+                'dob': dob,
+                'date_toeclipped': None,
+                'date_weaned': None,
+            }
+            if dob is not None:
+                date_toeclipped = dob + datetime.timedelta(days=7)
+                if date_toeclipped <= end and rng.random() < 0.7:
+                    litter_d['date_toeclipped'] = date_toeclipped
+                date_weaned = dob + datetime.timedelta(days=21)
+                if date_weaned <= end and rng.random() < 0.8:
+                    litter_d['date_weaned'] = date_weaned
+            litter_d_l.append(litter_d)
+
+            if dob is not None and litter_d['date_weaned'] is None:
+                for idx in range(rng.randint(0, 8)):
+                    mouse_d_l.append({
+                        'name': '%s-p%d' % (cage_d['name'], idx + 1),
+                        'cage': cage_d,
+                        'litter': litter_d,
+                        'sex': rng.choice((0, 1, 2)),
+                        'manual_dob': None,
+                        'pure_breeder': False,
+                        'wild_type': False,
+                        'user': None,
+                        'created': dob,
+                        'genes': [],
+                    })
+
+        # The parents must exist before their litter, and the pups after
+        adult_d_l = [mouse_d for mouse_d in mouse_d_l
+            if 'litter' not in mouse_d]
+        pup_d_l = [mouse_d for mouse_d in mouse_d_l if 'litter' in mouse_d]
+        for mouse_d_sl in (adult_d_l, pup_d_l):
+            mice = create_named(Mouse, [
+                Mouse(name=mouse_d['name'], sex=mouse_d['sex'],
+                    cage=mouse_d['cage']['obj'],
+                    litter_id=mouse_d['litter']['cage']['obj'].pk
+                        if 'litter' in mouse_d else None,
+                    manual_dob=mouse_d['manual_dob'],
+                    pure_breeder=mouse_d['pure_breeder'],
+                    wild_type=mouse_d['wild_type'],
+                    user=mouse_d['user'], notes='',
+                    sack_date=mouse_d['cage']['defunct_date'])
+                for mouse_d in mouse_d_sl])
+            for mouse_d, mouse in zip(mouse_d_sl, mice):
+                mouse_d['obj'] = mouse
+
+            ## MouseGenes
+            MouseGene.objects.bulk_create([
+                MouseGene(mouse_name=mouse_d['obj'], gene_name=gene,
+                    zygosity=rng.choice(('+/+', '+/-', '+/-', '+/?')))
+                for mouse_d in mouse_d_sl for gene in mouse_d['genes']
+            ], batch_size=500)
+
+            if mouse_d_sl is adult_d_l:
+                # bulk_create sets the target_genotype slug, like saving
+                litters = []
+                for litter_d in litter_d_l:
+                    cage_d = litter_d['cage']
+                    litter = Litter(
+                        breeding_cage=cage_d['obj'],
+                        proprietor=cage_d['proprietor'],
+                        mother=cage_d['mice'][0]['obj'],
+                        father=cage_d['mice'][1]['obj'],
+                        date_mated=litter_d['date_mated'],
+                        dob=litter_d['dob'],
+                        date_toeclipped=litter_d['date_toeclipped'],
+                        date_weaned=litter_d['date_weaned'],
+                    )
+                    litters.append(litter)
+                    litter_d['obj'] = litter
+                Litter.objects.bulk_create(litters, batch_size=500)
+
+        ## Special requests
+        special_requests = []
+        for cage_d in cage_d_l:
+            if rng.random() < SPECIAL_REQUEST_FRACTION:
+                date_requested = random_date(cage_d['created'])
+                special_requests.append(SpecialRequest(
+                    cage=cage_d['obj'],
+                    message='please check this cage',
+                    requester=cage_d['proprietor'],
+                    requestee=rng.choice(persons),
+                    date_requested=date_requested,
+                    date_completed=random_date(date_requested)
+                        if rng.random() < 0.5 else None,
+                ))
+        SpecialRequest.objects.bulk_create(special_requests, batch_size=500)
+        special_requests = list(SpecialRequest.objects.all())
+
+        ## History
+        # Everything is created as it was, and the cages that are now
+        # defunct, and their mice, are changed later
+        create_history_by_date(Person,
+            [(start, person) for person in persons], '+')
+        create_history_by_date(Litter,
+            [(litter_d['date_mated'], litter_d['obj'])
+            for litter_d in litter_d_l], '+')
+        create_history_by_date(SpecialRequest,
+            [(special_request.date_requested, special_request)
+            for special_request in special_requests], '+')
+        for model, obj_d_l, field, value in (
+            (Cage, cage_d_l, 'defunct', False),
+            (Mouse, mouse_d_l, 'sack_date', None),
+            ):
+            created_l = []
+            changed_l = []
+            for obj_d in obj_d_l:
+                defunct_date = (obj_d if model is Cage else obj_d['cage'])[
+                    'defunct_date']
+                if defunct_date is None:
+                    created_l.append((obj_d['created'], obj_d['obj']))
+                else:
+                    obj = copy.copy(obj_d['obj'])
+                    setattr(obj, field, value)
+                    created_l.append((obj_d['created'], obj))
+                    changed_l.append((defunct_date, obj_d['obj']))
+            create_history_by_date(model, created_l, '+')
+            create_history_by_date(model, changed_l, '~')
+
+        ## Denormalized data
+        refresh_cages(Cage.objects.all())
+        sync_all_tasks()
+
+    return {
+        'Person': len(persons),
+        'Gene': len(genes),
+        'Cage': len(cage_d_l),
+        'Mouse': len(mouse_d_l),
+        'MouseGene': MouseGene.objects.count(),
+        'Litter': len(litter_d_l),
+        'SpecialRequest': len(special_requests),
+    }
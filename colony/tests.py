@@ -1,3 +1,1584 @@
-from django.test import TestCase
+from __future__ import unicode_literals
 
-# Create your tests here.
+import datetime
+import json
+import importlib
+import os
+import tempfile
+import threading
+from io import StringIO
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.apps import apps
+from django.db import connection, transaction
+from django.test import (RequestFactory, TestCase, TransactionTestCase, 
+    skipUnlessDBFeature)
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from . import name_index, urls
+from .benchmark import BENCHMARK_URLS, run_benchmarks
+from .bulk import (WEAN_CAGE_SUFFIXES, create_pups, create_with_history, 
+    get_pup_traits, sack_cages, set_zygosities, wean_litters)
+from .census import (CENSUS_CACHE_TIMEOUT, build_census, 
+    census_cache_timeout, get_census_rows, update_classification)
+from .changes import (diff_records, get_logged_changes, get_predecessors,
+    select_display_related)
+from .forms import CountsByPersonForm
+from .genotyping import parse_results
+from .husbandry import (TASK_METHODS, get_tasks_due, sync_all_tasks, 
+    sync_tasks)
+from .name_index import mouse_name_index
+from .occupancy import (cage_counts_by_proprietor, count_cages_by_proprietor,
+    get_cage_versions, get_counts_by_person, midnights, store_snapshots)
+from .models import (Cage, CageNameSequence, CageSnapshot, ChangeLog, Gene,
+    Genotype, HistoricalCage, HistoricalMouse, HusbandryTask, Litter, Mouse, 
+    MouseGene, Person, SpecialRequest, find_last_cage_number, 
+    generate_cage_name)
+from .profiling import QueryProfile
+from .synthetic import generate_colony
+from .views import parse_records_cursor
+
+
+class SyntheticColonyTest(TestCase):
+    """Tests of the synthetic colony generator"""
+    today = datetime.date(2020, 6, 1)
+
+    def generate(self, seed):
+        """Generate a colony, and return its contents, then roll it back"""
+        with transaction.atomic():
+            counts = generate_colony(200, seed=seed, today=self.today)
+            contents = (
+                counts,
+                list(Mouse.objects.values_list(
+                    'name', 'cage__name', 'sex', 'sack_date', 'litter_id')),
+                list(MouseGene.objects.order_by('mouse_name__name',
+                    'gene_name__name').values_list(
+                    'mouse_name__name', 'gene_name__name', 'zygosity')),
+                list(Litter.objects.order_by('breeding_cage__name'
+                    ).values_list('breeding_cage__name', 'dob',
+                    'date_weaned', 'target_genotype')),
+            )
+            transaction.set_rollback(True)
+        return contents
+
+    def test_deterministic(self):
+        self.assertEqual(self.generate(seed=1), self.generate(seed=1))
+        self.assertNotEqual(self.generate(seed=1), self.generate(seed=2))
+
+    def test_consistent(self):
+        counts = generate_colony(200, seed=1, today=self.today)
+        self.assertGreaterEqual(counts['Mouse'], 200)
+        self.assertEqual(Mouse.objects.count(), counts['Mouse'])
+
+        # The stored classification is up to date
+        self.assertEqual(update_classification(Cage.objects.all()), 0)
+
+        # Every cage and mouse has history, and defunct cages have a change
+        self.assertEqual(
+            HistoricalCage.objects.filter(history_type='+').count(),
+            counts['Cage'])
+        self.assertEqual(
+            HistoricalMouse.objects.filter(history_type='+').count(),
+            counts['Mouse'])
+        self.assertEqual(
+            ChangeLog.objects.filter(model='Cage', field='defunct').count(),
+            Cage.objects.filter(defunct=True).count())
+
+        # Mice in defunct cages are sacked
+        self.assertFalse(Mouse.objects.filter(cage__defunct=True,
+            sack_date__isnull=True).exists())
+
+class BenchmarkTest(TestCase):
+    """Tests that the benchmark runs"""
+    def test_run_benchmarks(self):
+        res = run_benchmarks([50], repeat=1)
+
+        self.assertEqual(len(res['results']), len(BENCHMARK_URLS))
+        for result in res['results']:
+            self.assertEqual(result['status'], 200, result['name'])
+            self.assertGreater(result['queries'], 0)
+
+        # The results can be saved as JSON
+        json.dumps(res)
+
+class PredecessorsTest(TestCase):
+    """Tests of finding the previous version of many records at once"""
+    def setUp(self):
+        generate_colony(100, today=datetime.date(2020, 6, 1))
+
+    def test_get_predecessors(self):
+        for history_model in (HistoricalMouse, HistoricalCage):
+            records = list(history_model.objects.all())
+            with QueryProfile() as profile:
+                predecessors = get_predecessors(history_model, records)
+            self.assertEqual(profile.n_queries, 1)
+            
+            # The latest record of the same object before each one
+            n_found = 0
+            for record in records:
+                key = (record.history_date, record.history_id)
+                earlier = [candidate for candidate in records
+                    if candidate.id == record.id and 
+                    (candidate.history_date, candidate.history_id) < key]
+                if len(earlier) == 0:
+                    self.assertIsNone(predecessors[record.history_id])
+                else:
+                    n_found += 1
+                    self.assertEqual(
+                        predecessors[record.history_id].history_id,
+                        max(earlier, key=lambda candidate: (
+                        candidate.history_date, candidate.history_id)
+                        ).history_id)
+            self.assertGreater(n_found, 0)
+
+    def test_diff_records(self):
+        """The diffs of a page of records take a fixed number of queries"""
+        records = list(select_display_related(
+            HistoricalMouse.objects.order_by('-history_id'))[:50])
+        with QueryProfile() as profile:
+            predecessors = get_predecessors(HistoricalMouse, records)
+            changes = [diff_records(predecessors[record.history_id], record)
+                for record in records 
+                if predecessors[record.history_id] is not None]
+        self.assertEqual(profile.n_queries, 1)
+        self.assertTrue(any(changes))
+        
+        # Only the fields that changed are reported
+        for change in sum(changes, []):
+            self.assertNotEqual(change['old'], change['new'])
+            self.assertNotIn(change['field'], ('history_id', 'history_date'))
+
+@override_settings(STATICFILES_STORAGE=
+    'django.contrib.staticfiles.storage.StaticFilesStorage')
+class RecordsTest(TestCase):
+    """Tests of the pagination of the records view"""
+    def get_records(self, **params):
+        response = self.client.get(reverse('colony:records'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.context
+
+    def test_cursor_without_model(self):
+        """A cursor without a model excludes records with its id"""
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+        
+        first = self.get_records(n=5)
+        history_date, history_id, model_idx = parse_records_cursor(
+            first['next_before'])
+        
+        # The records with the same date and history_id in either model
+        excluded = set()
+        for model in (HistoricalCage, HistoricalMouse):
+            for record in model.objects.filter(
+                history_date=history_date, history_id=history_id):
+                excluded.add((model.instance_type.__name__, record.name))
+        self.assertGreater(len(excluded), 0)
+
+        second = self.get_records(n=5, before='%s,%d' % (
+            history_date.isoformat(), history_id))
+        for rec_summary in second['rec_summaries']:
+            self.assertNotIn(
+                (rec_summary['model'], rec_summary['name']), excluded)
+
+@override_settings(STATICFILES_STORAGE=
+    'django.contrib.staticfiles.storage.StaticFilesStorage')
+class CensusByGenotypeTest(TestCase):
+    """Tests of grouping the census by genotype"""
+    def get_groups(self):
+        """Returns the groups of the census, as (dname, cage names)"""
+        cache.clear()
+        response = self.client.get(reverse('colony:census_by_genotype'),
+            {'location': 'All'})
+        self.assertEqual(response.status_code, 200)
+        return [(group['dname'], sorted([
+            Cage.objects.get(pk=row.pk).name for row in group['cage_l']]))
+            for group in response.context['sorted_by_geneset']]
+
+    def test_stale_classification(self):
+        """The groups don't depend on the stored classification"""
+        generate_colony(100, today=datetime.date(2020, 6, 1))
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+        groups = self.get_groups()
+        self.assertGreater(len(groups), 1)
+
+        # As if the classification was never filled in, or cut off
+        Cage.objects.update(geneset_key='empty')
+        self.assertEqual(self.get_groups(), groups)
+        Cage.objects.update(geneset_key='Emx-C')
+        self.assertEqual(self.get_groups(), groups)
+
+class BuildCensusTest(TestCase):
+    """Tests that build_census matches the Cage and Mouse properties"""
+    def setUp(self):
+        generate_colony(200, today=datetime.date.today())
+
+    def test_matches_models(self):
+        census_cages = build_census(Cage.objects.order_by('name'))
+        cages = list(Cage.objects.order_by('name'))
+        self.assertEqual([census_cage.pk for census_cage in census_cages], 
+            [cage.pk for cage in cages])
+        for census_cage, cage in zip(census_cages, cages):
+            self.assertEqual(census_cage.type_of_cage, cage.type_of_cage)
+            self.assertEqual(census_cage.printable_relevant_genesets,
+                cage.printable_relevant_genesets)
+            self.assertEqual(str(census_cage.auto_needs_message), 
+                str(cage.auto_needs_message()))
+            if census_cage.litter_pk is not None:
+                self.assertEqual(census_cage.mother_present, 
+                    cage.contains_mother_of_this_litter)
+            
+            mice = list(cage.mouse_set.all())
+            self.assertEqual([mouse.pk for mouse in census_cage.mice],
+                [mouse.pk for mouse in mice])
+            for census_mouse, mouse in zip(census_cage.mice, mice):
+                self.assertEqual(census_mouse.new_genotype, 
+                    mouse.new_genotype)
+                self.assertEqual(census_mouse.is_breedable_female, 
+                    mouse.is_breedable_female)
+                self.assertEqual(census_mouse.is_breedable_male,
+                    mouse.is_breedable_male)
+
+    def test_bounded_queries(self):
+        """The number of queries does not depend on the number of cages"""
+        n_queries = []
+        for n_cages in (1, 10, 1000):
+            with QueryProfile() as profile:
+                build_census(Cage.objects.order_by('name')[:n_cages])
+            n_queries.append(profile.n_queries)
+        self.assertEqual(n_queries, [5, 5, 5])
+
+class CensusTodayTest(TestCase):
+    """Tests that build_census computes the needs as of its today, and 
+    that the cached rows expire when they would change"""
+    def test_litter_needs(self):
+        today = datetime.date(2020, 6, 1)
+        generate_colony(100, today=today)
+        litters = Litter.objects.all()
+        self.assertTrue(litters.exists())
+        
+        # A litter with no date mated needs it as of today
+        litter = litters.first()
+        litter.date_mated = None
+        litter.dob = None
+        litter.save()
+        
+        for later in [today, today + datetime.timedelta(days=10)]:
+            census_cages = build_census(Cage.objects.filter(
+                pk__in=litters.values('breeding_cage')), today=later)
+            for census_cage in census_cages:
+                litter_needs = Litter.objects.get(
+                    pk=census_cage.pk).auto_needs_message(later)
+                self.assertTrue(
+                    census_cage.auto_needs_message.endswith(litter_needs))
+            self.assertIn('specify date mated on %s' % later.strftime('%m/%d'),
+                [census_cage.auto_needs_message 
+                for census_cage in census_cages
+                if census_cage.pk == litter.pk][0])
+
+    def test_expires(self):
+        today = datetime.date(2020, 6, 1)
+        generate_colony(100, today=today)
+        cache.clear()
+        census_cages = [census_cage for census_cage 
+            in build_census(Cage.objects.all(), today=today)
+            if census_cage.expires is not None]
+        self.assertTrue(census_cages)
+        
+        for census_cage in census_cages[:5]:
+            cage_qs = Cage.objects.filter(pk=census_cage.pk)
+            expires = census_cage.expires
+            self.assertGreater(expires, today)
+            get_census_rows(cage_qs, today=today)
+            
+            # The row is cached until the day before it expires
+            for date in (today, expires - datetime.timedelta(days=1)):
+                with QueryProfile() as profile:
+                    get_census_rows(cage_qs, today=date)
+                self.assertEqual(profile.n_queries, 1)
+            
+            # Then it is rendered again, like an uncached row
+            with QueryProfile() as profile:
+                html = get_census_rows(cage_qs, today=expires)[0].html
+            self.assertGreater(profile.n_queries, 1)
+            cache.clear()
+            self.assertEqual(get_census_rows(cage_qs, today=expires)[0].html,
+                html)
+            
+            # A row is not used before the date it was rendered on
+            with QueryProfile() as profile:
+                get_census_rows(cage_qs, today=today)
+            self.assertGreater(profile.n_queries, 1)
+
+    def test_cache_timeout(self):
+        today = datetime.date.today()
+        self.assertEqual(census_cache_timeout(None), CENSUS_CACHE_TIMEOUT)
+        self.assertEqual(census_cache_timeout(today), 1)
+        self.assertTrue(0 < census_cache_timeout(
+            today + datetime.timedelta(days=1)) <= 24 * 60 * 60)
+        self.assertEqual(census_cache_timeout(
+            today + datetime.timedelta(days=100)), CENSUS_CACHE_TIMEOUT)
+
+@override_settings(STATICFILES_STORAGE=
+    'django.contrib.staticfiles.storage.StaticFilesStorage')
+class QueryCountTest(TestCase):
+    """Tests that the number of queries of each page is bounded
+
+    Every view in colony.urls, and the changelist, add, and change pages
+    of every admin, are requested on a small and a larger synthetic
+    colony. The larger colony may only take SLACK more queries, so that
+    a query per cage or per mouse fails. The changelists are shown on a
+    single page, because pagination would hide such queries.
+
+    A new view must be added to get_urls, or test_every_view fails.
+    """
+    today = datetime.date(2020, 6, 1)
+    scales = (100, 300)
+    SLACK = 2
+
+    def get_urls(self):
+        """Returns list of (name, url) to request in the current colony"""
+        cage = Cage.objects.filter(defunct=False).order_by('pk').first()
+        litter = Litter.objects.filter(dob__isnull=False).order_by(
+            'pk').first()
+        cage_ids = Cage.objects.filter(defunct=False).values_list(
+            'pk', flat=True)
+        
+        res = [
+            ('index', reverse('colony:index')),
+            ('census', reverse('colony:census')),
+            ('census', reverse('colony:census') + '?sort_by=genotype'),
+            ('census', reverse('colony:census') + '?sort_by=rack+spot'),
+            ('census', reverse('colony:census') + 
+                '?location=All&person=person1&include_by_user=True'),
+            ('census_by_genotype', reverse('colony:census_by_genotype')),
+            ('new_mating_cage', reverse('colony:new_mating_cage')),
+            ('add_genotyping_info', reverse('colony:add_genotyping_info', 
+                args=[litter.pk])),
+            ('summary', reverse('colony:summary')),
+            ('records', reverse('colony:records')),
+            ('counts_by_person', reverse('colony:counts_by_person')),
+            ('tasks_due', reverse('colony:tasks_due')),
+            ('tasks_due_json', reverse('colony:tasks_due_json', 
+                args=['json'])),
+            ('import_genotyping', reverse('colony:import_genotyping')),
+            ('sack', reverse('colony:sack', args=[cage.pk])),
+            ('sack_multiple', reverse('colony:sack_multiple') + '?' +
+                '&'.join(['cages=%d' % pk for pk in cage_ids])),
+            ('wean', reverse('colony:wean', args=[litter.breeding_cage.pk])),
+            ('wean_due', reverse('colony:wean_due')),
+            ('query_profiles', reverse('colony:query_profiles')),
+        ]
+        for fmt in ('png', 'svg', 'json'):
+            res.append(('counts_by_person_chart', reverse(
+                'colony:counts_by_person_chart', args=[fmt])))
+        for name in ('mouse-autocomplete', 'unsacked-mouse-autocomplete',
+            'female-mouse-autocomplete', 'male-mouse-autocomplete'):
+            res.append((name, reverse('colony:' + name)))
+            res.append((name, reverse('colony:' + name) + '?q=1'))
+
+        # The admin pages of every model in this app
+        # The object to change must be in the admin's queryset
+        request = RequestFactory().get('/')
+        for model, model_admin in admin.site._registry.items():
+            if model._meta.app_label != 'colony':
+                continue
+            prefix = 'admin:colony_%s_' % model._meta.model_name
+            obj = model_admin.get_queryset(request).order_by('pk').first()
+            res.append((prefix + 'changelist', reverse(prefix + 'changelist')))
+            res.append((prefix + 'add', reverse(prefix + 'add')))
+            res.append((prefix + 'change', reverse(prefix + 'change', 
+                args=[obj.pk])))
+        
+        # Filtered changelists
+        res.append(('admin:colony_cage_changelist', reverse(
+            'admin:colony_cage_changelist') + '?defunct=all'))
+        res.append(('admin:colony_litter_changelist', reverse(
+            'admin:colony_litter_changelist') + '?date_genotyped=all'))
+        res.append(('admin:colony_mouse_changelist', reverse(
+            'admin:colony_mouse_changelist') + '?q=1'))
+        
+        return res
+
+    def generate(self, n_mice):
+        """Generate a colony, with a Genotype for its admin change page
+        
+        Genotype is deprecated, so generate_colony doesn't create any.
+        """
+        generate_colony(n_mice, today=self.today)
+        Genotype.objects.create(name='TBD')
+
+    def count_queries(self, n_mice):
+        """Generate a colony of n_mice and count the queries of each URL
+
+        The colony is rolled back afterwards.
+
+        Returns: list of (name, url, number of queries), in the order
+            of get_urls
+        """
+        res = []
+        with transaction.atomic():
+            self.generate(n_mice)
+            user = User.objects.create_superuser(
+                'test', 'test@example.com', 'test')
+            self.client.force_login(user)
+
+            for name, url in self.get_urls():
+                cache.clear()
+                with QueryProfile() as profile:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200, url)
+                res.append((name, url, profile.n_queries))
+            transaction.set_rollback(True)
+        return res
+
+    def setUp(self):
+        # Show every changelist on one page
+        for model_admin in admin.site._registry.values():
+            self.addCleanup(setattr, model_admin, 'list_per_page', 
+                model_admin.list_per_page)
+            model_admin.list_per_page = 10000
+
+    def test_every_view(self):
+        """Every view in colony.urls is tested"""
+        self.generate(self.scales[0])
+        tested = set([name for name, url in self.get_urls()])
+        for pattern in urls.urlpatterns:
+            self.assertIn(pattern.name, tested)
+
+    def test_bounded_queries(self):
+        small, large = [self.count_queries(n_mice) 
+            for n_mice in self.scales]
+        
+        for (name, url, n_small), (name, url, n_large) in zip(small, large):
+            with self.subTest(url=url):
+                self.assertLessEqual(n_large, n_small + self.SLACK,
+                    '%s took %d queries with %d mice, but %d with %d' % (
+                    name, n_small, self.scales[0], n_large, 
+                    self.scales[1]))
+
+class CountsByPersonFormTest(TestCase):
+    """Tests of the parameters of counts_by_person"""
+    def test_max_days(self):
+        end = datetime.date(2020, 6, 1)
+        start = end - datetime.timedelta(
+            days=CountsByPersonForm.max_days - 1)
+        form = CountsByPersonForm({'start': start, 'end': end, 'freq': 'D'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.get_params()[:2], (start, end))
+        
+        # One more day is too many, and the defaults are used instead
+        start -= datetime.timedelta(days=1)
+        form = CountsByPersonForm({'start': start, 'end': end, 'freq': 'D'})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(form.get_params()[:2], (
+            datetime.date.today() - datetime.timedelta(
+            weeks=CountsByPersonForm.default_weeks), datetime.date.today()))
+        
+        # The end defaults to today
+        form = CountsByPersonForm({'start': datetime.date(2000, 1, 1)})
+        self.assertFalse(form.is_valid())
+
+    @override_settings(STATICFILES_STORAGE=
+        'django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_view(self):
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+        response = self.client.get(reverse('colony:counts_by_person'),
+            {'start': '2000-01-01', 'end': '2020-06-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'The range can be at most')
+
+class OccupancyTest(TestCase):
+    """Tests of reconstructing the cages of each proprietor over time"""
+    today = datetime.date(2020, 6, 1)
+    locations = [0, 4]
+
+    def setUp(self):
+        generate_colony(200, today=self.today)
+
+    def get_dates(self):
+        """Every fifth day of the last year, plus the day after today"""
+        return [self.today - datetime.timedelta(days=days)
+            for days in range(-1, 365, 5)]
+
+    def count_slowly(self, target_date):
+        """Count the cages of each proprietor at target_date, like
+        counts_by_person originally did, with one query per date"""
+        latest = {}
+        for record in HistoricalCage.objects.filter(
+            history_date__lte=target_date).select_related('proprietor'):
+            key = (record.history_date, record.history_id)
+            if record.id not in latest or key > latest[record.id][0]:
+                latest[record.id] = (key, record)
+        
+        res = {}
+        for key, record in latest.values():
+            if (not record.defunct and record.location in self.locations
+                and record.history_type != '-'):
+                res[record.proprietor.name] = res.get(
+                    record.proprietor.name, 0) + 1
+        return res
+
+    def test_count_cages_by_proprietor(self):
+        target_dates = midnights(self.get_dates())
+        with QueryProfile() as profile:
+            counts = count_cages_by_proprietor(get_cage_versions(), 
+                target_dates, self.locations)
+        self.assertEqual(profile.n_queries, 1)
+        self.assertGreater(counts.values.sum(), 0)
+        
+        for target_date in target_dates:
+            expected = self.count_slowly(target_date)
+            self.assertEqual(dict([(proprietor, n) 
+                for proprietor, n in counts[target_date].items() if n > 0]),
+                expected)
+
+class SnapshotTest(TestCase):
+    """Tests of the daily cage snapshots"""
+    today = datetime.date(2020, 6, 1)
+    locations = [0, 4]
+
+    def setUp(self):
+        generate_colony(100, today=self.today)
+
+    def test_snapshot_counts(self):
+        """The snapshots give the same counts as the history"""
+        dates = [self.today - datetime.timedelta(days=days) 
+            for days in range(0, 200, 3)]
+        target_dates = midnights(dates)
+        expected = count_cages_by_proprietor(get_cage_versions(), 
+            target_dates, self.locations)
+        expected = expected.loc[expected.sum(1) > 0]
+        self.assertGreater(expected.values.sum(), 0)
+        
+        # With no snapshots, some, and all of them
+        for snapshot_dates in [[], dates[::2], dates]:
+            store_snapshots(snapshot_dates)
+            with QueryProfile() as profile:
+                counts = cage_counts_by_proprietor(target_dates, 
+                    self.locations)
+            self.assertTrue(counts.sort_index().equals(
+                expected.sort_index()))
+        
+        # When every date is snapshotted, the history is not read
+        self.assertFalse([sql for sql, seconds in profile.queries
+            if 'colony_historical' in sql])
+        
+        # The unsacked mice are counted in each cage
+        date = dates[-1]
+        n_mice = dict(CageSnapshot.objects.filter(date=date).values_list(
+            'cage_id', 'n_mice'))
+        latest = {}
+        for record in HistoricalMouse.objects.filter(
+            history_date__lte=midnights([date])[0]).order_by(
+            'history_date', 'history_id'):
+            latest[record.id] = record
+        expected_n_mice = dict([(cage_id, 0) for cage_id in n_mice])
+        for record in latest.values():
+            if (record.history_type != '-' and record.sack_date is None and
+                record.cage_id in expected_n_mice):
+                expected_n_mice[record.cage_id] += 1
+        self.assertEqual(n_mice, expected_n_mice)
+        self.assertGreater(sum(n_mice.values()), 0)
+
+    def test_command(self):
+        """snapshot_cages only snapshots the days after the latest one"""
+        today = datetime.date.today()
+        start = today - datetime.timedelta(days=3)
+        call_command('snapshot_cages', start=start.isoformat(), 
+            end=(today - datetime.timedelta(days=2)).isoformat(), 
+            stdout=StringIO())
+        self.assertEqual(
+            set(CageSnapshot.objects.values_list('date', flat=True)), 
+            {start, start + datetime.timedelta(days=1)})
+        
+        call_command('snapshot_cages', stdout=StringIO())
+        self.assertEqual(
+            set(CageSnapshot.objects.values_list('date', flat=True)), 
+            set([start + datetime.timedelta(days=days) 
+            for days in range(4)]))
+
+    def test_future_end(self):
+        today = datetime.date.today()
+        tomorrow = today + datetime.timedelta(days=1)
+        with self.assertRaises(CommandError):
+            call_command('snapshot_cages', start=today.isoformat(),
+                end=tomorrow.isoformat(), stdout=StringIO())
+        self.assertFalse(CageSnapshot.objects.exists())
+        
+        call_command('snapshot_cages', end=today.isoformat(), 
+            stdout=StringIO())
+        self.assertEqual(
+            set(CageSnapshot.objects.values_list('date', flat=True)), 
+            {today})
+
+class CountsByPersonCacheTest(TestCase):
+    """Tests that counts_by_person is cached until the history changes"""
+    def setUp(self):
+        generate_colony(100, today=datetime.date(2020, 6, 1))
+        cache.clear()
+        self.params = (datetime.date(2020, 1, 1), datetime.date(2020, 6, 1),
+            'W-WED', [0, 4])
+
+    def test_cache(self):
+        version, df, tabular_df = get_counts_by_person(*self.params)
+        self.assertEqual(list(df.index)[-1], 'total')
+        self.assertEqual(len(df.columns), 153)
+        self.assertTrue(df.columns.is_monotonic_decreasing)
+        self.assertTrue(set(tabular_df.columns) <= set(df.columns))
+        
+        # A hit runs one query, or none if the version is known
+        with QueryProfile() as profile:
+            res = get_counts_by_person(*self.params)
+        self.assertEqual(profile.n_queries, 1)
+        self.assertEqual(res[0], version)
+        self.assertTrue(res[1].equals(df))
+        with QueryProfile() as profile:
+            get_counts_by_person(*self.params, version=version)
+        self.assertEqual(profile.n_queries, 0)
+        
+        # Other parameters are cached separately
+        other_df = get_counts_by_person(self.params[0], self.params[1], 
+            'D', [0])[1]
+        self.assertFalse(other_df.equals(df))
+        
+        # Changing a cage changes the version
+        cage = Cage.objects.filter(defunct=False, location__in=[0, 4]
+            ).first()
+        cage.defunct = True
+        cage.save()
+        with QueryProfile() as profile:
+            new_version = get_counts_by_person(*self.params)[0]
+        self.assertGreater(new_version, version)
+        self.assertGreater(profile.n_queries, 1)
+
+class ChangeLogTest(TestCase):
+    """Tests of the stored changes of the history"""
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.records = (list(HistoricalMouse.objects.all()) + 
+            list(HistoricalCage.objects.all()))
+
+    def get_logs(self):
+        return sorted(ChangeLog.objects.values_list('model', 'object_id', 
+            'history_id', 'history_date', 'field', 'old', 'new', 
+            'change_type'))
+
+    def test_log_on_save(self):
+        mouse = Mouse.objects.filter(cage__isnull=False, 
+            notes='').first()
+        cage = Cage.objects.exclude(pk=mouse.cage_id).first()
+        old_cage_name = mouse.cage.name
+        mouse.cage = cage
+        mouse.notes = 'moved'
+        mouse.save()
+        
+        record = mouse.history.latest()
+        self.assertEqual(sorted(ChangeLog.objects.filter(model='Mouse', 
+            history_id=record.history_id).values_list(
+            'object_id', 'field', 'old', 'new', 'change_type')), [
+            (mouse.pk, 'cage', old_cage_name, cage.name, 'change'),
+            (mouse.pk, 'notes', '', 'moved', 'change'),
+        ])
+        
+        # Creating an object has no changes to log
+        new_mouse = Mouse.objects.create(name='logged', sex=0)
+        self.assertFalse(ChangeLog.objects.filter(model='Mouse', 
+            object_id=new_mouse.pk).exists())
+        
+        # The records view shows the stored changes
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+        with self.settings(STATICFILES_STORAGE=
+            'django.contrib.staticfiles.storage.StaticFilesStorage'):
+            response = self.client.get(reverse('colony:records'), {'n': 5})
+        rec_summary = [rec_summary for rec_summary 
+            in response.context['rec_summaries'] 
+            if rec_summary['model'] == 'Mouse' and 
+            rec_summary['name'] == mouse.name][0]
+        self.assertEqual(sorted([change['field'] 
+            for change in rec_summary['changes']]), ['cage', 'notes'])
+
+    def test_backfill(self):
+        """The backfill stores the same changes as were logged on save"""
+        logs = self.get_logs()
+        self.assertTrue(logs)
+        call_command('backfill_changelog', stdout=StringIO())
+        self.assertEqual(self.get_logs(), logs)
+        
+        # One model at a time
+        ChangeLog.objects.all().delete()
+        call_command('backfill_changelog', model='Cage', batch_size=7,
+            stdout=StringIO())
+        self.assertEqual(self.get_logs(), 
+            [log for log in logs if log[0] == 'Cage'])
+
+    def test_unlogged_changes(self):
+        """The history that predates ChangeLog is diffed when read"""
+        logged = get_logged_changes(self.records)
+        self.assertTrue(logged)
+
+        ChangeLog.objects.all().delete()
+        self.assertEqual(get_logged_changes(self.records), logged)
+        
+        # Only the records before the first stored change are diffed
+        call_command('backfill_changelog', stdout=StringIO())
+        self.assertEqual(get_logged_changes(self.records), logged)
+        first_change = ChangeLog.objects.order_by('history_id').first()
+        ChangeLog.objects.filter(history_id__lt=first_change.history_id + 50,
+            model=first_change.model).delete()
+        self.assertEqual(get_logged_changes(self.records), logged)
+
+class HusbandryTaskTest(TestCase):
+    """Tests of storing the litter needs in HusbandryTask"""
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+
+    def get_needs(self):
+        """Returns {(litter_id, kind): (trigger, target, warn)}"""
+        res = {}
+        for litter in Litter.objects.all():
+            for kind, method_name in TASK_METHODS.items():
+                needs = getattr(litter, method_name)()
+                if needs is not None:
+                    res[(litter.pk, kind)] = (
+                        needs['trigger'], needs['target'], needs['warn'])
+        return res
+
+    def get_pending(self):
+        return dict([((task.litter_id, task.kind), 
+            (task.trigger, task.target, task.warn))
+            for task in HusbandryTask.objects.filter(completed=False)])
+
+    def test_sync_all_tasks(self):
+        """The pending tasks are the needs of every litter"""
+        needs = self.get_needs()
+        self.assertTrue(needs)
+        self.assertEqual(self.get_pending(), needs)
+        
+        # Nothing changes when they are synced again
+        self.assertEqual(sync_all_tasks(batch_size=7), 0)
+        HusbandryTask.objects.all().delete()
+        self.assertEqual(sync_all_tasks(batch_size=7), len(needs))
+        self.assertEqual(self.get_pending(), needs)
+
+    def test_sync_on_save(self):
+        """Saving a litter updates and completes its tasks"""
+        litter = Litter.objects.filter(dob__isnull=False).first()
+        litter.date_weaned = None
+        litter.save()
+        wean = litter.tasks.get(kind='wean')
+        self.assertFalse(wean.completed)
+        
+        litter.date_weaned = litter.dob + datetime.timedelta(days=21)
+        litter.save()
+        wean.refresh_from_db()
+        self.assertTrue(wean.completed)
+        
+        litter.date_weaned = None
+        litter.dob = litter.dob - datetime.timedelta(days=3)
+        litter.save()
+        wean.refresh_from_db()
+        self.assertFalse(wean.completed)
+        self.assertEqual(wean.target, 
+            litter.dob + datetime.timedelta(days=20))
+        self.assertEqual(self.get_pending(), self.get_needs())
+
+    def test_date_mated_keeps_dates(self):
+        """A pending 'date_mated' task is not moved to today"""
+        litter = Litter.objects.filter(dob__isnull=False).first()
+        litter.dob = None
+        litter.date_mated = None
+        litter.save()
+        task = litter.tasks.get(kind='date_mated')
+        self.assertFalse(task.completed)
+        self.assertEqual(task.trigger, datetime.date.today())
+        
+        old_date = datetime.date(2020, 5, 1)
+        HusbandryTask.objects.filter(pk=task.pk).update(
+            trigger=old_date, target=old_date, warn=old_date)
+        self.assertEqual(sync_tasks([litter]), 0)
+        task.refresh_from_db()
+        self.assertEqual((task.trigger, task.target, task.warn), 
+            (old_date, old_date, old_date))
+        
+        # Once the date is specified, it is completed
+        litter.date_mated = old_date
+        litter.save()
+        task.refresh_from_db()
+        self.assertTrue(task.completed)
+
+    def test_get_tasks_due(self):
+        """The tasks due are the needs triggered by that date"""
+        needs = self.get_needs()
+        live_litters = set(Litter.objects.filter(
+            breeding_cage__defunct=False).values_list('pk', flat=True))
+        proprietor = Person.objects.order_by('pk').first()
+        proprietor_litters = set(Litter.objects.filter(
+            breeding_cage__proprietor=proprietor).values_list(
+            'pk', flat=True))
+        
+        for date in (datetime.date(2020, 4, 1), datetime.date(2020, 6, 1)):
+            expected = set([key for key, dates in needs.items()
+                if key[0] in live_litters and dates[0] <= date])
+            self.assertTrue(expected)
+            tasks = list(get_tasks_due(date))
+            self.assertEqual(
+                set([(task.litter_id, task.kind) for task in tasks]), 
+                expected)
+            self.assertEqual([task.target for task in tasks], 
+                sorted([task.target for task in tasks]))
+            self.assertEqual(
+                set([(task.litter_id, task.kind) 
+                for task in get_tasks_due(date, proprietor)]),
+                set([key for key in expected 
+                if key[0] in proprietor_litters]))
+            
+            # The view reads the same tasks, in one query
+            with QueryProfile() as profile:
+                response = self.client.get(
+                    reverse('colony:tasks_due_json', args=['json']),
+                    {'date': date.isoformat()})
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content.decode('utf-8'))
+            self.assertEqual(data['date'], date.isoformat())
+            self.assertEqual(
+                [(row['cage_id'], row['kind']) for row in data['tasks']],
+                [(task.litter_id, task.kind) for task in tasks])
+            self.assertEqual(
+                [row['overdue'] for row in data['tasks']],
+                [task.warn <= date for task in tasks])
+            self.assertEqual(len([sql for sql, seconds in profile.queries
+                if 'colony_husbandrytask' in sql]), 1)
+
+class MouseAutocompleteTest(TestCase):
+    """Tests of the mouse autocompletes"""
+    names = ('mouse-autocomplete', 'unsacked-mouse-autocomplete',
+        'female-mouse-autocomplete', 'male-mouse-autocomplete')
+    
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+
+    def get_results(self, name, **params):
+        response = self.client.get(reverse('colony:' + name), params)
+        self.assertEqual(response.status_code, 200)
+        return [result['id'] for result in 
+            json.loads(response.content.decode('utf-8'))['results']]
+
+    def check_invalid_params(self):
+        for name in self.names:
+            first_page = self.get_results(name)
+            self.assertTrue(first_page)
+            
+            # An invalid sex is ignored
+            for sex in ('x', '3', '-1'):
+                self.assertEqual(self.get_results(name, sex=sex), first_page)
+            for sex in (0, 1):
+                self.assertFalse(Mouse.objects.filter(
+                    pk__in=self.get_results(name, sex=str(sex))).exclude(
+                    sex=sex).exists())
+            
+            # An invalid page is the first page, and pages past the end
+            # are empty
+            for page in ('x', '0', '-3', '1.5'):
+                self.assertEqual(self.get_results(name, page=page), 
+                    first_page)
+            self.assertEqual(
+                self.get_results(name, page='99999999999999999999'), [])
+            self.assertEqual(self.get_results(name, page='1000'), [])
+
+    def test_invalid_params(self):
+        with self.settings(MOUSE_NAME_INDEX=False):
+            self.check_invalid_params()
+        with self.settings(MOUSE_NAME_INDEX=True):
+            self.check_invalid_params()
+
+class MouseNameIndexTest(TestCase):
+    """Tests of the in-memory mouse name index"""
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+
+    def search_pks(self, q=''):
+        return set(entry.pk for entry in mouse_name_index.search(q))
+
+    def test_bulk_changes(self):
+        """Bulk changes are seen by the next search in this process"""
+        mouse_name_index.rebuild()
+        unsacked = set(Mouse.objects.filter(sack_date__isnull=True
+            ).values_list('pk', flat=True))
+        self.assertEqual(self.search_pks(), unsacked)
+
+        # Sacked mice are removed
+        litter = Litter.objects.filter(breeding_cage__defunct=False,
+            date_weaned__isnull=True).first()
+        cage = Cage.objects.filter(defunct=False, 
+            mouse__sack_date__isnull=True).exclude(pk=litter.pk).first()
+        sacked = set(cage.mouse_set.filter(sack_date__isnull=True
+            ).values_list('pk', flat=True))
+        sack_cages(Cage.objects.filter(pk=cage.pk))
+        self.assertEqual(self.search_pks(), unsacked - sacked)
+
+        # New pups are added, and found by their genes
+        # The synthetic mice take the first pup names of their cage
+        pups = create_pups(litter, litter.mouse_set.count() + 10)
+        self.assertTrue(pups)
+        self.assertEqual(self.search_pks(), 
+            unsacked - sacked | set(pup.pk for pup in pups))
+        for pup in pups:
+            self.assertIn(pup.pk, self.search_pks(pup.name))
+            for mg in pup.mousegene_set.select_related('gene_name'):
+                self.assertIn(pup.pk, self.search_pks(mg.gene_name.name))
+
+    def expected_pks(self, q, sex=None):
+        """Returns the pks that search should return, in order"""
+        mice = sorted(Mouse.objects.filter(sack_date__isnull=True
+            ).prefetch_related('mousegene_set__gene_name'),
+            key=lambda mouse: (mouse.name.upper(), mouse.name))
+        if sex is not None:
+            mice = [mouse for mouse in mice if mouse.sex == sex]
+        q = q.upper()
+        starts = [mouse.pk for mouse in mice 
+            if mouse.name.upper().startswith(q)]
+        contains = [mouse.pk for mouse in mice 
+            if q in mouse.name.upper() and mouse.pk not in starts]
+        by_gene = [mouse.pk for mouse in mice 
+            if q not in mouse.name.upper() and any(
+            mg.gene_name.name.upper().startswith(q) 
+            for mg in mouse.mousegene_set.all())]
+        return starts + contains + by_gene
+
+    def test_search(self):
+        """Prefix matches come first, then infix, then gene matches"""
+        mouse_name_index.rebuild()
+        mouse = Mouse.objects.filter(sack_date__isnull=True).first()
+        gene = Gene.objects.order_by('pk').first()
+        for q in (mouse.name, mouse.name[:2].lower(), mouse.name[-2:], 
+            gene.name, gene.name[:3].lower(), 'no such mouse'):
+            self.assertEqual([entry.pk 
+                for entry in mouse_name_index.search(q)],
+                self.expected_pks(q))
+            for sex in (0, 1):
+                self.assertEqual([entry.pk 
+                    for entry in mouse_name_index.search(q, sex=sex)],
+                    self.expected_pks(q, sex=sex))
+        
+        # Some of the matches are only by gene
+        self.assertTrue(Mouse.objects.filter(
+            pk__in=self.expected_pks(gene.name)).exclude(
+            name__icontains=gene.name).exists())
+
+    def test_changes_by_other_processes(self):
+        """Changes not marked in this process are found by the version
+        check, once CHECK_INTERVAL has passed
+        """
+        mouse_name_index.rebuild()
+        mouse = Mouse.objects.filter(sack_date__isnull=True).first()
+        mouse.name = 'renamed elsewhere'
+        mouse.save()
+        with mouse_name_index.lock:
+            mouse_name_index.changed_ids = set()
+        
+        # Not checked yet
+        self.assertEqual(self.search_pks('renamed'), set())
+        
+        mouse_name_index.checked_at -= name_index.CHECK_INTERVAL + 1
+        self.assertEqual(self.search_pks('renamed'), set([mouse.pk]))
+        self.assertEqual([entry.pk for entry in mouse_name_index.search('')],
+            self.expected_pks(''))
+
+class BulkTest(TestCase):
+    """Tests of the bulk operations in colony.bulk"""
+    today = datetime.date(2020, 6, 1)
+
+    def setUp(self):
+        generate_colony(100, today=self.today)
+        Genotype.objects.create(name='TBD')
+        self.user = User.objects.create_user('bulk')
+        cache.clear()
+
+    def census_html(self, cage):
+        """Returns the census row of cage"""
+        return get_census_rows(Cage.objects.filter(pk=cage.pk), 
+            today=self.today)[0].html
+
+    def assert_history(self, model, objs, history_type):
+        """Each of objs has a last record of history_type, by self.user"""
+        for obj in objs:
+            record = obj.history.latest()
+            self.assertEqual(record.history_type, history_type)
+            self.assertEqual(record.history_user, self.user)
+            self.assertIsNone(record.history_change_reason)
+            for field in model._meta.fields:
+                if field.name not in record._history_excluded_fields:
+                    self.assertEqual(getattr(record, field.attname), 
+                        getattr(obj, field.attname))
+
+    def assert_refreshed(self):
+        """The stored classification of every cage is up to date"""
+        self.assertEqual(update_classification(Cage.objects.all()), 0)
+
+    def unweaned_litter(self):
+        return Litter.objects.filter(breeding_cage__defunct=False,
+            date_weaned__isnull=True).order_by('pk').first()
+
+    def test_create_with_history(self):
+        proprietor = Person.objects.first()
+        cages = create_with_history(Cage, [Cage(name='bulk%d' % idx, 
+            proprietor=proprietor, notes='') for idx in range(3)], 
+            user=self.user)
+        self.assertEqual([cage.name for cage in cages], 
+            ['bulk0', 'bulk1', 'bulk2'])
+        self.assertTrue(all(cage.pk is not None for cage in cages))
+        self.assert_history(Cage, cages, '+')
+        self.assertEqual(HistoricalCage.objects.filter(
+            id__in=[cage.pk for cage in cages]).count(), 3)
+
+    def test_create_pups(self):
+        litter = Litter.objects.select_related('breeding_cage', 'father',
+            'mother').get(pk=self.unweaned_litter().pk)
+        cage = litter.breeding_cage
+        n_existing = litter.mouse_set.count()
+        
+        # A pup name that is already taken is skipped
+        # (the synthetic mice take the first pup names of their cage)
+        cage.name = 'bulk'
+        cage.save()
+        Mouse.objects.create(name='%s-%d' % (cage.name, n_existing + 2), 
+            sex=0)
+        
+        # The census row is cached before
+        self.assertNotIn('bulk-', self.census_html(cage))
+        with QueryProfile() as profile:
+            pups = create_pups(litter, n_existing + 10, user=self.user)
+        self.assertEqual([pup.name for pup in pups], 
+            ['%s-%d' % (cage.name, pupnum) 
+            for pupnum in range(n_existing + 1, n_existing + 11) 
+            if pupnum != n_existing + 2])
+        self.assertEqual(litter.mouse_set.count(), n_existing + len(pups))
+        self.assert_history(Mouse, pups, '+')
+        
+        # Each pup has an unknown MouseGene for each gene of the parents
+        pure_breeder, wild_type, gene_ids = get_pup_traits(litter)
+        self.assertTrue(gene_ids)
+        for pup in pups:
+            self.assertEqual(pup.cage_id, cage.pk)
+            self.assertEqual(pup.sex, 2)
+            self.assertEqual(pup.genotype.name, 'TBD')
+            self.assertEqual(sorted(pup.mousegene_set.values_list(
+                'gene_name_id', 'zygosity')), 
+                sorted([(gene_id, '?/?') for gene_id in gene_ids]))
+        
+        # The census row shows the pups
+        self.assert_refreshed()
+        html = self.census_html(cage)
+        for pup in pups:
+            self.assertIn(pup.name, html)
+        
+        # The number of queries does not depend on the number of pups
+        # The pups are numbered from the count, so the last name is taken
+        number_of_pups = litter.mouse_set.count() + 2
+        with QueryProfile() as profile2:
+            self.assertEqual(len(create_pups(litter, number_of_pups, 
+                user=self.user)), 1)
+        self.assertEqual(profile2.n_queries, profile.n_queries)
+
+    def test_set_zygosities(self):
+        gene = Gene.objects.order_by('name').first()
+        mice = list(Mouse.objects.filter(sack_date__isnull=True, 
+            cage__isnull=False).order_by('pk')[:20])
+        existing = dict(MouseGene.objects.filter(gene_name=gene,
+            mouse_name__in=mice).values_list('mouse_name_id', 'zygosity'))
+        self.assertTrue(0 < len(existing) < len(mice))
+        for mouse in mice:
+            self.census_html(mouse.cage)
+        
+        # Flip the existing ones, and add the missing ones
+        zygosities = [
+            '-/-' if existing.get(mouse.pk) == '+/-' else '+/-'
+            for mouse in mice]
+        self.assertEqual(set_zygosities(gene, mice, zygosities), len(mice))
+        for mouse, zygosity in zip(mice, zygosities):
+            self.assertEqual(list(mouse.mousegene_set.filter(
+                gene_name=gene).values_list('zygosity', flat=True)), 
+                [zygosity])
+        self.assert_refreshed()
+        for mouse in mice:
+            self.assertIn(gene.name, self.census_html(mouse.cage))
+        
+        # Setting them again changes nothing, with a single query
+        with QueryProfile() as profile:
+            self.assertEqual(set_zygosities(gene, mice, zygosities), 0)
+        self.assertEqual(profile.n_queries, 1)
+        
+        # The number of queries does not depend on the number of mice
+        n_queries = []
+        for zygosity, n_mice in [('+/+', 5), ('?/?', 15)]:
+            with QueryProfile() as profile:
+                self.assertEqual(set_zygosities(gene, mice[:n_mice], 
+                    [zygosity] * n_mice), n_mice)
+            n_queries.append(profile.n_queries)
+        self.assertEqual(n_queries[0], n_queries[1])
+
+    def test_wean_litters(self):
+        litters = list(Litter.objects.filter(breeding_cage__defunct=False,
+            date_weaned__isnull=True).select_related('breeding_cage'
+            ).order_by('pk')[:2])
+        self.assertEqual(len(litters), 2)
+
+        # Give each litter a male, a female, and a pup of unknown sex
+        for idx, litter in enumerate(litters):
+            litter.breeding_cage.name = 'wean%d' % idx
+            litter.breeding_cage.save()
+            pups = create_pups(litter, litter.mouse_set.count() + 3)
+            for sex, pup in enumerate(pups):
+                pup.sex = sex
+                pup.save()
+        pups = list(Mouse.objects.filter(litter__in=litters))
+        for pup in pups:
+            self.assertIn('/admin/colony/mouse/%d"' % pup.pk, 
+                self.census_html(pup.litter.breeding_cage))
+        
+        # Nothing is changed if a cage name is taken
+        Cage.objects.create(name='wean1F', notes='', 
+            proprietor=Person.objects.first())
+        with self.assertRaises(ValueError):
+            wean_litters(litters, user=self.user)
+        self.assertFalse(Litter.objects.filter(pk__in=[
+            litter.pk for litter in litters], 
+            date_weaned__isnull=False).exists())
+        Cage.objects.filter(name='wean1F').delete()
+        
+        new_cages = wean_litters(litters, user=self.user)
+        self.assertEqual(sorted([cage.name for cage in new_cages]), [
+            'wean0F', 'wean0M', 'wean0PUP', 'wean1F', 'wean1M', 'wean1PUP'])
+        self.assert_history(Cage, new_cages, '+')
+        
+        # Each pup is in the new cage for its sex
+        for cage in new_cages:
+            breeding_cage = Cage.objects.get(name=cage.name[:5])
+            self.assertEqual(cage.location, breeding_cage.location)
+            self.assertEqual(cage.proprietor_id, 
+                breeding_cage.proprietor_id)
+        cage_names = dict(Mouse.objects.filter(litter__in=litters
+            ).values_list('pk', 'cage__name'))
+        for pup in pups:
+            self.assertEqual(cage_names[pup.pk], '%s%s' % (
+                pup.litter.breeding_cage.name, 
+                dict(WEAN_CAGE_SUFFIXES)[pup.sex]))
+        moved = list(Mouse.objects.filter(litter__in=litters))
+        self.assert_history(Mouse, moved, '~')
+        self.assertEqual(ChangeLog.objects.filter(model='Mouse', 
+            field='cage', object_id__in=[pup.pk for pup in pups]).count(),
+            len(pups))
+        
+        # The litters are weaned today
+        litters = list(Litter.objects.filter(
+            pk__in=[litter.pk for litter in litters]))
+        for litter in litters:
+            self.assertEqual(litter.date_weaned, datetime.date.today())
+        self.assert_history(Litter, litters, '~')
+        
+        # The breeding cages no longer show the pups
+        self.assert_refreshed()
+        for pup in pups:
+            self.assertNotIn('/admin/colony/mouse/%d"' % pup.pk, 
+                self.census_html(pup.litter.breeding_cage))
+
+    def test_sack_cages(self):
+        cages = list(Cage.objects.filter(defunct=False, 
+            mouse__sack_date__isnull=True).distinct().order_by('pk')[:4])
+        cage_qs = Cage.objects.filter(pk__in=[cage.pk for cage in cages])
+        self.assertEqual(len(cages), 4)
+        mice = list(Mouse.objects.filter(cage__in=cages, 
+            sack_date__isnull=True))
+        already_sacked = list(Mouse.objects.filter(cage__in=cages, 
+            sack_date__isnull=False).values_list('pk', 'sack_date'))
+        htmls = [self.census_html(cage) for cage in cages]
+        
+        with QueryProfile() as profile:
+            self.assertEqual(sack_cages(cage_qs, user=self.user), 
+                (len(cages), len(mice)))
+        
+        # The cages are defunct and their mice sacked today
+        cages = list(cage_qs)
+        self.assertTrue(all(cage.defunct for cage in cages))
+        self.assert_history(Cage, cages, '~')
+        mice = list(Mouse.objects.filter(pk__in=[mouse.pk for mouse in mice]))
+        self.assertTrue(all(
+            mouse.sack_date == datetime.date.today() for mouse in mice))
+        self.assert_history(Mouse, mice, '~')
+        self.assertEqual(list(Mouse.objects.filter(cage__in=cages, 
+            sack_date__isnull=False).exclude(pk__in=[mouse.pk for mouse 
+            in mice]).values_list('pk', 'sack_date')), already_sacked)
+        self.assertEqual(ChangeLog.objects.filter(model='Cage', 
+            field='defunct', object_id__in=[cage.pk for cage in cages]
+            ).count(), len(cages))
+        
+        # The census rows are refreshed
+        self.assert_refreshed()
+        for cage, html in zip(cages, htmls):
+            self.assertNotEqual(self.census_html(cage), html)
+        
+        # Sacking again changes nothing
+        self.assertEqual(sack_cages(cage_qs, user=self.user), (0, 0))
+        
+        # The number of queries does not depend on the number of cages
+        other_qs = Cage.objects.filter(defunct=False, 
+            mouse__sack_date__isnull=True).distinct()
+        n_other = other_qs.count()
+        self.assertNotIn(n_other, (0, len(cages)))
+        with QueryProfile() as profile2:
+            self.assertEqual(sack_cages(other_qs)[0], n_other)
+        self.assertEqual(profile2.n_queries, profile.n_queries)
+
+    @override_settings(STATICFILES_STORAGE=
+        'django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_sack_multiple(self):
+        """The sack action of CageAdmin, confirmed with sack_multiple"""
+        user = User.objects.create_superuser('test', 'test@example.com', 
+            'test')
+        self.client.force_login(user)
+        cage_ids = list(Cage.objects.filter(defunct=False).order_by(
+            'pk').values_list('pk', flat=True)[:3])
+        
+        response = self.client.post(
+            reverse('admin:colony_cage_changelist'), {
+            'action': 'sack', '_selected_action': cage_ids})
+        self.assertEqual(response.status_code, 302)
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted([cage.pk for cage in 
+            response.context['cages']]), cage_ids)
+        self.assertFalse(Cage.objects.filter(defunct=True, 
+            pk__in=cage_ids).exists())
+        
+        response = self.client.post(reverse('colony:sack_multiple'), 
+            {'cages': cage_ids})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Cage.objects.filter(defunct=True, 
+            pk__in=cage_ids).count(), 3)
+        self.assertEqual(HistoricalCage.objects.filter(id__in=cage_ids,
+            history_type='~', history_user=user).count(), 3)
+        
+        # Defunct cages cannot be chosen again
+        response = self.client.get(reverse('colony:sack_multiple'), 
+            {'cages': cage_ids})
+        self.assertFalse(response.context['form'].is_valid())
+
+@override_settings(STATICFILES_STORAGE=
+    'django.contrib.staticfiles.storage.StaticFilesStorage')
+class GenotypingImportTest(TestCase):
+    """Tests of importing genotyping results from CSV or TSV"""
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.mice = list(Mouse.objects.order_by('pk')[:3])
+        self.gene = Gene.objects.order_by('name').first()
+        self.valid_rows = [[mouse.name, self.gene.name, '+/-'] 
+            for mouse in self.mice]
+        self.client.force_login(User.objects.create_superuser(
+            'test', 'test@example.com', 'test'))
+
+    def imported(self):
+        """The zygosities after importing valid_rows"""
+        return dict([(mouse.pk, '+/-') for mouse in self.mice])
+
+    def get_zygosities(self):
+        return dict(MouseGene.objects.filter(gene_name=self.gene, 
+            mouse_name__in=self.mice).values_list('mouse_name_id', 
+            'zygosity'))
+
+    def join(self, rows, delimiter=','):
+        return '\n'.join([delimiter.join(row) for row in rows])
+
+    def test_parse_results(self):
+        # With a header, and a repeated row
+        rows = [['mouse', 'gene', 'zygosity']] + self.valid_rows + [
+            self.valid_rows[0], []]
+        for delimiter in (',', '\t'):
+            results, errors = parse_results(self.join(rows, delimiter))
+            self.assertEqual(errors, [])
+            self.assertEqual(results, [(mouse, self.gene, '+/-') 
+                for mouse in self.mice])
+        
+        # Every invalid row is reported, with its line number
+        mouse_name = self.mice[0].name
+        results, errors = parse_results(self.join(self.valid_rows + [
+            [mouse_name, self.gene.name],
+            ['nobody', 'nothing', '+/-'],
+            [mouse_name, self.gene.name, 'x'],
+            [mouse_name, self.gene.name, '-/-'],
+        ]))
+        self.assertEqual(errors, [
+            'line 4: expected 3 columns, got 2',
+            'line 5: unknown mouse "nobody"',
+            'line 5: unknown gene "nothing"',
+            'line 6: invalid zygosity "x"',
+            'line 7: conflicting result for %s %s' % (
+                mouse_name, self.gene.name),
+        ])
+
+    def test_view(self):
+        zygosities = self.get_zygosities()
+        self.assertNotEqual(zygosities, self.imported())
+        url = reverse('colony:import_genotyping')
+        
+        # Nothing is imported if a row is invalid
+        response = self.client.post(url, {'results_text': self.join(
+            self.valid_rows + [[self.mice[0].name, self.gene.name, 'x']])})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['errors'], 
+            ['line 4: invalid zygosity "x"'])
+        self.assertContains(response, 'Nothing was imported')
+        self.assertEqual(self.get_zygosities(), zygosities)
+        
+        # Nor if there are no results
+        response = self.client.post(url, {'results_text': ''})
+        self.assertContains(response, 'Upload or paste some results.')
+        self.assertEqual(self.get_zygosities(), zygosities)
+        
+        response = self.client.post(url, {'results_text': self.join(
+            self.valid_rows)})
+        self.assertEqual(response.context['n_imported'], 3)
+        self.assertEqual(self.get_zygosities(), self.imported())
+
+    def test_command(self):
+        zygosities = self.get_zygosities()
+        self.assertNotEqual(zygosities, self.imported())
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        def import_rows(rows, **options):
+            with open(path, 'w') as fi:
+                fi.write(self.join(rows))
+            call_command('import_genotyping', path, stdout=StringIO(),
+                **options)
+        
+        with self.assertRaises(CommandError) as cm:
+            import_rows(self.valid_rows + [['nobody', self.gene.name, '+/-']])
+        self.assertIn('line 4: unknown mouse "nobody"', str(cm.exception))
+        import_rows(self.valid_rows, dry_run=True)
+        self.assertEqual(self.get_zygosities(), zygosities)
+        
+        import_rows(self.valid_rows)
+        self.assertEqual(self.get_zygosities(), self.imported())
+        
+        with self.assertRaises(CommandError):
+            call_command('import_genotyping', path + '.missing')
+
+class CageNameSequenceTest(TestCase):
+    """Tests of allocating cage names with CageNameSequence"""
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.proprietor = Person.objects.order_by('pk').first()
+        self.series_number = self.proprietor.series_number
+        self.last_number = find_last_cage_number(self.series_number)
+        self.assertGreater(self.last_number, self.series_number * 1000)
+
+    def create_cage(self, name):
+        return Cage.objects.create(name=name, proprietor=self.proprietor,
+            notes='')
+
+    def test_seed_migration(self):
+        """The migration starts each series after its last cage"""
+        migration = importlib.import_module(
+            'colony.migrations.0040_cagenamesequence')
+        CageNameSequence.objects.all().delete()
+        migration.seed_sequences(apps, None)
+        series_numbers = set(Person.objects.values_list(
+            'series_number', flat=True))
+        self.assertEqual(
+            dict(CageNameSequence.objects.values_list(
+            'series_number', 'last_number')),
+            dict([(series_number, find_last_cage_number(series_number))
+            for series_number in series_numbers]))
+
+    def test_generate_cage_name(self):
+        # The sequence starts after the last cage, if it is missing
+        CageNameSequence.objects.all().delete()
+        name = generate_cage_name(self.series_number)
+        self.assertEqual(name, str(self.last_number + 1))
+        self.create_cage(name)
+        
+        # Names that were taken by hand are skipped
+        self.create_cage(str(self.last_number + 2))
+        self.assertEqual(generate_cage_name(self.series_number), 
+            str(self.last_number + 3))
+        
+        # A number is not reused, even if its cage was never created
+        self.assertEqual(generate_cage_name(self.series_number), 
+            str(self.last_number + 4))
+        self.assertEqual(CageNameSequence.objects.get(
+            series_number=self.series_number).last_number, 
+            self.last_number + 4)
+        
+        # The cage names are not read again
+        with QueryProfile() as profile:
+            generate_cage_name(self.series_number)
+        self.assertFalse([sql for sql, seconds in profile.queries 
+            if 'LIKE' in sql])
+
+    def test_series_full(self):
+        CageNameSequence.objects.update_or_create(
+            series_number=self.series_number, 
+            defaults={'last_number': self.series_number * 1000 + 998})
+        self.assertEqual(generate_cage_name(self.series_number), 
+            str(self.series_number * 1000 + 999))
+        with self.assertRaises(ValueError):
+            generate_cage_name(self.series_number)
+        self.assertEqual(CageNameSequence.objects.get(
+            series_number=self.series_number).last_number, 
+            self.series_number * 1000 + 999)
+
+class CageNameRaceTest(TransactionTestCase):
+    """Tests that concurrent requests never get the same cage name
+    
+    This needs a database that locks the sequence with select_for_update,
+    like PostgreSQL.
+    """
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent(self):
+        series_number = 9
+        n_threads, n_names = 4, 10
+        barrier = threading.Barrier(n_threads)
+        names = []
+        def allocate():
+            try:
+                barrier.wait()
+                for idx in range(n_names):
+                    names.append(generate_cage_name(series_number))
+            finally:
+                connection.close()
+        
+        threads = [threading.Thread(target=allocate) 
+            for idx in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(names), [str(9001 + idx) 
+            for idx in range(n_threads * n_names)])
+
+class CensusCacheTest(TransactionTestCase):
+    """Tests that only the census rows of changed cages are rendered again
+    
+    The signals refresh the cages when a transaction commits, so this
+    needs a TransactionTestCase.
+    """
+    today = datetime.date(2020, 6, 1)
+
+    def setUp(self):
+        generate_colony(50, today=self.today)
+        cache.clear()
+        self.cage_qs = Cage.objects.filter(defunct=False).order_by('name')
+
+    def get_rows(self):
+        """Returns a dict from cage id to its rendered html"""
+        return dict([(row.pk, row.html) 
+            for row in get_census_rows(self.cage_qs, today=self.today)])
+
+    def assert_changed(self, old_rows, cage_ids):
+        """Only the rows of cage_ids changed since old_rows"""
+        new_rows = self.get_rows()
+        self.assertEqual(set([cage_id for cage_id in new_rows 
+            if new_rows[cage_id] != old_rows[cage_id]]), set(cage_ids))
+        return new_rows
+
+    def test_cached(self):
+        rows = self.get_rows()
+        with QueryProfile() as profile:
+            self.assertEqual(self.get_rows(), rows)
+        self.assertEqual(profile.n_queries, 1)
+
+    def test_invalidation(self):
+        rows = self.get_rows()
+        
+        # Moving a mouse changes its old and new cages
+        mouse = Mouse.objects.filter(cage__in=self.cage_qs, 
+            litter__isnull=True, sack_date__isnull=True).exclude(
+            pk__in=Litter.objects.values('mother')).exclude(
+            pk__in=Litter.objects.values('father')).first()
+        old_cage = mouse.cage
+        new_cage = self.cage_qs.exclude(pk=old_cage.pk).first()
+        mouse.cage = new_cage
+        mouse.save()
+        rows = self.assert_changed(rows, [old_cage.pk, new_cage.pk])
+        self.assertIn('/admin/colony/mouse/%d"' % mouse.pk, 
+            rows[new_cage.pk])
+        
+        # And so does a special request
+        SpecialRequest.objects.create(cage=old_cage, message='clip ears')
+        rows = self.assert_changed(rows, [old_cage.pk])
+        self.assertIn('clip ears', rows[old_cage.pk])
+        
+        # Renaming a person changes the rows of its cages
+        person = new_cage.proprietor
+        person.name = 'renamed'
+        person.save()
+        rows = self.assert_changed(rows, [cage.pk 
+            for cage in self.cage_qs.filter(proprietor=person)])
+        self.assertIn('[renamed]', rows[new_cage.pk])
+
+class RefreshOnCommitTest(TransactionTestCase):
+    """Tests that saves refresh their cages once, when they commit"""
+    def setUp(self):
+        generate_colony(50, today=datetime.date(2020, 6, 1))
+        self.mice = list(Mouse.objects.filter(sack_date__isnull=True, 
+            litter__isnull=True).order_by('pk')[:6])
+        self.cage = Cage.objects.filter(defunct=False).exclude(
+            pk__in=[mouse.cage_id for mouse in self.mice]).first()
+        self.gene = Gene.objects.first()
+
+    def move_mouse(self, mouse):
+        mouse.cage = self.cage
+        mouse.save()
+        MouseGene.objects.filter(mouse_name=mouse).delete()
+        MouseGene.objects.create(mouse_name=mouse, gene_name=self.gene,
+            zygosity='+/-')
+
+    def test_one_refresh_per_transaction(self):
+        with QueryProfile() as profile:
+            with transaction.atomic():
+                for mouse in self.mice:
+                    self.move_mouse(mouse)
+                
+                # Nothing is refreshed until the transaction commits
+                self.assertNotEqual(
+                    update_classification(Cage.objects.all()), 0)
+        
+        n_touches = len([sql for sql, seconds in profile.queries
+            if sql.startswith('UPDATE') and 'census_modified' in sql])
+        self.assertEqual(n_touches, 1)
+
+    def test_refresh(self):
+        with transaction.atomic():
+            for mouse in self.mice:
+                self.move_mouse(mouse)
+        self.assertEqual(update_classification(Cage.objects.all()), 0)
+
+        # Outside of a transaction, each save refreshes immediately
+        self.mice[0].cage = self.mice[1].cage
+        self.mice[0].save()
+        self.assertEqual(update_classification(Cage.objects.all()), 0)
+
+    def test_savepoint_rollback(self):
+        """Changes after a rolled back savepoint are still refreshed"""
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    self.move_mouse(self.mice[0])
+                    raise ValueError
+            except ValueError:
+                pass
+            for mouse in self.mice[1:]:
+                self.move_mouse(mouse)
+        self.assertEqual(update_classification(Cage.objects.all()), 0)
@@ -1,4 +1,5 @@
 from django.conf.urls import url
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 
 from . import views
@@ -7,14 +8,22 @@ app_name = 'colony'
 urlpatterns = [
     url(r'^$', login_required(views.census), name='index'),
     url(r'^census$', login_required(views.census), name='census'),
-    url(r'^census_by_genotype$', login_required(views.census_by_genotype), name='census_by_genotype'),
+    url(r'^census_by_genotype$', login_required(views.census), 
+        {'sort_by': 'genotype'}, name='census_by_genotype'),
     url(r'^new_mating_cage$', login_required(views.make_mating_cage), name='new_mating_cage'),
     url(r'^add_genotyping_info/([0-9]+)/$', login_required(views.add_genotyping_information), name='add_genotyping_info'),
     url(r'^summary$', login_required(views.summary), name='summary'),
     url(r'^records$', login_required(views.records), name='records'),
     url(r'^counts_by_person$', login_required(views.counts_by_person), name='counts_by_person'),
+    url(r'^counts_by_person/chart\.(png|svg|json)$', login_required(views.counts_by_person_chart), name='counts_by_person_chart'),
+    url(r'^tasks_due$', login_required(views.tasks_due), name='tasks_due'),
+    url(r'^tasks_due\.(json)$', login_required(views.tasks_due), name='tasks_due_json'),
+    url(r'^import_genotyping$', login_required(views.import_genotyping), name='import_genotyping'),
     url(r'^sack/([0-9]+)/$', login_required(views.sack), name='sack'),
+    url(r'^sack_multiple$', login_required(views.sack_multiple), name='sack_multiple'),
     url(r'^wean/([0-9]+)/$', login_required(views.wean), name='wean'),
+    url(r'^wean_due$', login_required(views.wean_due), name='wean_due'),
+    url(r'^query_profiles$', staff_member_required(views.query_profiles), name='query_profiles'),
     url(r'^mouse-autocomplete/$', 
         login_required(views.MouseAutocomplete.as_view()), 
         name='mouse-autocomplete',),
@@ -4,17 +4,38 @@ from django.shortcuts import render
 from django.views import generic
 from django.db.models import FieldDoesNotExist
 from django.db import IntegrityError
+from django.db.models import Case, Count, IntegerField, Q, Value, When
 from django.http import HttpResponseRedirect, HttpResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.utils.dateparse import parse_datetime
 import datetime
+import hashlib
+import json
 
 from .models import (Mouse, Cage, Litter, generate_cage_name,
     Person,
-    have_same_single_gene,
+    have_same_single_gene, format_genesets,
     HistoricalCage, HistoricalMouse, MouseGene, Gene, Genotype)
 from .forms import (MatingCageForm, SackForm, AddGenotypingInfoForm,
-    ChangeNumberOfPupsForm, CensusFilterForm, WeanForm, SetMouseSexForm)
+    ChangeNumberOfPupsForm, CensusFilterForm, WeanForm, SetMouseSexForm,
+    CountsByPersonForm, TasksDueForm, GenotypingImportForm, WeanLittersForm,
+    SackCagesForm)
+from .census import get_census_rows
+from .changes import get_logged_changes
+from .occupancy import (get_counts_by_person, get_history_state,
+    counts_params_key, COUNTS_CACHE_TIMEOUT)
+from .husbandry import get_tasks_due
+from .bulk import create_pups, sack_cages, set_zygosities, wean_litters
+from .genotyping import import_results, parse_results
+from .name_index import mouse_name_index
+from .profiling import get_view_stats, reset_view_stats
 from simple_history.models import HistoricalRecords
-from itertools import chain
+from itertools import islice
+from collections import OrderedDict
+import heapq
 
 # I think there's a thread problem with importing pyplot here
 # Maybe if you specify matplotlib.use('Agg') it would be okay
@@ -33,163 +54,179 @@ from colony.models import Mouse
 # I can't figure how to use forward filtering in this version of dal
 # so separate ones for each
 class MouseAutocomplete(autocomplete.Select2QuerySetView):
-    """Autocomplete for all mice"""
+    """Autocomplete for all mice
+    
+    The search text matches the start of the mouse name, anywhere in the
+    mouse name, or the start of the name of one of its genes, and the
+    results are listed in that order. On PostgreSQL these are served by 
+    the indexes on UPPER(name) (see migration 0041).
+    
+    The other mouse autocompletes are subclasses that set filter_kwargs.
+    The GET parameters 'sex' and 'unsacked' (e.g., forwarded from the 
+    widget) also filter the results.
+    
+    If the setting MOUSE_NAME_INDEX is True, the autocompletes of unsacked
+    mice (use_name_index) search the in-memory index in colony.name_index
+    instead of the database.
+    
+    Only one page of results, plus one row to tell whether there are more,
+    is fetched for each keystroke. The matches are never counted.
+    
+    An invalid 'sex' is ignored, and an invalid 'page' is taken as the 
+    first page.
+    """
+    # Field lookups for the mice to search
+    filter_kwargs = {}
+    
+    # Whether these mice are all in the mouse name index
+    use_name_index = False
+    
+    # Pages after this one are always empty
+    max_page = 1000
+    
+    def get_sex(self):
+        """Returns the sex to filter on, or None to not filter on sex"""
+        sex = self.forwarded.get('sex', self.request.GET.get('sex'))
+        try:
+            sex = int(sex)
+        except (TypeError, ValueError):
+            return None
+        if sex not in dict(Mouse._meta.get_field('sex').choices):
+            return None
+        return sex
+    
     def get_queryset(self):
         if not self.request.user.is_authenticated:
             return Mouse.objects.none()
 
-        qs = Mouse.objects.all()
-
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
+        sex = self.get_sex()
+        if self.use_name_index and settings.MOUSE_NAME_INDEX:
+            # Like the queryset, no mouse has two different sexes
+            fixed_sex = self.filter_kwargs.get('sex')
+            if fixed_sex is not None and sex not in (None, fixed_sex):
+                return []
+            return mouse_name_index.search(self.q,
+                sex=self.filter_kwargs.get('sex', sex))
 
-        return qs        
-
-class UnsackedMouseAutocomplete(autocomplete.Select2QuerySetView):
-    """Autocomplete for unsacked mice"""
-    def get_queryset(self):
-        if not self.request.user.is_authenticated:
-            return Mouse.objects.none()
-
-        qs = Mouse.objects.filter(sack_date__isnull=True).all()
+        qs = Mouse.objects.filter(**self.filter_kwargs)
+        
+        if sex is not None:
+            qs = qs.filter(sex=sex)
+        
+        if self.forwarded.get('unsacked', self.request.GET.get('unsacked')):
+            qs = qs.filter(sack_date__isnull=True)
 
         if self.q:
-            qs = qs.filter(name__istartswith=self.q)
+            gene_mouse_ids = MouseGene.objects.filter(
+                gene_name__name__istartswith=self.q).values('mouse_name_id')
+            qs = qs.filter(
+                Q(name__icontains=self.q) | Q(pk__in=gene_mouse_ids)
+            ).annotate(match_rank=Case(
+                When(name__istartswith=self.q, then=Value(0)),
+                When(name__icontains=self.q, then=Value(1)),
+                default=Value(2),
+                output_field=IntegerField(),
+            )).order_by('match_rank', 'name')
+
+        return qs
+    
+    def paginate_queryset(self, queryset, page_size):
+        """Fetch one page of results, with LIMIT and OFFSET
+        
+        This replaces the Paginator, which counts all the matches.
+        """
+        try:
+            page = max(int(self.request.GET.get('page', 1)), 1)
+        except (TypeError, ValueError):
+            page = 1
+        if page > self.max_page:
+            self.more = False
+            return None, None, [], False
+        start = (page - 1) * page_size
+        results = list(queryset[start:start + page_size + 1])
+        self.more = len(results) > page_size
+        return None, None, results[:page_size], self.more
+    
+    def has_more(self, context):
+        return self.more
 
-        return qs      
+class UnsackedMouseAutocomplete(MouseAutocomplete):
+    """Autocomplete for unsacked mice"""
+    filter_kwargs = {'sack_date__isnull': True}
+    use_name_index = True
 
 # These two are for mating cage
-class FemaleMouseAutocomplete(autocomplete.Select2QuerySetView):
+class FemaleMouseAutocomplete(MouseAutocomplete):
     """Autocomplete for unsacked female mice"""
-    def get_queryset(self):
-        if not self.request.user.is_authenticated:
-            return Mouse.objects.none()
-
-        qs = Mouse.objects.filter(sex=1, sack_date__isnull=True).all()
+    filter_kwargs = {'sex': 1, 'sack_date__isnull': True}
+    use_name_index = True
 
-        sex = self.forwarded.get('sex', None)
-        if sex:
-            qs = qs.filter(sex=sex)
-
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
-
-        return qs       
-
-class MaleMouseAutocomplete(autocomplete.Select2QuerySetView):
+class MaleMouseAutocomplete(MouseAutocomplete):
     """Autocomplete for unsacked male mice"""
-    def get_queryset(self):
-        if not self.request.user.is_authenticated:
-            return Mouse.objects.none()
-
-        qs = Mouse.objects.filter(sex=0, sack_date__isnull=True).all()
-
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
-
-        return qs       
+    filter_kwargs = {'sex': 0, 'sack_date__isnull': True}
+    use_name_index = True
 
 
 def counts_by_person(request):
-    # Define dates to test (for graphing)
-    target_dates = pandas.date_range(
-        datetime.date.today() - datetime.timedelta(weeks=20),
-        datetime.date.today(), 
-        tz='America/New_York',
-        freq='D')[::-1]
-    
-    # Dates to test (tabular output)
-    tabular_target_dates = pandas.date_range(
-        datetime.date.today() - datetime.timedelta(weeks=20),
-        datetime.date.today(), 
-        tz='America/New_York',
-        freq='W-WED')[::-1]
-
-
-    ## Iterate over target_dates
-    pc_l = []
-    for target_date in target_dates:
-        # Find the most recent historical cage record before target date, 
-        # distinct by each cage
-        qs1 = colony.models.HistoricalCage.objects.filter(
-            history_date__lte=target_date).order_by(
-            'id', '-history_date').distinct('id')
-
-        # Include only cages that were non-defunct and in 1710 at that time
-        # And also exclude any deleted cages
-        # I think cages that contained no mice are also included here
-        qs2 = colony.models.HistoricalCage.objects.filter(
-            history_id__in=qs1.values_list('history_id', flat=True), 
-            defunct=False, location__in=[0, 4]).exclude(history_type='-')
-
-        # Extract proprietor names
-        proprietor_names = qs2.values_list('proprietor__name', flat=True)
-
-        # Count them
-        proprietor_counts = pandas.Series(list(proprietor_names)).value_counts()
-
-        # Store
-        pc_l.append(proprietor_counts)
-
-    # Concat
-    df = pandas.concat(pc_l, axis=1, sort=True).fillna(0).astype(int)
-    df.columns = target_dates
-    
-    # Sort by usage
-    df = df.loc[df.sum(1).sort_values().index[::-1]]
-    
-    # Add a total
-    df.loc['total'] = df.sum(0)
-
-
-    ## Repeat everything above for tabular
-    tabular_pc_l = []
-    for target_date in tabular_target_dates:
-        # Find the most recent historical cage record before target date, 
-        # distinct by each cage
-        qs1 = colony.models.HistoricalCage.objects.filter(
-            history_date__lte=target_date).order_by(
-            'id', '-history_date').distinct('id')
-
-        # Include only cages that were non-defunct and in 1710 at that time
-        # And also exclude any deleted cages
-        # I think cages that contained no mice are also included here
-        qs2 = colony.models.HistoricalCage.objects.filter(
-            history_id__in=qs1.values_list('history_id', flat=True), 
-            defunct=False, location__in=[0, 4]).exclude(history_type='-')
-
-        # Extract proprietor names
-        proprietor_names = qs2.values_list('proprietor__name', flat=True)
-
-        # Count them
-        proprietor_counts = pandas.Series(list(proprietor_names)).value_counts()
-
-        # Store
-        tabular_pc_l.append(proprietor_counts)
-
-    # Concat
-    tabular_df = pandas.concat(tabular_pc_l, axis=1, sort=True).fillna(0).astype(int)
-    tabular_df.columns = tabular_target_dates
+    """Plot and tabulate the number of cages owned by each person over time
     
-    # Sort by usage
-    tabular_df = tabular_df.loc[tabular_df.sum(1).sort_values().index[::-1]]
+    The date range, table resolution, and locations can be chosen with 
+    the GET parameters start, end, freq, and locations (see 
+    CountsByPersonForm). The counts are cached until a cage changes.
     
-    # Add a total
-    tabular_df.loc['total'] = tabular_df.sum(0)    
+    The chart is not rendered here, but fetched separately from 
+    counts_by_person_chart, with the same GET parameters.
+    """
+    form = CountsByPersonForm(request.GET or None)
+    start, end, freq, locations = form.get_params()
+    version, df, tabular_df = get_counts_by_person(
+        start, end, freq, locations)
     
     
     ## Format tabular text
     # Concatenate every 6 days of tabular data
     pandas.set_option('display.width', 160)
     string_result = ''
-    for idx in range(0, len(tabular_target_dates), 5):
+    for idx in range(0, len(tabular_df.columns), 5):
         subdf = tabular_df.iloc[:, idx:idx+5]
         string_result += str(subdf) + '\n\n'
     
-    # Format in pre tags
-    string_result = '<pre>' + string_result + '</pre>'
+    
+    ## Return the table, and links to the chart
+    return render(request, 'colony/counts_by_person.html', {
+        'form': form,
+        'location_names': get_location_names(locations),
+        'query': request.GET.urlencode(),
+        'string_result': string_result,
+    })
 
+def get_location_names(locations):
+    """Returns the names of locations, joined by 'and'"""
+    location_choices = dict(Cage._meta.get_field('location').choices)
+    return ' and '.join([location_choices[location] 
+        for location in locations])
 
+def render_counts_chart(df, title, fmt):
+    """Render the daily cage counts from get_counts_by_person
+    
+    fmt : 'png', 'svg', or 'json'
+        For 'json', the series are returned for plotting on the client,
+        as {'title', 'dates', 'series': [{'name', 'counts'}]}, with the
+        dates in increasing order and the total first.
+    
+    Returns: content, content_type
+    """
+    if fmt == 'json':
+        df = df.iloc[:, ::-1]
+        names = ['total'] + [name for name in df.index if name != 'total']
+        content = json.dumps({
+            'title': title,
+            'dates': [date.date().isoformat() for date in df.columns],
+            'series': [{'name': name, 'counts': [int(count) for count in 
+                df.loc[name].values]} for name in names],
+        })
+        return content, 'application/json'
+    
     ## Plot
     # Extract only people with enough cages
     subdf = df.loc[
@@ -220,31 +257,113 @@ def counts_by_person(request):
     ax.legend(['total'] + list(subdf.index), loc='center left', bbox_to_anchor=(1, 0.5))
     
     # Title
-    ax.set_title('cage counts in 1710 and SC2-011')
+    ax.set_title(title)
     #~ ax.set_xticklabels(ax.get_xticks(), rotation=90)
 
     # Print
-    # This is just to directly display it
-    #~ canvas = FigureCanvas(f)
-    #~ response = HttpResponse(content_type='image/png')
-    #~ canvas.print_png(response)
-    
-    # Put it into an img tag
-    # http://stackoverflow.com/questions/31492525/converting-matplotlib-png-to-base64-for-viewing-in-html-template
+    # The canvas has to be attached before saving
     from io import BytesIO
-    import base64
     figfile = BytesIO()
-    canvas = FigureCanvas(f)
-    canvas.print_png(figfile)
-    figfile.seek(0)
-    figdata_png = base64.b64encode(figfile.getvalue()).decode('utf-8')
-    img_result = '<img src="data:image/png;base64,%s"\\>' % figdata_png
+    FigureCanvas(f)
+    f.savefig(figfile, format=fmt)
+    
+    if fmt == 'svg':
+        return figfile.getvalue(), 'image/svg+xml'
+    return figfile.getvalue(), 'image/png'
+
+def counts_by_person_chart(request, fmt):
+    """The chart for counts_by_person, as png, svg, or json
     
+    Takes the same GET parameters as counts_by_person. 
     
-    ## Return both
-    response = HttpResponse(img_result + string_result)
+    The rendered chart is cached until a cage changes, so it is rendered
+    at most once per change. The response has an ETag and Last-Modified,
+    so browsers can revalidate it without downloading it again.
+    """
+    form = CountsByPersonForm(request.GET or None)
+    start, end, freq, locations = form.get_params()
+    params_key = counts_params_key(start, end, freq, locations)
+    
+    # The chart depends only on the parameters and the history
+    # It also changes at midnight at the start of the end date, because
+    # cages may have changed before then without any new history
+    version, modified = get_history_state()
+    etag = hashlib.md5(('%s:%s:%d' % (
+        params_key, fmt, version)).encode('utf-8')).hexdigest()
+    last_modified = int(pandas.Timestamp(end).tz_localize(
+        settings.TIME_ZONE).timestamp())
+    if modified is not None:
+        last_modified = max(last_modified, int(modified.timestamp()))
+    
+    response = get_conditional_response(request, etag=quote_etag(etag),
+        last_modified=last_modified)
+    if response is not None:
+        return response
+    
+    # Render, unless this chart is already cached
+    key = 'counts_by_person_chart:%s' % etag
+    chart = cache.get(key)
+    if chart is None:
+        version, df, tabular_df = get_counts_by_person(
+            start, end, freq, locations, version=version)
+        chart = render_counts_chart(df, 
+            'cage counts in %s' % get_location_names(locations), fmt)
+        cache.set(key, chart, COUNTS_CACHE_TIMEOUT)
+    content, content_type = chart
+    
+    response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    
+    # Always revalidate, because it changes whenever a cage changes
+    patch_cache_control(response, private=True, no_cache=True)
     return response
 
+def tasks_due(request, fmt='html'):
+    """List the husbandry tasks that are due, across all litters
+    
+    The date and proprietor can be chosen with the GET parameters date
+    and proprietor (see TasksDueForm). The tasks are read from 
+    HusbandryTask in a single query, without evaluating the needs of 
+    every litter.
+    
+    fmt : 'html', or 'json' for {'date', 'tasks': [...]}, where each 
+        task has the fields of the rows below, with dates as strings
+    """
+    form = TasksDueForm(request.GET or None)
+    date, proprietor = form.get_params()
+    
+    rows = []
+    for task in get_tasks_due(date, proprietor):
+        cage = task.litter.breeding_cage
+        rows.append({
+            'cage': cage.name,
+            'cage_id': cage.pk,
+            'proprietor': None if cage.proprietor is None else (
+                cage.proprietor.name),
+            'kind': task.kind,
+            'task': task.get_kind_display(),
+            'trigger': task.trigger,
+            'target': task.target,
+            'warn': task.warn,
+            'overdue': task.warn <= date,
+        })
+    
+    if fmt == 'json':
+        for row in rows:
+            for field in ('trigger', 'target', 'warn'):
+                row[field] = row[field].isoformat()
+        return HttpResponse(json.dumps({
+            'date': date.isoformat(),
+            'tasks': rows,
+        }), content_type='application/json')
+    
+    return render(request, 'colony/tasks_due.html', {
+        'form': form,
+        'date': date,
+        'tasks': rows,
+        'query': request.GET.urlencode(),
+    })
 
 
 def census_by_cage_number(request, census_filter_form, proprietor, 
@@ -283,28 +402,12 @@ def census_by_cage_number(request, census_filter_form, proprietor,
     # Order by name
     qs = qs.order_by(order_by)
     
-    # Now select related
-    qs = qs.prefetch_related('mouse_set').\
-        prefetch_related('specialrequest_set').\
-        prefetch_related('specialrequest_set__requester').\
-        prefetch_related('specialrequest_set__requestee').\
-        prefetch_related('mouse_set__litter').\
-        prefetch_related('mouse_set__user').\
-        prefetch_related('mouse_set__genotype').\
-        prefetch_related('litter__mouse_set').\
-        prefetch_related('litter__father__mousegene_set').\
-        prefetch_related('litter__mother__mousegene_set').\
-        prefetch_related('litter__father__mousegene_set__gene_name').\
-        prefetch_related('litter__mother__mousegene_set__gene_name').\
-        prefetch_related('mouse_set__mousegene_set').\
-        prefetch_related('mouse_set__mousegene_set__gene_name').\
-        select_related('litter', 'litter__father', 'litter__mother', 
-            'litter__mother__cage', # for contains_mother_of_this_litter
-            'proprietor', 'litter__proprietor')
+    # Render every row of the census, or get it from the cache
+    object_list = get_census_rows(qs)
 
     return render(request, 'colony/index.html', {
         'form': census_filter_form,
-        'object_list': qs,
+        'object_list': object_list,
         'include_by_user': include_by_user,
     })
 
@@ -339,57 +442,30 @@ def census_by_genotype(request, census_filter_form, proprietor,
     if location != 'All':
         qs = qs.filter(location=location)
 
-    # Now select related
-    qs = qs.prefetch_related('mouse_set').\
-        prefetch_related('specialrequest_set').\
-        prefetch_related('specialrequest_set__requester').\
-        prefetch_related('specialrequest_set__requestee').\
-        prefetch_related('mouse_set__litter').\
-        prefetch_related('mouse_set__user').\
-        prefetch_related('mouse_set__genotype').\
-        prefetch_related('litter__mouse_set').\
-        prefetch_related('litter__father__mousegene_set').\
-        prefetch_related('litter__mother__mousegene_set').\
-        prefetch_related('litter__father__mousegene_set__gene_name').\
-        prefetch_related('litter__mother__mousegene_set__gene_name').\
-        prefetch_related('mouse_set__mousegene_set').\
-        prefetch_related('mouse_set__mousegene_set__gene_name').\
-        select_related('litter', 'litter__father', 'litter__mother', 
-            'litter__mother__cage', # for contains_mother_of_this_litter
-            'proprietor', 'litter__proprietor')
-    
-    # Extract relevant genesets
-    relevant_genesets = [cage.relevant_genesets for cage in qs.all()]
-    unique_relevant_genesets = []
-    for rg in relevant_genesets:
-        for srg in rg:
-            tsrg = tuple(srg)
-            if tsrg not in unique_relevant_genesets:
-                unique_relevant_genesets.append(tsrg)
-    
-    # Sort by first gene, then number of genes
-    unique_relevant_genesets = sorted(unique_relevant_genesets, 
-        key=lambda v: (v[0] if len(v) > 0 else '', len(v)))
-
-    # Should remove this second iteration over qs.all() for SQL efficiency
-    # Just iterate once and save everything necessary
-    #
-    # Iterate once over cages and group by geneset
-    geneset2cage_l = {}
-    for cage in qs.all():
-        for geneset in cage.relevant_genesets:
-            if geneset in geneset2cage_l:
-                geneset2cage_l[geneset].append(cage)
-            else:
-                geneset2cage_l[geneset] = [cage]
+    # Order by the stored genesets, and within each group by cage type
+    qs = qs.order_by('geneset_key', 'cage_type', 'name')
 
-    # Now refactor
+    # Render every row of the census, or get it from the cache
+    # The relevant genesets of each row are computed with it, so the
+    # groups don't depend on the stored classification
+    object_list = get_census_rows(qs)
+    
+    # Group the cages by geneset, in a single pass
+    # A cage is in more than one group if it contains several genesets
+    geneset2cage_l = OrderedDict()
+    for row in object_list:
+        for geneset in row.genesets:
+            geneset2cage_l.setdefault(geneset, []).append(row)
+    
+    # Sort by first gene, then number of genes, then the other genes
     sorted_by_geneset = []
-    for geneset in unique_relevant_genesets:
+    for geneset, cage_l in sorted(geneset2cage_l.items(), 
+        key=lambda item: (item[0][0] if len(item[0]) > 0 else '', 
+        len(item[0]), item[0])):
         sorted_by_geneset.append({
             'geneset': geneset,
-            'dname': (' x '.join(geneset)) if len(geneset) > 0 else 'WT',
-            'cage_l': geneset2cage_l[geneset]
+            'dname': format_genesets([geneset]),
+            'cage_l': cage_l,
         })
 
     return render(request, 'colony/census_by_genotype.html', {
@@ -397,13 +473,17 @@ def census_by_genotype(request, census_filter_form, proprietor,
         'sorted_by_geneset': sorted_by_geneset,
     })
 
-def census(request):
+def census(request, sort_by=None):
     """Display cages and option for sorting or filtering
     
     This also handles all getting of GET parameters
+    
+    sort_by : if not None, the default sort method, instead of the
+        'sort_by' parameter
     """
     # Default values for form parameters
-    sort_by = request.GET.get('sort_by', 'cage number')
+    if sort_by is None:
+        sort_by = request.GET.get('sort_by', 'cage number')
     include_by_user = request.GET.get('include_by_user', False)
     location = request.GET.get('location', 4) # SC2-011
     
@@ -576,23 +656,60 @@ def summary(request):
     
     'persons_current':
         Same as above, but only for cages for which defunct=False.
+    
+    If the GET parameter 'by_location' is set, the current counts are
+    also broken down by location, in 'persons_by_location'.
+    
+    All counts come from one aggregate query each on Cage and Mouse.
     """
-    persons = Person.objects.all()
-    mice = Mouse.objects.all()
-    cages = Cage.objects.all()
-
+    persons = list(Person.objects.values_list('id', 'name'))
+    
+    # Locations included in the current counts
+    current_locations = [0, 4]
+    
+    
+    ## Count cages and mice by proprietor and location
+    # This is one GROUP BY query per table, regardless of the number of
+    # persons. Every table below is summed from these counts.
+    # order_by() is needed to keep Meta.ordering out of the GROUP BY.
+    # Cages are "current" if not defunct. Empty cages are excluded from
+    # the current cage count, so those are counted from the mice.
+    counts = {}
+    for row in Cage.objects.values('proprietor', 'location').annotate(
+        n_cages=Count('id')).order_by():
+        counts.setdefault((row['proprietor'], row['location']), 
+            {}).update(row)
+    
+    for row in Mouse.objects.values('cage__proprietor', 
+        'cage__location').annotate(
+        n_mice=Count('id'),
+        n_current_mice=Count('id', filter=Q(cage__defunct=False)),
+        n_current_cages=Count('cage', distinct=True, 
+            filter=Q(cage__defunct=False)),
+        ).order_by():
+        counts.setdefault((row['cage__proprietor'], row['cage__location']), 
+            {}).update(row)
+    
+    all_locations = set([location for proprietor, location in counts])
+    
+    def count(proprietor, key, locations=all_locations):
+        """Sum the count `key` for proprietor over locations"""
+        return sum([counts.get((proprietor, location), {}).get(key, 0)
+            for location in locations])
+    
+    
     # Contains information about all cages and mice stored in database
     all_table_data = [{ 
-        'name': person.name, 
-        'cages': cages.filter(proprietor=person).count(),
-        'mice': mice.filter(cage__proprietor=person).count(),
-    } for person in persons]
+        'name': name, 
+        'cages': count(pk, 'n_cages'),
+        'mice': count(pk, 'n_mice'),
+    } for pk, name in persons]
     
     # Add entry for mice without a cage
     all_table_data.append({
         'name': 'No Cage',
         'cages': 0,
-        'mice': mice.filter(cage__isnull=True).count()
+        'mice': count(None, 'n_mice'),
     })
     all_totals = {
         'cages' : sum([person['cages'] for person in all_table_data]), 
@@ -602,33 +719,68 @@ def summary(request):
     # Exclude empty cages
     # Include only cages in 1710
     current_table_data = [{ 
-        'name': person.name, 
-        'cages': cages.filter(
-            proprietor=person, defunct=False, location__in=[0, 4]).exclude( 
-            mouse__isnull=True).count(),
-        'mice': mice.filter(cage__proprietor=person, 
-            cage__defunct=False, cage__location__in=[0, 4]).count(),
-    } for person in persons]
+        'name': name, 
+        'cages': count(pk, 'n_current_cages', current_locations),
+        'mice': count(pk, 'n_current_mice', current_locations),
+    } for pk, name in persons]
 
     current_totals = {
         'cages' : sum([person['cages'] for person in current_table_data]),
         'mice' : sum([person['mice'] for person in current_table_data])}
+    
+    # Optionally, break down the current counts by every location
+    if request.GET.get('by_location', False):
+        location_choices = Cage._meta.get_field('location').choices
+        
+        # Only include locations that have any current mice
+        locations = [(location, location_name) 
+            for location, location_name in location_choices
+            if any([count(pk, 'n_current_mice', [location]) 
+                for pk, name in persons])]
+        
+        location_table_data = [{
+            'name': name,
+            'counts': [{
+                'cages': count(pk, 'n_current_cages', [location]),
+                'mice': count(pk, 'n_current_mice', [location]),
+            } for location, location_name in locations],
+        } for pk, name in persons]
+        
+        location_totals = [{
+            'cages': sum([person['counts'][idx]['cages'] 
+                for person in location_table_data]),
+            'mice': sum([person['counts'][idx]['mice'] 
+                for person in location_table_data]),
+        } for idx in range(len(locations))]
+    else:
+        locations = None
+        location_table_data = None
+        location_totals = None
 
     return render(request, 'colony/summary.html', {
         'persons_all': all_table_data, 
         'persons_current': current_table_data,
         'all_totals' : all_totals,
         'current_totals' : current_totals,
+        'locations': locations,
+        'persons_by_location': location_table_data,
+        'location_totals': location_totals,
     })
 
 def records(request):
     """ Returns a feed of Mouse and Cage model change
     
     The historical record object is used to obtain the previous 50 model changes
-    and identify which fields are altered in each
+    and the fields that were altered in each are read from ChangeLog
+    
+    GET parameters:
+        proprietor: only include records of this proprietor's cages
+        n: number of records to show (default 50)
+        before: only include records before this one (see 
+            parse_records_cursor). Each page links to the next one.
     
     Returns a request with "rec_summaries" in context data.
-    rec_summaries is a list in chronological order.
+    rec_summaries is a list in reverse chronological order.
     Each entry is a dict with the following fields:
         name: string with format
             "%MODEL_NAME% %NEW_OBJECT_NAME% %HISTORY_TYPE%"
@@ -646,9 +798,12 @@ def records(request):
     n_records = request.GET.get('n')
     try:
         n_records = int(n_records)
-    except TypeError:
+    except (TypeError, ValueError):
         n_records = 50
     
+    # Keyset pagination: only show records before this one
+    before = parse_records_cursor(request.GET.get('before'))
+    
     # Get all historical mouses and historical cages
     mouse_records = Mouse.history
     cage_records = Cage.history
@@ -658,16 +813,44 @@ def records(request):
         cage_records = cage_records.filter(
             proprietor__name__icontains=proprietor)
 
-    # Merge the historical mouse and cage records
-    records = sorted(chain(mouse_records.all(), cage_records.all()),
-        key=lambda instance: instance.history_date, reverse=True)
-
-    # Take at most 50 records
-    records = records[:n_records]
+    # Take the most recent n_records of each model, before the cursor
+    # The ordering and limit are done in SQL, so the cost depends on 
+    # n_records and not on the size of the history
+    # Records are ordered by history_date, then history_id, then model,
+    # since history_id is only unique within each model
+    record_querysets = []
+    for model_idx, history_qs in enumerate([cage_records, mouse_records]):
+        if before is not None:
+            before_date, before_id, before_model_idx = before
+            if model_idx < before_model_idx:
+                same_date_q = Q(history_id__lte=before_id)
+            else:
+                same_date_q = Q(history_id__lt=before_id)
+            history_qs = history_qs.filter(
+                Q(history_date__lt=before_date) |
+                (Q(history_date=before_date) & same_date_q))
+        record_querysets.append([
+            (record.history_date, record.history_id, model_idx, record)
+            for record in history_qs.select_related('history_user').order_by(
+            '-history_date', '-history_id')[:n_records]])
+
+    # Merge the historical mouse and cage records, and take at most
+    # n_records in total
+    merged = list(islice(heapq.merge(*record_querysets, reverse=True), 
+        n_records))
+    records = [record for history_date, history_id, model_idx, record 
+        in merged]
     
-    # Exclude these fields
-    exclude_fields = ['history_date', 'history_id', 'history_user',
-        'history_type']
+    # Cursor for the next page, if there might be one
+    if len(merged) == n_records and n_records > 0:
+        history_date, history_id, model_idx, record = merged[-1]
+        next_before = '%s,%d,%d' % (history_date.isoformat(), history_id,
+            model_idx)
+    else:
+        next_before = None
+    
+    # Get the stored changes of every record, in one query
+    changes = get_logged_changes(records)
 
     # Summarize each change
     rec_summaries = []
@@ -680,19 +863,6 @@ def records(request):
         else:
             raise ValueError("unknown model type")        
         
-        ## Get the previous version of this object, for comparison
-        # This is the pk of the object that was changed
-        real_object_pk = new_record.instance.pk
-        
-        # Search for earlier historical objects with the same pk
-        change_datetime = new_record.history_date
-        hrecs_same_object = new_record.__class__.objects.filter(
-            id=real_object_pk, 
-            history_date__lt=change_datetime)
-        
-        # Take the most recent one that is before this one
-        old_record = hrecs_same_object.order_by('history_date').last()
-
         ## Store some metadata
         rec_summary = {
             'model': model,
@@ -700,63 +870,51 @@ def records(request):
             'history_type': new_record.history_type,
             'history_user': str(new_record.history_user),
             'alter_time': new_record.history_date.strftime('%Y-%m-%d %H:%M-%S'),
+            'changes': changes.get(
+                (type(new_record), new_record.history_id), []),
         }
-
-        ## Compare old and new records, if possible
-        if old_record is None:
-            # No previous record to compare with
-            assert new_record.history_type == '+'
-            rec_summary['changes'] = []
-        else:
-            ## Find which fields differ between the 2 records
-            old_fields = type(old_record)._meta.get_fields()
-            new_fields = type(new_record)._meta.get_fields()
-            
-            # Identify which are present in the old but not the new
-            for field in old_fields:
-                # This will raise AttributeError if not present
-                getattr(new_record, field.name)
-            
-            # Iterate over all fields in the new
-            changes = []
-            for field in new_fields:
-                # Skip if excluded
-                fieldname = field.name
-                if fieldname in exclude_fields:
-                    continue
-                
-                # Get the old and new field values
-                # This will raise AttributeError if not present in old
-                old_field_value = getattr(old_record, fieldname)
-                new_field_value = getattr(new_record, fieldname)
-                change = {
-                    'field': fieldname,
-                    'old': old_field_value,
-                    'new': new_field_value,
-                }
-                
-                # Determine if this was added, deleted, changed, or nothing
-                if old_field_value is None and new_field_value is not None:
-                    change['type'] = 'addition'
-                elif new_field_value is None and old_field_value is not None:
-                    change['type'] = 'removal'
-                elif old_field_value != new_field_value:
-                    change['type'] = 'change'
-                else:
-                    # no change made to this field
-                    continue
-                
-                # Append change, if any
-                changes.append(change)
-
-            # Store in rec_summary and append
-            rec_summary['changes'] = changes
         rec_summaries.append(rec_summary)
 
     return render(request, 'colony/records.html', {
-        'rec_summaries' : rec_summaries
+        'rec_summaries' : rec_summaries,
+        'next_before': next_before,
+        'proprietor': proprietor,
+        'n_records': n_records,
     })
 
+def parse_records_cursor(before):
+    """Parse the 'before' parameter of records
+    
+    This has the format '<history_date>,<history_id>[,<model>]', with 
+    the date in ISO format, and refers to the last record of the previous
+    page. model is 0 for Cage and 1 for Mouse, and breaks ties between 
+    records of different models with the same date and history_id. If it
+    is omitted, records with the same date and history_id are excluded.
+    
+    Returns: (history_date, history_id, model), or None if invalid
+    """
+    if not before:
+        return None
+    
+    parts = before.split(',')
+    if len(parts) == 2:
+        # Lower than every model, so that ties are excluded
+        parts.append('-1')
+    if len(parts) != 3:
+        return None
+    
+    # A '+' in the timezone may have been decoded as a space
+    try:
+        history_date = parse_datetime(parts[0].replace(' ', '+'))
+        history_id = int(parts[1])
+        model_idx = int(parts[2])
+    except ValueError:
+        return None
+    if history_date is None:
+        return None
+    
+    return history_date, history_id, model_idx
+
 def sack(request, cage_id):
     """Sack all mice in the cage and mark the cage as defunct"""
     cage = Cage.objects.get(pk=cage_id)
@@ -768,11 +926,7 @@ def sack(request, cage_id):
 
         if form.is_valid():
             #Make all cage/mice defunct
-            cage.defunct = True
-            cage.save()
-            for mouse in mice:
-                mouse.sack_date = datetime.date.today()
-                mouse.save()
+            sack_cages(Cage.objects.filter(pk=cage.pk), user=request.user)
             
             #redirect to census
             return HttpResponseRedirect('/colony/') 
@@ -783,6 +937,35 @@ def sack(request, cage_id):
 
     })
 
+def sack_multiple(request):
+    """Sack all mice in several cages and mark the cages as defunct
+    
+    The cages are chosen with the parameter cages, one cage id per 
+    value, e.g. by the 'sack' action of CageAdmin. A GET shows them for
+    confirmation, and a POST sacks them all at once with 
+    colony.bulk.sack_cages.
+    """
+    if request.method == 'POST':
+        form = SackCagesForm(request.POST)
+        if form.is_valid():
+            sack_cages(form.cleaned_data['cages'], user=request.user)
+            return HttpResponseRedirect('/colony/')
+    else:
+        form = SackCagesForm(request.GET or None)
+    
+    if form.is_valid():
+        # Count the mice to sack, in the same query
+        cages = form.cleaned_data['cages'].select_related(
+            'proprietor').annotate(n_mice=Count('mouse', 
+            filter=Q(mouse__sack_date__isnull=True))).order_by('name')
+    else:
+        cages = []
+    
+    return render(request, 'colony/sack_multiple.html', {
+        'form': form,
+        'cages': cages,
+    })
+
 def add_genotyping_information(request, litter_id):
     """A view with multiple forms for managing litter.
     
@@ -823,55 +1006,9 @@ def add_genotyping_information(request, litter_id):
                     'number_of_pups']
                 
                 if new_number_of_pups > litter.mouse_set.count():
-                    # Determine the MouseGenes to add
-                    mother_genes = list(litter.mother.mousegene_set.values_list(
-                        'gene_name__id', flat=True))
-                    father_genes = list(litter.father.mousegene_set.values_list(
-                        'gene_name__id', flat=True))
-                    gene_set = Gene.objects.filter(id__in=(
-                        mother_genes + father_genes)).distinct()
-                    
-                    # pure_breeder if one parent is pure and other is wild
-                    # or if both are pure breeders of the same gene
-                    pup_is_pure = (
-                        (litter.mother.pure_breeder and litter.father.wild_type) or
-                        (litter.father.pure_breeder and litter.mother.wild_type) or
-                        (litter.father.pure_breeder and 
-                        litter.mother.pure_breeder and
-                        have_same_single_gene(litter.mother, litter.father))
-                    )
-                    
-                    # wild_type if both parents are wild_type
-                    pup_is_wild_type = (
-                        litter.mother.wild_type and litter.father.wild_type
-                    )
-                    
-                    # wild_type implies pure_breeder
-                    if pup_is_wild_type:
-                        pup_is_pure = True
-
-                    for pupnum in range(litter.mouse_set.count(), new_number_of_pups):
-                        # Create a new mouse
-                        mouse = Mouse(
-                            name='%s-%d' % (litter.breeding_cage.name, pupnum + 1),
-                            sex=2,
-                            genotype=Genotype.objects.filter(name='TBD').first(),
-                            litter=litter,
-                            cage=litter.breeding_cage,
-                            pure_breeder=pup_is_pure,
-                            wild_type=pup_is_wild_type,
-                        )
-                        try:
-                            mouse.save()
-                        except IntegrityError:
-                            # Mouse already exists due to naming the pups weirdly
-                            continue
-                        
-                        # Add its genes
-                        for gene in gene_set:
-                            mg = MouseGene(mouse_name=mouse, gene_name=gene,
-                                zygosity='?/?')
-                            mg.save()
+                    # Add the pups, with their genes, in bulk
+                    create_pups(litter, new_number_of_pups, 
+                        user=request.user)
                 elif new_number_of_pups < litter.mouse_set.count():
                     # Delete unneeded pups
                     # Assume the pup numbering is correct, so if we want
@@ -902,26 +1039,12 @@ def add_genotyping_information(request, litter_id):
             if form.is_valid():
                 # process the data in form.cleaned_data as required
                 gene_name = form.cleaned_data['gene_name']
-                for mouse in litter.mouse_set.all():
-                    result = form.cleaned_data['result_%s' % mouse.name]
-                    
-                    # If the mouse gene already exists, change it
-                    mgqs = MouseGene.objects.filter(
-                        mouse_name=mouse, gene_name=gene_name)
-                    
-                    if mgqs.count() == 0:
-                        # Create it
-                        mg = MouseGene(
-                            gene_name=gene_name,
-                            mouse_name=mouse,
-                            zygosity=result,
-                        )
-                        mg.save()
-                    else:
-                        # Edit it
-                        mg = mgqs.first()
-                        mg.zygosity = result
-                        mg.save()
+                mice = list(litter.mouse_set.all())
+                
+                # Create or change the MouseGenes in bulk
+                set_zygosities(gene_name, mice, 
+                    [form.cleaned_data['result_%s' % mouse.name]
+                    for mouse in mice])
                 
                 # Create a new, blank form (so the fields default to blank
                 # rather than to the values we just entered)
@@ -967,8 +1090,40 @@ def add_genotyping_information(request, litter_id):
             'litter': litter})
 
 
+def import_genotyping(request):
+    """Import genotyping results for many mice at once, e.g. a PCR plate
+    
+    The results are uploaded as a CSV or TSV file, or pasted, with one
+    row per result (see colony.genotyping). They are all validated 
+    first, and only imported if every row is valid.
+    """
+    errors = []
+    n_imported = None
+    n_changed = None
+    if request.method == 'POST':
+        form = GenotypingImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            results, errors = parse_results(form.cleaned_data['text'])
+            if len(errors) == 0:
+                n_changed = import_results(results)
+                n_imported = len(results)
+                form = GenotypingImportForm()
+    else:
+        form = GenotypingImportForm()
+    
+    return render(request, 'colony/import_genotyping.html', {
+        'form': form,
+        'errors': errors,
+        'n_imported': n_imported,
+        'n_changed': n_changed,
+    })
+
+
 def wean(request, cage_id):
-    """Wean pups in the cage's litter into new cages"""
+    """Wean pups in the cage's litter into new cages
+    
+    See colony.bulk.wean_litters.
+    """
     cage = Cage.objects.get(pk=cage_id)
     male_pups = cage.litter.mouse_set.filter(sex=0).all()
     female_pups = cage.litter.mouse_set.filter(sex=1).all()
@@ -979,59 +1134,96 @@ def wean(request, cage_id):
         form = WeanForm(request.POST)
 
         if form.is_valid():
-            # Create the cages and move the mice
-            if male_pups.count() > 0:
-                cage_name = cage.name + 'M'
-                male_cage = colony.models.Cage(
-                    name=cage_name,
-                    location=cage.location,
-                    proprietor=cage.proprietor,
-                    notes='',
-                )
-                male_cage.save()
-                for mouse in male_pups.all():
-                    mouse.cage = male_cage
-                    mouse.save()
-            
-            # same with females
-            if female_pups.count() > 0:
-                cage_name = cage.name + 'F'
-                female_cage = colony.models.Cage(
-                    name=cage_name,
-                    location=cage.location,
-                    proprietor=cage.proprietor,
-                    notes='',
-                )
-                female_cage.save()
-                for mouse in female_pups.all():
-                    mouse.cage = female_cage
-                    mouse.save()    
-
-            # same with unknown gender
-            if unk_pups.count() > 0:
-                cage_name = cage.name + 'PUP'
-                unk_cage = colony.models.Cage(
-                    name=cage_name,
-                    location=cage.location,
-                    proprietor=cage.proprietor,
-                    notes='',
-                )
-                unk_cage.save()
-                for mouse in unk_pups.all():
-                    mouse.cage = unk_cage
-                    mouse.save()    
-            
-            cage.litter.date_weaned = datetime.date.today()
-            cage.litter.save()
-
-            ## Redirect to a new mating cage form for the parents
-            # Should redirect to a new mating cage form, or do that above
-            # For now just redirect to the litter maintenance page
-            return HttpResponseRedirect('/colony/')
+            # Create the cages and move the mice, all at once
+            try:
+                wean_litters([cage.litter], user=request.user)
+            except ValueError as e:
+                form.add_error(None, str(e))
+            else:
+                ## Redirect to a new mating cage form for the parents
+                # Should redirect to a new mating cage form, or do that above
+                # For now just redirect to the litter maintenance page
+                return HttpResponseRedirect('/colony/')
+    else:
+        form = WeanForm()
 
     return render(request, 'colony/wean.html', {
         'cage' : cage,
+        'form': form,
         'male_pups' : male_pups,
         'female_pups' : female_pups,
         'unk_pups' : unk_pups,
     })
+
+def wean_due(request):
+    """Wean several litters at once, e.g. all of those due today
+    
+    Lists the litters with a pending 'wean' HusbandryTask (see 
+    Litter.needs_wean) that was triggered by today, with how many pups
+    of each sex they have. The chosen litters are weaned together with
+    colony.bulk.wean_litters, in one transaction.
+    """
+    today = datetime.date.today()
+    due_litters = Litter.objects.filter(
+        tasks__kind='wean',
+        tasks__completed=False,
+        tasks__trigger__lte=today,
+        breeding_cage__defunct=False,
+        date_weaned__isnull=True,
+    ).select_related('breeding_cage__proprietor').order_by(
+        'tasks__target', 'breeding_cage__name')
+    
+    if request.method == 'POST':
+        form = WeanLittersForm(request.POST, litters=due_litters)
+        if form.is_valid():
+            try:
+                wean_litters(list(form.cleaned_data['litters']),
+                    user=request.user)
+            except ValueError as e:
+                form.add_error(None, str(e))
+            else:
+                return HttpResponseRedirect('/colony/')
+    else:
+        form = WeanLittersForm(litters=due_litters)
+    
+    # Count the pups of each sex, in one query
+    litters = list(due_litters)
+    n_pups = {}
+    for litter_id, sex, n in Mouse.objects.filter(
+        litter__in=[litter.pk for litter in litters]).order_by().values_list(
+        'litter_id', 'sex').annotate(n=Count('id')):
+        n_pups[(litter_id, sex)] = n
+    
+    rows = []
+    for litter in litters:
+        rows.append({
+            'pk': litter.pk,
+            'cage': litter.breeding_cage,
+            'dob': litter.dob,
+            'n_male': n_pups.get((litter.pk, 0), 0),
+            'n_female': n_pups.get((litter.pk, 1), 0),
+            'n_unknown': n_pups.get((litter.pk, 2), 0),
+        })
+    
+    return render(request, 'colony/wean_due.html', {
+        'form': form,
+        'rows': rows,
+        'today': today,
+    })
+
+def query_profiles(request):
+    """Show the query counts and times of each view, for staff
+    
+    These are recorded by QueryProfileMiddleware, when the setting 
+    QUERY_PROFILE is True, for this process since it started or since
+    they were last reset with a POST.
+    """
+    if request.method == 'POST':
+        reset_view_stats()
+        return HttpResponseRedirect(request.path)
+    
+    return render(request, 'colony/query_profiles.html', {
+        'enabled': settings.QUERY_PROFILE,
+        'budget': settings.QUERY_BUDGET,
+        'rows': get_view_stats(),
+    })
@@ -15,11 +15,9 @@ from __future__ import print_function
 
 from builtins import zip
 from django.test.client import RequestFactory
-from django.conf import settings
-settings.DEBUG = True
-from django.db import connection
 import colony.views
 import colony.models
+from colony.profiling import QueryProfile
 
 
 
@@ -156,11 +154,11 @@ def test4():
     for cage in qs.all():
         cage
 
-cq0 = len(connection.queries)
+with QueryProfile() as profile:
+    test2()
 
-test2()
-
-cq1 = len(connection.queries)
-print(cq1 - cq0)
+print(profile.summary())
+for fp, count in profile.get_duplicates().most_common(5):
+    print('%dx %s' % (count, fp))
 
 